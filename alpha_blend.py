@@ -1,6 +1,8 @@
 from C import macro
 from blit import blitter, Pixel
 
+__templates__ = ['alpha_blend']
+
 if (-1 >> 1) < 0:
     @macro
     def ALPHA_BLEND_COMP(sC, dC, sA):
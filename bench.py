@@ -0,0 +1,252 @@
+"""Time the blit.py operations on every execution backend
+
+Each operation is timed as its tuple reference (blit.ALPHA_BLEND ...) run
+over a surface, as its template (blit.ALPHA_BLENDx ...) run by the Python
+Pixel classes, and as the template compiled by each available backend:
+run_numpy, write_py and build_c, with and without SIMD and threads. The
+passes of write_c.Compiler are timed too.
+
+Results are written as JSON, and can be checked against a baseline file
+written earlier:
+
+    python bench.py -o base.json
+    ... change transform.py ...
+    python bench.py --baseline base.json --threshold 0.1
+
+A result more than threshold (a fraction) slower per pixel than its
+baseline counts as a regression, and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+import blit
+from buffers import surface_order
+
+OPERATIONS = OrderedDict([
+    ('ALPHA_BLEND', 2),
+    ('BLEND_ADD', 2),
+    ('ZERO', 1),
+    ('ROTATE', 1),
+])
+
+# Surface kinds: (flags, depth)
+FORMATS = [(pygame.SRCALPHA, 32), (0, 32), (0, 24)]
+
+SIZES = [64, 256, 1024]
+
+# Backends looping in Python, too slow for large surfaces
+SLOW_BACKENDS = ('reference', 'template', 'python')
+SLOW_SIZE = 64
+
+def reference(func, nargs):
+    """Wrap a tuple operation of blit.py as a surface function"""
+    def run(*surfaces):
+        d = surfaces[-1]
+        width, height = d.get_size()
+        for x in range(width):
+            for y in range(height):
+                posn = (x, y)
+                d.set_at(posn, func(*[tuple(s.get_at(posn))
+                                       for s in surfaces]))
+    return run
+
+def _numpy(src):
+    import run_numpy
+    return run_numpy.Compiler(src)
+
+def _python(src):
+    import write_py
+    return write_py.Compiler(src)
+
+def _c(src):
+    import build_c
+    return build_c.Kernel(src)
+
+def _c_scalar(src):
+    import build_c
+    return build_c.Kernel(src, simd=False, threads=1)
+
+BACKENDS = OrderedDict([
+    ('reference', lambda op: reference(getattr(blit, op), OPERATIONS[op])),
+    ('template', lambda op: getattr(blit, op + 'x')),
+    ('numpy', lambda op: _numpy(getattr(blit, op + 'x_SRC'))),
+    ('python', lambda op: _python(getattr(blit, op + 'x_SRC'))),
+    ('c', lambda op: _c(getattr(blit, op + 'x_SRC'))),
+    ('c-scalar', lambda op: _c_scalar(getattr(blit, op + 'x_SRC'))),
+])
+
+def make_surface(size, flags, depth, seed):
+    """Return a surface of random pixels"""
+    surf = pygame.Surface(size, flags, depth)
+    proxy = surf.get_buffer()
+    n = proxy.length
+    proxy.write(random.Random(seed).getrandbits(8 * n).to_bytes(n, 'little'))
+    del proxy
+    return surf
+
+def time_call(func, args, min_time, repeat):
+    """Return the best seconds per call of repeat timing runs"""
+    best = None
+    for i in range(repeat):
+        number = 0
+        start = time.perf_counter()
+        while True:
+            func(*args)
+            number += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        t = elapsed / number
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench_operations(ops, backends, sizes, slow_size, min_time, repeat,
+                     log=None):
+    results = []
+    for op in ops:
+        for backend in backends:
+            try:
+                func = BACKENDS[backend](op)
+            except Exception as e:
+                if log:
+                    log("skipped {} {}: {}".format(op, backend, e))
+                continue
+            for flags, depth in FORMATS:
+                for n in sizes:
+                    if backend in SLOW_BACKENDS and n > slow_size:
+                        continue
+                    args = [make_surface((n, n), flags, depth, i)
+                            for i in range(OPERATIONS[op])]
+                    try:
+                        func(*args)
+                    except Exception as e:
+                        if log:
+                            log("skipped {} {}: {}".format(op, backend, e))
+                        break
+                    t = time_call(func, args, min_time, repeat)
+                    pixels = n * n
+                    r = OrderedDict([
+                        ('op', op),
+                        ('backend', backend),
+                        ('format', surface_order(args[-1])),
+                        ('size', [n, n]),
+                        ('seconds', t),
+                        ('ns_per_pixel', t * 1e9 / pixels),
+                        ('pixels_per_second', pixels / t),
+                    ])
+                    results.append(r)
+                    if log:
+                        log(format_result(r))
+    return results
+
+def bench_compiler(ops, repeat):
+    """Return the best time of each write_c.Compiler pass, per operation"""
+    import write_c
+
+    results = []
+    for op in ops:
+        src = getattr(blit, op + 'x_SRC')
+        best = OrderedDict()
+        for i in range(max(repeat, 5)):
+            timings = write_c.Compiler(src).timings
+            for name, t in timings.items():
+                best[name] = min(t, best.get(name, t))
+        results.append(OrderedDict([
+            ('op', op),
+            ('passes', best),
+            ('seconds', sum(best.values())),
+        ]))
+    return results
+
+def format_result(r):
+    return "{:<12} {:<10} {:<5} {:>9} {:>10.2f} ns/px {:>9.2f} Mpx/s".format(
+        r['op'], r['backend'], r['format'], '{}x{}'.format(*r['size']),
+        r['ns_per_pixel'], r['pixels_per_second'] / 1e6)
+
+def _key(r):
+    return r['op'], r['backend'], r['format'], tuple(r['size'])
+
+def compare(results, baseline, threshold):
+    """Return (result, baseline result) pairs slower than threshold allows
+    """
+    base = {_key(r): r for r in baseline['results']}
+    slower = []
+    for r in results['results']:
+        b = base.get(_key(r))
+        if b is not None and r['ns_per_pixel'] > (b['ns_per_pixel'] *
+                                                  (1 + threshold)):
+            slower.append((r, b))
+    base = {r['op']: r for r in baseline.get('compiler', [])}
+    for r in results.get('compiler', []):
+        b = base.get(r['op'])
+        if b is not None and r['seconds'] > b['seconds'] * (1 + threshold):
+            slower.append((r, b))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output',
+                        help="write results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown fraction (default 0.1)")
+    parser.add_argument('--ops', nargs='+', choices=list(OPERATIONS),
+                        default=list(OPERATIONS))
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS),
+                        default=list(BACKENDS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES,
+                        help="square surface sizes")
+    parser.add_argument('--slow-size', type=int, default=SLOW_SIZE,
+                        help="largest size for the Python loop backends")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="least seconds per timing run")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    results = OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('machine', platform.machine()),
+        ('cpus', os.cpu_count()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+    ])
+    results['results'] = bench_operations(args.ops, args.backends, args.sizes,
+                                          args.slow_size, args.min_time,
+                                          args.repeat, log)
+    results['compiler'] = bench_compiler(args.ops, args.repeat)
+    for r in results['compiler']:
+        passes = ' '.join('{}={:.3f}'.format(name, t * 1e3)
+                          for name, t in r['passes'].items())
+        log("{:<12} compile {:.3f} ms: {}".format(r['op'], r['seconds'] * 1e3,
+                                                   passes))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        for r, b in slower:
+            if 'backend' in r:
+                log("REGRESSION {}, baseline {:.2f} ns/px".format(
+                    format_result(r), b['ns_per_pixel']))
+            else:
+                log("REGRESSION {} compile: {:.3f} ms, baseline {:.3f}".format(
+                    r['op'], r['seconds'] * 1e3, b['seconds'] * 1e3))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
 from blit import Pixel, MIN
 
+__templates__ = ['blend_add']
+
 def blend_add(s: Pixel, d: Pixel) -> None:
     d.rgb = MIN(d.rgb + s.rgb, 255)
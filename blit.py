@@ -2,17 +2,24 @@
 """
 
 # Template Types
-from itertools import repeat
+from itertools import product, repeat
+from operator import add, attrgetter, floordiv, lshift, mul, rshift, sub
+from buffers import blit_region, call_region, is_indexed, transmute_palette
 
 class Group:
     """A sequence that supports some itemwise operations.
+
+    The items are kept as a tuple. Operations on groups of 3 or 4 items,
+    the usual plane counts, are written out rather than looped.
     """
 
+    __slots__ = ('items',)
+
     def __init__(self, items):
-        self.items = list(items)
+        self.items = tuple(items)
 
     def __str__(self):
-        s = "Group({})". format(self.items)
+        s = "Group({})". format(list(self.items))
         return s
 
     def __len__(self):
@@ -22,37 +29,75 @@ class Group:
         return iter(self.items)
 
     def map(self, fn):
-        return Group((fn(x) for x in self))
+        return Group(map(fn, self.items))
+
+    def _apply(self, op, other):
+        items = self.items
+        n = len(items)
+        if isinstance(other, Group):
+            others = other.items
+            if n == 3 and len(others) == 3:
+                return Group((op(items[0], others[0]), op(items[1], others[1]),
+                              op(items[2], others[2])))
+            if n == 4 and len(others) == 4:
+                return Group((op(items[0], others[0]), op(items[1], others[1]),
+                              op(items[2], others[2]),
+                              op(items[3], others[3])))
+            return Group(map(op, items, others))
+        if n == 3:
+            return Group((op(items[0], other), op(items[1], other),
+                          op(items[2], other)))
+        if n == 4:
+            return Group((op(items[0], other), op(items[1], other),
+                          op(items[2], other), op(items[3], other)))
+        return Group(map(op, items, repeat(other, n)))
 
     def __add__(self, other):
-        if not isinstance(other, Group):
-            return Group((s + other for s in self))
-        return Group((s + o for s, o in zip(self, other)))
+        return self._apply(add, other)
 
     def __sub__(self, other):
-        if not isinstance(other, Group):
-            return Group((s - other for s in self))
-        return Group((s - o for s, o in zip(self, other)))
+        return self._apply(sub, other)
 
     def __lshift__(self, other):
-        if not isinstance(other, Group):
-            return Group((s << other for s in self))
-        return Group((s << o for s, o in zip(self, other)))
+        return self._apply(lshift, other)
 
     def __rshift__(self, other):
-        if not isinstance(other, Group):
-            return Group((s >> other for s in self))
-        return Group((s >> o for s, o in zip(self, other)))
+        return self._apply(rshift, other)
 
     def __floordiv__(self, other):
-        if not isinstance(other, Group):
-            return Group((s // other for s in self))
-        return Group((s // o for s, o in zip(self, other)))
+        return self._apply(floordiv, other)
 
     def __mul__(self, other):
-        if not isinstance(other, Group):
-            return Group((s * other for s in self))
-        return Group((s * o for s, o in zip(self, other)))
+        return self._apply(mul, other)
+
+def _plane_names(attr):
+    # The slot names of the planes of a Pixel attribute, like 'brg'
+    for a in attr:
+        if a not in "rgba":
+            raise AttributeError("Invalid attribute {}".format(attr))
+    return tuple('_' + a for a in attr)
+
+def _plane_property(attr):
+    # A property for a plane attribute of a Pixel, like p.brg
+    names = _plane_names(attr)
+    setattr = object.__setattr__
+    if len(names) == 1:
+        fget = attrgetter(names[0])
+    else:
+        planes = attrgetter(*names)
+        def fget(self):
+            return Group(planes(self))
+
+    def fset(self, value):
+        if not isinstance(value, Group):
+            for name in names:
+                setattr(self, name, value)
+            return
+        if len(names) != len(value.items):
+            raise ValueError("attribute/value mismatch")
+        for name, v in zip(names, value.items):
+            setattr(self, name, v)
+    return property(fget, fset)
 
 class Pixel:
     """A mutable RGBA color
@@ -62,8 +107,14 @@ class Pixel:
     of planes as the same time. Eg:
 
     g = p.rgb  # => Group([p.r, p.g, p.a])
+
+    The planes are slots. Every attribute of up to 4 planes is a property
+    of the class, looked up in a table rather than parsed when accessed;
+    longer ones can only be read.
     """
 
+    __slots__ = ('_r', '_g', '_b', '_a')
+
     def __init__(self, r, g, b, a=255):
         self._r = r
         self._b = b
@@ -75,51 +126,24 @@ class Pixel:
         return s
 
     def __getattr__(self, attr):
-        planes = []
-        for a in attr:
-            if a == 'r':
-                planes.append(self._r)
-            elif a == 'g':
-                planes.append(self._g)
-            elif a == 'b':
-                planes.append(self._b)
-            elif a == 'a':
-                planes.append(self._a)
-            else:
-                raise AttributeError("Invalid attribute {}".format(attr))
-        if len(planes) == 1:
-            return planes[0]
-        return Group(planes)
-
-    def __setattr__(self, attr, value):
         if attr.startswith('_'):
-            object.__setattr__(self, attr, value)
-            return
-        for a in attr:
-            if a not in "rgba":
-                raise AttributeError("Invalid attribute {}".format(attr))
-        alen = len(attr)
-        if not isinstance(value, Group):
-            value = [value] * alen
-        elif alen != len(value):
-            raise ValueError("attribute/value mismatch")
-        for a, v in zip(attr, value):
-            if a == 'r':
-                self._r = v
-            elif a == 'g':
-                self._g = v
-            elif a == 'b':
-                self._b = v
-            else:  # 'a'
-                self._a = v
+            raise AttributeError(attr)
+        return Group(attrgetter(*_plane_names(attr))(self))
 
     def as_color(self):
-        return self.r, self.g, self.b, self.a
+        return self._r, self._g, self._b, self._a
 
     @classmethod
     def from_color(cls, color):
         return cls(color[0], color[1], color[2], color[3])
 
+# Swizzle table: a property for every attribute of 1 to 4 planes
+for _n in range(1, 5):
+    for _planes in product('rgba', repeat=_n):
+        _attr = ''.join(_planes)
+        setattr(Pixel, _attr, _plane_property(_attr))
+del _n, _planes, _attr
+
 class GroupFunction:
     """Wrap a function to allow it to work with groups
 
@@ -130,47 +154,64 @@ class GroupFunction:
         self.func = func
 
     def __call__(self, arg1, *args):
-        def as_iarg(arg):
+        if not isinstance(arg1, Group):
+            return self.func(arg1, *args)
+        items = arg1.items
+        group_size = len(items)
+        iargs = [items]
+        for arg in args:
             if isinstance(arg, Group):
-                if len(arg) != group_size:
+                if len(arg.items) != group_size:
                     msg_fmt = "Group size mismatch: expected {}; got {}"
                     raise ValueError(msg_fmt.format(group_size, len(arg)))
-                return iter(arg)
-            return repeat(arg, group_size)
-
-        if (isinstance(arg1, Group)):
-            group_size = len(arg1)
-            iargs = [iter(arg1)]
-            iargs.extend(as_iarg(arg) for arg in args)
-            return Group(map(self.func, *iargs))
-        return self.func(arg1, *args)
-        
+                iargs.append(arg.items)
+            else:
+                iargs.append(repeat(arg, group_size))
+        return Group(map(self.func, *iargs))
+
 MIN = GroupFunction(min)
 
 # decorators (wrappers for pygame.Surface blits)
+#
+# Like pygame.Surface.blit, a blit takes the destination position dest of
+# the source rectangle area, clipped to both surfaces (see
+# buffers.blit_region), and returns the destination rectangle changed. A
+# transmute takes area as the rectangle of the destination to change; that
+# of an 8 bit surface changes its palette (see buffers.transmute_palette).
 def blitter(func):
-    def blit(s: 'pygame.Surface', d: 'pygame.Surface'):
-        s_width, s_height = s.get_size()
-        d_width, d_height = d.get_size()
-        if s_width != d_width or s_height != d_height:
-            raise TypeError("source and destination size mismatch")
-        for r in range(s_width):
-            for c in range(s_height):
-                posn = (r, c)
-                d_pixel = Pixel.from_color(d.get_at(posn))
-                func(Pixel.from_color(s.get_at(posn)), d_pixel)
-                d.set_at(posn, d_pixel.as_color())
+    def blit(s: 'pygame.Surface', d: 'pygame.Surface', dest=None, area=None):
+        s_x, s_y, d_x, d_y, width, height = blit_region(s.get_size(),
+                                                        d.get_size(),
+                                                        dest, area)
+        for x in range(width):
+            for y in range(height):
+                d_posn = (d_x + x, d_y + y)
+                d_pixel = Pixel.from_color(d.get_at(d_posn))
+                func(Pixel.from_color(s.get_at((s_x + x, s_y + y))), d_pixel)
+                d.set_at(d_posn, d_pixel.as_color())
+        return d_x, d_y, width, height
     return blit
 
 def transmuter(func):
-    def transmute(d: 'pygame.Surface'):
-        width, height = d.get_size()
-        for c in range(width):
-            for r in range(height):
-                posn = (r, c)
+    def transmute_colors(buf):
+        view = buf.view
+        for i in range(0, len(view), 3):
+            pixel = Pixel(view[i], view[i + 1], view[i + 2])
+            func(pixel)
+            view[i:i + 3] = bytes(pixel.rgb)
+
+    def transmute(d: 'pygame.Surface', area=None):
+        if is_indexed(d):
+            return transmute_palette(transmute_colors, d, area=area)
+        [(d_x, d_y)], (width, height) = call_region([d.get_size()],
+                                                    area=area)
+        for x in range(d_x, d_x + width):
+            for y in range(d_y, d_y + height):
+                posn = (x, y)
                 pixel = Pixel.from_color(d.get_at(posn))
                 func(pixel)
                 d.set_at(posn, pixel.as_color())
+        return d_x, d_y, width, height
     return transmute
 
 def macro(func):
@@ -179,9 +220,11 @@ def macro(func):
 # alphablend equation
 
 if (-1 >> 1) < 0:
+    @macro
     def ALPHA_BLEND_COMP(sC, dC, sA):
         return ((((sC - dC) * sA + sC) >> 8) + dC)
 else:
+    @macro
     def ALPHA_BLEND_COMP(sC, dC, sA):
         return (((dC << 8) + (sC - dC) * sA + sC) >> 8)
 
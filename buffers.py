@@ -0,0 +1,312 @@
+"""Raw pixel access for the template execution backends
+
+A PixelBuffer describes where the pixels of a pygame.Surface, or of an
+object exporting a (height, width, channels) unsigned byte buffer, live in
+memory. The byte layout of a pixel is given as an order string, one letter
+per byte: 'bgra' for the usual little endian 32 bit SRCALPHA surface. An
+'x' marks a padding byte. A layout without an 'a' reads as opaque (255)
+and ignores alpha stores, like pygame.Surface.get_at and set_at do.
+"""
+
+import ctypes
+import sys
+
+class PixelBuffer:
+    """An RGBA view of a 2D pixel buffer
+
+    view is a 1D unsigned byte memoryview starting at the top left pixel.
+    Row y starts at byte y * pitch. The order of a mapped buffer, whose
+    pixels are bpp byte integers, is None.
+    """
+
+    def __init__(self, view, pitch, width, height, order, parent=None,
+                 bpp=None):
+        self.view = view
+        self.pitch = pitch
+        self.width = width
+        self.height = height
+        self.order = order
+        self.bpp = len(order) if bpp is None else bpp
+        self._parent = parent
+
+    def __str__(self):
+        s = "PixelBuffer({}x{}, pitch={}, order='{}')"
+        return s.format(self.width, self.height, self.pitch, self.order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def get_size(self):
+        return self.width, self.height
+
+    def region(self, x, y, width, height):
+        """Return a PixelBuffer of a rectangle of this one, sharing its
+        memory, which must not be released first"""
+        start = y * self.pitch + x * self.bpp
+        end = start
+        if width and height:
+            end += (height - 1) * self.pitch + width * self.bpp
+        return PixelBuffer(self.view[start:end], self.pitch, width, height,
+                           self.order, self, self.bpp)
+
+    def release(self):
+        """Release the buffer export, unlocking a surface"""
+        self.view.release()
+        self._parent = None
+
+def blit_region(src_size, dst_size, dest=None, area=None):
+    """Clip a blit to the source and destination, as pygame.Surface.blit
+
+    dest is the destination position (x, y) of the source rectangle area
+    (x, y, width, height), by default the whole source. Either can be a
+    pygame.Rect. Returns (src_x, src_y, dst_x, dst_y, width, height) of
+    the pixels blitted, with a width and height of 0 if none are.
+    """
+    src_width, src_height = src_size
+    dst_width, dst_height = dst_size
+    dst_x, dst_y = (0, 0) if dest is None else (dest[0], dest[1])
+    if area is None:
+        src_x, src_y, width, height = 0, 0, src_width, src_height
+    else:
+        src_x, src_y, width, height = area[0], area[1], area[2], area[3]
+    if src_x < 0:
+        width += src_x
+        dst_x -= src_x
+        src_x = 0
+    if src_y < 0:
+        height += src_y
+        dst_y -= src_y
+        src_y = 0
+    if dst_x < 0:
+        width += dst_x
+        src_x -= dst_x
+        dst_x = 0
+    if dst_y < 0:
+        height += dst_y
+        src_y -= dst_y
+        dst_y = 0
+    width = max(min(width, src_width - src_x, dst_width - dst_x), 0)
+    height = max(min(height, src_height - src_y, dst_height - dst_y), 0)
+    if not (width and height):
+        # Nothing is blitted: 0x0, as pygame returns
+        width = height = 0
+    return src_x, src_y, dst_x, dst_y, width, height
+
+def surface_order(surf):
+    """Return the pixel byte order string of a 24 or 32 bit pygame.Surface
+    """
+    bpp = surf.get_bytesize()
+    if bpp not in (3, 4):
+        msg = "unsupported surface pixel size {}".format(bpp)
+        raise ValueError(msg)
+    order = ['x'] * bpp
+    for plane, shift, mask in zip('rgba', surf.get_shifts(), surf.get_masks()):
+        if not mask:
+            continue
+        if shift % 8 or mask != 0xff << shift:
+            raise ValueError("unsupported surface pixel format")
+        i = shift // 8
+        if sys.byteorder == 'big':
+            i = bpp - 1 - i
+        order[i] = plane
+    return ''.join(order)
+
+def is_indexed(obj):
+    """True if obj is an 8 bit pygame.Surface, its pixels palette indices"""
+    return (hasattr(obj, 'get_palette') and hasattr(obj, 'get_bytesize') and
+            obj.get_bytesize() == 1)
+
+def transmute_palette(transmute, surf, dest=None, area=None):
+    """Run a transmuter on the palette of an 8 bit pygame.Surface
+
+    Every pixel of the surface is one of its palette colors, and a
+    transmuter only reads the pixel it changes, so transmute is called
+    once, with the palette as a 'rgb' PixelBuffer of one row, instead of
+    on each pixel. That changes the whole surface, which area, if given,
+    must cover. Returns the destination rectangle, as call_region.
+    """
+    size = surf.get_size()
+    [(x, y)], (width, height) = call_region([size], dest, area)
+    if width and height and (width, height) != size:
+        raise ValueError("a palette transmute changes the whole surface")
+    rect = (x, y, width, height)
+    if not (width and height):
+        return rect
+    palette = surf.get_palette()
+    data = bytearray()
+    for color in palette:
+        data.extend((color.r, color.g, color.b))
+    buf = PixelBuffer(memoryview(data), len(data), len(palette), 1, 'rgb')
+    transmute(buf)
+    surf.set_palette([tuple(data[i:i + 3]) for i in range(0, len(data), 3)])
+    return rect
+
+def call_region(sizes, dest=None, area=None):
+    """Return the top left (x, y) of each template argument's pixels, and
+    the (width, height), of a call clipped by blit_region
+
+    sizes are those of the arguments, the destination last; sources must
+    match. A transmuter, with only a destination, takes area as a
+    rectangle of it, and no dest.
+    """
+    *sources, dst_size = sizes
+    if not sources:
+        if dest is not None:
+            raise TypeError("a transmuter takes no dest position")
+        if area is not None:
+            dest = area[0], area[1]
+        x, y, dst_x, dst_y, width, height = blit_region(dst_size, dst_size,
+                                                        dest, area)
+        return [(dst_x, dst_y)], (width, height)
+    if any(size != sources[0] for size in sources[1:]):
+        raise TypeError("source size mismatch")
+    src_x, src_y, dst_x, dst_y, width, height = blit_region(
+        sources[0], dst_size, dest, area)
+    return ([(src_x, src_y)] * len(sources) + [(dst_x, dst_y)],
+            (width, height))
+
+def pixel_buffer(obj, mapped=False):
+    """Return a PixelBuffer for a surface or buffer object
+
+    Surfaces stay locked until the PixelBuffer is released. Other objects
+    must export a C contiguous (height, width, 3 or 4) unsigned byte array,
+    which is taken to be RGB or RGBA ordered. A mapped buffer is only
+    available for a surface, of any pixel size.
+    """
+    if isinstance(obj, PixelBuffer):
+        return obj
+    if hasattr(obj, 'get_buffer') and hasattr(obj, 'get_pitch'):
+        order = None if mapped else surface_order(obj)
+        proxy = obj.get_buffer()
+        width, height = obj.get_size()
+        view = memoryview(proxy).cast('B')
+        return PixelBuffer(view, obj.get_pitch(), width, height, order, proxy,
+                           obj.get_bytesize())
+    if mapped:
+        raise TypeError("expected a pygame.Surface")
+    view = memoryview(obj)
+    if view.ndim != 3 or view.shape[2] not in (3, 4) or view.itemsize != 1:
+        raise ValueError("expected a (height, width, 3 or 4) byte array")
+    if not view.c_contiguous:
+        raise ValueError("pixel array must be C contiguous")
+    height, width, bpp = view.shape
+    order = 'rgba'[0:bpp]
+    return PixelBuffer(view.cast('B'), width * bpp, width, height, order, obj)
+
+class SurfaceFunction:
+    """The calling convention of a compiled blitter or transmuter
+
+    A subclass sets function, the template function definition, and
+    arg_names, its argument names, then defines _run(bufs, size) to run
+    the template on the argument PixelBuffers, all of size (width, height).
+    The dest and area keywords clip the call as call_region does, and the
+    destination rectangle (x, y, width, height) blitted is returned. A
+    transmuter of an 8 bit surface is run on its palette instead (see
+    transmute_palette).
+    """
+
+    def __call__(self, *surfaces, dest=None, area=None):
+        if len(surfaces) != len(self.arg_names):
+            msg = "{}() takes {} surface arguments ({} given)"
+            raise TypeError(msg.format(self.function.name,
+                                       len(self.arg_names), len(surfaces)))
+        if len(surfaces) == 1 and is_indexed(surfaces[0]):
+            return transmute_palette(self, surfaces[0], dest, area)
+        bufs = [pixel_buffer(s) for s in surfaces]
+        regions = []
+        try:
+            posns, size = call_region([b.get_size() for b in bufs], dest,
+                                      area)
+            rect = posns[-1] + size
+            if 0 in size:
+                return rect
+            regions = [b.region(x, y, *size) for b, (x, y) in zip(bufs, posns)]
+            self._run(regions, size)
+            return rect
+        finally:
+            for r in regions:
+                r.release()
+            for b, s in zip(bufs, surfaces):
+                if b is not s:
+                    b.release()
+
+    def _run(self, bufs, size):
+        raise NotImplementedError()
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [('buf', ctypes.c_void_p),
+                ('obj', ctypes.c_void_p),
+                ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t),
+                ('readonly', ctypes.c_int),
+                ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p),
+                ('shape', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('strides', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('suboffsets', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('internal', ctypes.c_void_p)]
+
+PyBUF_WRITABLE = 0x0001
+PyBUF_FORMAT = 0x0004
+PyBUF_ND = 0x0008
+PyBUF_STRIDES = 0x0010 | PyBUF_ND
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+                        ctypes.c_int]
+_get_buffer.restype = ctypes.c_int
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+_release_buffer.restype = None
+
+class ArrayBuffer:
+    """The memory of a 2D integer array, as exported (PEP 3118)
+
+    Strided arrays, like those of pygame.surfarray, are used in place.
+    address is that of element [0, 0]; strides are in bytes. signed is
+    True for a signed integer format.
+    """
+
+    def __init__(self, obj, writable=False):
+        self._buffer = None
+        flags = PyBUF_STRIDES | PyBUF_FORMAT
+        if writable:
+            flags |= PyBUF_WRITABLE
+        b = _Py_buffer()
+        _get_buffer(obj, ctypes.byref(b), flags)
+        self._buffer = b
+        try:
+            if b.ndim != 2:
+                raise ValueError("expected a 2D array")
+            fmt = b.format.decode('ascii').lstrip('@=<>!')
+            if fmt not in 'bBhHiIlLqQ' or len(fmt) != 1:
+                raise ValueError("expected an integer array")
+            if b.itemsize not in (1, 2, 4, 8):
+                msg = "unsupported array item size {}".format(b.itemsize)
+                raise ValueError(msg)
+        except Exception:
+            self.release()
+            raise
+        self.address = b.buf
+        self.itemsize = b.itemsize
+        self.signed = fmt in 'bhilq'
+        self.readonly = bool(b.readonly)
+        self.shape = (b.shape[0], b.shape[1])
+        self.strides = (b.strides[0], b.strides[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+    def release(self):
+        if self._buffer is not None:
+            _release_buffer(ctypes.byref(self._buffer))
+            self._buffer = None
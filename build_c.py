@@ -0,0 +1,577 @@
+"""Build, load and call the C code written by write_c
+
+A template is compiled by write_c.Compiler into a C translation unit,
+which the system C compiler turns into a shared library loaded with
+ctypes. Libraries are cached on disk, named by a hash of the C source and
+the compiler command, so an unchanged template is never rebuilt.
+
+The cache directory is $PIXEL_CACHE_DIR, else $XDG_CACHE_HOME/pixel or
+~/.cache/pixel. The compiler is $CC, else cc. The template compiler's own
+results, its lowered AST and C code, are cached there too, keyed by the
+template source and the source of the compiler modules.
+
+ctypes releases the GIL for the length of a call, so a large destination
+is split into bands of rows run on a shared thread pool. The number of
+threads is $PIXEL_THREADS, else the CPU count. Setting $PIXEL_STATS builds
+kernels that count their calls (see Kernel.get_stats).
+"""
+
+import ast
+import ctypes
+import hashlib
+import importlib.util
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from buffers import (pixel_buffer, blit_region, call_region, ArrayBuffer,
+                     is_indexed, transmute_palette)
+from rgba import RGBA
+from mapped import Mapped, Element
+import transform
+import rgba
+import mapped
+import write_c
+import blit
+
+CC = os.environ.get('CC', 'cc')
+CFLAGS = ['-O2', '-fPIC', '-shared']
+
+THREADS = int(os.environ.get('PIXEL_THREADS', 0)) or os.cpu_count() or 1
+# Fewest pixels per band worth handing to another thread
+BAND_PIXELS = 1 << 16
+# Build kernels counting their calls (see Kernel.get_stats)
+STATS = os.environ.get('PIXEL_STATS', '') not in ('', '0')
+
+# The array typecode of a ptrdiff_t, for write_c.BatchWriter records
+_SSIZE_CODE = [c for c in 'ilq'
+               if array(c).itemsize == ctypes.sizeof(ctypes.c_ssize_t)][0]
+
+if sys.platform == 'win32':
+    LIB_SUFFIX = '.dll'
+elif sys.platform == 'darwin':
+    LIB_SUFFIX = '.dylib'
+else:
+    LIB_SUFFIX = '.so'
+
+class BuildError(Exception):
+    pass
+
+LoopStats = namedtuple('LoopStats', 'calls pixels bytes nanoseconds')
+
+class _PixelStats(ctypes.Structure):
+    # write_c's pixel_stats
+    _fields_ = [(field, ctypes.c_uint64) for field in LoopStats._fields]
+
+def cache_dir():
+    """Return the directory holding built libraries"""
+    try:
+        return os.environ['PIXEL_CACHE_DIR']
+    except KeyError:
+        pass
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pixel')
+
+def build(code, cflags=CFLAGS, cc=CC):
+    """Compile C source code into a shared library, returning its path
+
+    A library already built from the same code and command is reused.
+    """
+    key_src = '\0'.join([cc] + list(cflags) + [code])
+    key = hashlib.sha256(key_src.encode('utf-8')).hexdigest()
+    directory = cache_dir()
+    path = os.path.join(directory, key + LIB_SUFFIX)
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+    fd, c_path = tempfile.mkstemp('.c', key + '-', directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(code)
+    tmp_path = c_path[0:-2] + LIB_SUFFIX
+    cmd = [cc] + list(cflags) + ['-o', tmp_path, c_path]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            msg = "{} failed:\n{}".format(' '.join(cmd), result.stdout)
+            raise BuildError(msg)
+        # Rename last, so concurrent builders never load a partial library
+        os.replace(c_path, os.path.join(directory, key + '.c'))
+        os.replace(tmp_path, path)
+    finally:
+        for p in (c_path, tmp_path):
+            if os.path.exists(p):
+                os.remove(p)
+    return path
+
+# Modules whose source decides what write_c.Compiler writes. blit holds
+# the macros templates see by default (see write_c.Compiler).
+COMPILER_MODULES = [transform, rgba, mapped, write_c, blit]
+
+_compiler_version = None
+
+def compiler_version():
+    """Return a hash of the source of the template compiler"""
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        for module in COMPILER_MODULES:
+            with open(module.__file__, 'rb') as f:
+                h.update(f.read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+def _canonical(value):
+    if isinstance(value, ast.AST):
+        return ast.dump(value)
+    if isinstance(value, dict):
+        return sorted((k, _canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+def _imported_sources(src):
+    # The source of each module a template imports from
+    sources = []
+    for node in ast.parse(src).body:
+        if isinstance(node, ast.ImportFrom) and node.module:
+            spec = importlib.util.find_spec(node.module)
+            if (spec is not None and spec.origin and
+                os.path.isfile(spec.origin)):
+                with open(spec.origin, 'rb') as f:
+                    sources.append(f.read())
+    return sources
+
+def template_key(cls, src, *args, **kwds):
+    """Return a hash of what cls(src, *args, **kwds) compiles to depend on
+
+    That is the source of the template, of any module it imports macros
+    from, and of COMPILER_MODULES.
+    """
+    key_src = repr([compiler_version(), cls.__name__, src,
+                    _canonical(args), _canonical(kwds),
+                    _imported_sources(src)])
+    return hashlib.sha256(key_src.encode('utf-8')).hexdigest()
+
+def compile_template(cls, src, *args, **kwds):
+    """Return cls(src, *args, **kwds), loaded from the cache if built before
+
+    cls is write_c.Compiler or write_c.VariantCompiler. A cached compiler
+    keeps its results (ast, function, code, library_code ...) but not its
+    passes. The cache is keyed by template_key. An entry is stored with
+    its key and used only if the key and class match; one that fails to
+    load is rebuilt. Entries are pickles, so the cache directory must be no
+    less trusted than the code.
+    """
+    key = template_key(cls, src, *args, **kwds)
+    directory = os.path.join(cache_dir(), 'templates')
+    path = os.path.join(directory, key + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            entry_key, compiler = pickle.load(f)
+        if entry_key == key and type(compiler) is cls:
+            return compiler
+    except Exception:
+        # A stale, foreign or damaged entry is a miss
+        pass
+    compiler = cls(src, *args, **kwds)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp('.tmp', key + '-', directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, compiler), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except OSError:
+        # An unwritable cache only costs a recompile next time
+        pass
+    return compiler
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _executor(threads):
+    """Return the shared pool running bands on threads - 1 workers"""
+    with _executors_lock:
+        try:
+            return _executors[threads]
+        except KeyError:
+            pool = ThreadPoolExecutor(threads - 1, 'pixel-band')
+            _executors[threads] = pool
+            return pool
+
+def bands(width, height, threads=THREADS, band_pixels=BAND_PIXELS):
+    """Return the (first row, row count) bands to split a blit into
+
+    There is a single band when the blit is too small to be worth running
+    on more than one thread.
+    """
+    n = min(threads, height, width * height // band_pixels)
+    if n <= 1:
+        return [(0, height)]
+    rows, extra = divmod(height, n)
+    result = []
+    y = 0
+    for i in range(n):
+        count = rows + (i < extra)
+        result.append((y, count))
+        y += count
+    return result
+
+def _pointer(view, writable):
+    """Return a ctypes object addressing the bytes of view"""
+    if view.readonly:
+        if writable:
+            raise ValueError("destination pixels are read-only")
+        return (ctypes.c_char * len(view)).from_buffer_copy(view)
+    return ctypes.c_char.from_buffer(view)
+
+class Pixels:
+    """The pixel memory of one kernel argument, held for a call
+
+    typ is the argument's C target type (rgba.RGBA, mapped.Mapped or
+    mapped.Element). format is the compile time format obj matches.
+    """
+
+    def __init__(self, typ, obj, writable):
+        self._pointer = None
+        if isinstance(typ, Element):
+            buf = ArrayBuffer(obj, writable)
+            self.format = -buf.itemsize if buf.signed else buf.itemsize
+            self.address = buf.address
+            self.stride, self.pitch = buf.strides
+            self.size = buf.shape
+        else:
+            buf = pixel_buffer(obj, isinstance(typ, Mapped))
+            self.format = buf.bpp if isinstance(typ, Mapped) else buf.order
+            self.stride = buf.bpp
+            self.pitch = buf.pitch
+            self.size = buf.get_size()
+            self.address = None
+            if len(buf.view):
+                self._pointer = _pointer(buf.view, writable)
+                self.address = ctypes.addressof(self._pointer)
+        self._buf = buf
+        self._owned = buf is not obj
+
+    def release(self):
+        self._pointer = None
+        if self._owned:
+            self._buf.release()
+
+class SpanIndex:
+    """The source alpha class of each block of pixels of a blit, saved by
+    Kernel.span_index
+
+    It stays valid while the source pixels are unchanged, and is passed to
+    calls as index to skip classing the source again. origin and size are
+    those of the source rectangle classed.
+    """
+
+    def __init__(self, formats, size, origin=(0, 0)):
+        self.formats = formats
+        self.size = size
+        self.origin = origin
+        width, height = size
+        self.blocks = -(-width // write_c.SPAN_BLOCK)
+        self.data = (ctypes.c_ubyte * max(self.blocks * height, 1))()
+        self.address = ctypes.addressof(self.data)
+
+class Kernel:
+    """A compiled blitter, transmuter or pixelcopy template
+
+    Called like run_numpy.Compiler: with a source and destination, or just
+    a destination, and optional dest and area keywords clipping the blit
+    (see buffers.call_region); it returns the destination rectangle. The
+    loops are run on the clipped rectangle in place. blit.Pixel arguments
+    take surfaces or buffers.pixel_buffer objects, pixels.Surface
+    arguments surfaces of any pixel size and pixels.PixelArray arguments
+    2D integer arrays, indexed (x, y) as by pygame.surfarray. A blit.Pixel
+    transmuter of an 8 bit surface is run on its palette (see
+    buffers.transmute_palette).
+
+    One library holds every variant (see write_c.VariantCompiler) of the
+    size formats of Surface and PixelArray arguments. Pixel layouts are
+    too many to expand, so a library is built, or loaded from the cache,
+    for each combination of layouts met. simd=False leaves out the
+    vectorized loops (see write_c.VectorLoopWriter), spans=False the loops
+    passing over transparent and opaque source pixels of a blitter (see
+    write_c.SpanLoopWriter), tables=False the byte lookup tables of the
+    scalar loops (see write_c.Tabler).
+
+    Blits of more than band_pixels pixels are split into row bands run on
+    up to threads threads; threads=1 runs every blit on the calling thread.
+    A blitter source that is blitted again unchanged can be classed once,
+    by span_index, and the SpanIndex passed to each call as index. Many
+    blits to one destination, such as sprites, are best run by blits.
+
+    With stats, by default $PIXEL_STATS, the loops are built with
+    -DPIXEL_STATS to count their calls, pixels, bytes and time (see
+    write_c.StatsWriter), read by get_stats. Without, they cost nothing.
+    """
+
+    def __init__(self, src, cflags=CFLAGS, cc=CC, simd=True, threads=None,
+                 band_pixels=BAND_PIXELS, spans=True, tables=True,
+                 stats=None):
+        self.src = src
+        self.cflags = list(cflags)
+        self.stats = STATS if stats is None else stats
+        if self.stats:
+            self.cflags.append('-DPIXEL_STATS')
+        self.cc = cc
+        self.simd = simd
+        self.spans = spans
+        self.tables = tables
+        self.threads = THREADS if threads is None else threads
+        if self.threads < 1:
+            raise ValueError("threads must be at least 1")
+        self.band_pixels = band_pixels
+        compiler = compile_template(write_c.Compiler, src)
+        self.name = compiler.name
+        self.arg_names = compiler.arg_names
+        self.arg_types = compiler.arg_types
+        self._libraries = {}
+        self._variant_names = {}
+        self._functions = {}
+
+    @classmethod
+    def from_module(cls, name, **kwds):
+        """Build the template defined in module name, such as alpha_blend"""
+        spec = importlib.util.find_spec(name)
+        if spec is None or spec.origin is None:
+            raise ImportError("No template module {}".format(name))
+        with open(spec.origin) as f:
+            return cls(f.read(), **kwds)
+
+    def get_library(self, formats):
+        """Return the loaded library holding the variant for formats"""
+        key = tuple(f if isinstance(t, RGBA) else None
+                    for t, f in zip(self.arg_types, formats))
+        try:
+            return self._libraries[key]
+        except KeyError:
+            pass
+        variant_formats = {a: [f] for a, f in zip(self.arg_names, key)
+                           if f is not None}
+        compiler = compile_template(write_c.VariantCompiler, self.src,
+                                    variant_formats, self.simd, self.spans,
+                                    tables=self.tables)
+        lib = ctypes.CDLL(build(compiler.library_code, self.cflags, self.cc))
+        self._libraries[key] = lib
+        self._variant_names[key] = [c.name for c in compiler.variants.values()]
+        return lib
+
+    def _loop_stats(self):
+        # (entry point, pixel_stats) of each loop of the libraries loaded
+        if not self.stats:
+            raise ValueError("{}: built without stats".format(self.name))
+        for key, lib in self._libraries.items():
+            for name in self._variant_names[key]:
+                for suffix in ('_loop', '_loop_indexed'):
+                    try:
+                        stats = _PixelStats.in_dll(lib, name + suffix +
+                                                   '_stats')
+                    except ValueError:
+                        continue
+                    yield name + suffix, stats
+
+    def get_stats(self):
+        """Return a LoopStats of the calls so far of each loop entry point,
+        such as ALPHA_BLENDx_bgra_bgra_loop, of the variants built
+
+        bytes counts the pixel bytes of every argument once. A call split
+        into bands counts once per band; a blits record once per blit.
+        """
+        return {entry: LoopStats(*[getattr(stats, field)
+                                   for field in LoopStats._fields])
+                for entry, stats in self._loop_stats()}
+
+    def reset_stats(self):
+        """Zero the counts of get_stats"""
+        for entry, stats in self._loop_stats():
+            ctypes.memset(ctypes.addressof(stats), 0, ctypes.sizeof(stats))
+
+    def get_function(self, formats, suffix='_loop'):
+        """Return the loop function for a tuple of argument formats
+
+        suffix '_loop_indexed' or '_spans' gets the span loop functions of
+        a blitter instead (see write_c.SpanLoopWriter), '_batch' its
+        write_c.BatchWriter entry point.
+        """
+        key = formats, suffix
+        try:
+            return self._functions[key]
+        except KeyError:
+            pass
+        lib = self.get_library(formats)
+        try:
+            func = getattr(lib, write_c.variant_name(self.name, formats) +
+                                suffix)
+        except AttributeError:
+            msg = "{}: unsupported formats {}".format(self.name, formats)
+            if suffix in ('_loop_indexed', '_spans'):
+                msg = "{}: no span loop for formats {}".format(self.name,
+                                                               formats)
+            elif suffix == '_batch':
+                msg = "{}: no batch loop for formats {}".format(self.name,
+                                                                formats)
+            raise ValueError(msg)
+        pixels = [ctypes.c_void_p, ctypes.c_ssize_t, ctypes.c_ssize_t]
+        size = [ctypes.c_int, ctypes.c_int]
+        if suffix == '_spans':
+            func.argtypes = pixels + size + [ctypes.c_void_p]
+        elif suffix == '_batch':
+            func.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        elif suffix == '_loop_indexed':
+            func.argtypes = (pixels * len(self.arg_names) + size +
+                             [ctypes.c_void_p])
+        else:
+            func.argtypes = pixels * len(self.arg_names) + size
+        func.restype = None
+        self._functions[key] = func
+        return func
+
+    def _pixels(self, objs):
+        # The Pixels of call arguments, checked
+        if len(objs) != len(self.arg_names):
+            msg = "{}() takes {} surface arguments ({} given)"
+            raise TypeError(msg.format(self.name, len(self.arg_names),
+                                       len(objs)))
+        pixels = []
+        try:
+            last = len(objs) - 1
+            for i, (typ, obj) in enumerate(zip(self.arg_types, objs)):
+                pixels.append(Pixels(typ, obj, i == last))
+        except Exception:
+            for p in pixels:
+                p.release()
+            raise
+        return pixels
+
+    def span_index(self, *objs, dest=None, area=None):
+        """Return the SpanIndex of the source of a call with objs, dest and
+        area
+
+        Only blitters written with a span loop have one.
+        """
+        pixels = self._pixels(objs)
+        try:
+            formats = tuple(p.format for p in pixels)
+            func = self.get_function(formats, '_spans')
+            posns, size = call_region([p.size for p in pixels], dest, area)
+            index = SpanIndex(formats, size, posns[0])
+            width, height = size
+            if width and height:
+                s = pixels[0]
+                x, y = posns[0]
+                func(s.address + y * s.pitch + x * s.stride, s.stride,
+                     s.pitch, width, height, index.address)
+            return index
+        finally:
+            for p in pixels:
+                p.release()
+
+    def blits(self, sequence, dst):
+        """Blit each (source, dest) or (source, dest, area) of sequence to
+        dst, in order, as pygame.Surface.blits does
+
+        dst is locked once, and each distinct source once. Consecutive
+        blits of sources of one format run in a single native call, on
+        the calling thread. Returns the destination rectangle of each
+        blit.
+        """
+        if len(self.arg_names) != 2:
+            raise TypeError("{}() is not a blitter".format(self.name))
+        src_type, dst_type = self.arg_types
+        record = write_c.BatchWriter.record_size(self.arg_names)
+        d = Pixels(dst_type, dst, True)
+        sources = {}
+        rects = []
+        try:
+            runs = []
+            fmt = None
+            for item in sequence:
+                obj, dest = item[0], item[1]
+                area = item[2] if len(item) > 2 else None
+                try:
+                    obj, s = sources[id(obj)]
+                except KeyError:
+                    s = Pixels(src_type, obj, False)
+                    sources[id(obj)] = obj, s
+                s_x, s_y, d_x, d_y, width, height = blit_region(
+                    s.size, d.size, dest, area)
+                rects.append((d_x, d_y, width, height))
+                if not (width and height):
+                    continue
+                if s.format != fmt:
+                    fmt = s.format
+                    values = array(_SSIZE_CODE)
+                    runs.append((fmt, values))
+                values.extend((
+                    s.address + s_y * s.pitch + s_x * s.stride, s.stride,
+                    s.pitch, d.address + d_y * d.pitch + d_x * d.stride,
+                    d.stride, d.pitch, width, height))
+            for fmt, values in runs:
+                func = self.get_function((fmt, d.format), '_batch')
+                func(values.buffer_info()[0], len(values) // record)
+        finally:
+            for obj, s in sources.values():
+                s.release()
+            d.release()
+        return rects
+
+    def __call__(self, *objs, dest=None, area=None, index=None):
+        if (len(objs) == 1 and isinstance(self.arg_types[0], RGBA) and
+                is_indexed(objs[0])):
+            return transmute_palette(self, objs[0], dest, area)
+        pixels = self._pixels(objs)
+        try:
+            posns, size = call_region([p.size for p in pixels], dest, area)
+            width, height = size
+            rect = posns[-1] + size
+            formats = tuple(p.format for p in pixels)
+            func = self.get_function(formats)
+            if index is not None:
+                if (index.formats != formats or index.size != size or
+                        index.origin != posns[0]):
+                    raise ValueError("span index is for another blit")
+                func = self.get_function(formats, '_loop_indexed')
+            if width == 0 or height == 0:
+                return rect
+            origins = [p.address + y * p.pitch + x * p.stride
+                       for p, (x, y) in zip(pixels, posns)]
+            split = bands(width, height, self.threads, self.band_pixels)
+            calls = []
+            for y, rows in split:
+                args = []
+                for p, origin in zip(pixels, origins):
+                    args.extend([origin + y * p.pitch, p.stride, p.pitch])
+                args.extend([width, rows])
+                if index is not None:
+                    args.append(index.address + y * index.blocks)
+                calls.append(args)
+            if len(calls) == 1:
+                func(*calls[0])
+                return rect
+            pool = _executor(self.threads)
+            futures = [pool.submit(func, *args) for args in calls[1:]]
+            try:
+                func(*calls[0])
+            finally:
+                for f in futures:
+                    f.result()
+            return rect
+        finally:
+            for p in pixels:
+                p.release()
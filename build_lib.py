@@ -0,0 +1,209 @@
+"""Build the C loop library of every template in a directory
+
+    python build_lib.py [directory] [-o build] [--name pixel_loops]
+
+finds the template modules of directory, by default this one: those
+naming their template function in a __templates__ list, like
+alpha_blend.py and pixelcopy.py. Every variant of each (see
+write_c.VariantCompiler) is written to build/pixel_loops.c, one C
+translation unit, and the prototypes of their entry points to
+build/pixel_loops.h.
+
+The variants are compiled in parallel by a pool of worker processes. The
+C of each template is kept in build/pixel_loops.parts with the
+build_c.template_key it was written for, so only templates whose source,
+the source of a module they import macros from, or the template compiler
+changed since the last build are compiled again. The library files are
+only rewritten when they change, leaving an unchanged library as it was
+for make and setuptools.
+"""
+
+import argparse
+import ast
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from transform import CompileError, is_templates_list, template_function
+import build_c
+import write_c
+
+NAME = 'pixel_loops'
+
+def is_template(src):
+    """True if module source src is a template module
+
+    A template module assigns __templates__ a list of the name of its
+    template function, which it must define; CompileError is raised if
+    not. The list is left out of the compiled template (see
+    transform.Fuser).
+    """
+    if '__templates__' not in src:
+        return False
+    module = ast.parse(src)
+    listed = [n for n in module.body if is_templates_list(n)]
+    if not listed:
+        return False
+    try:
+        names = ast.literal_eval(listed[-1].value)
+    except ValueError:
+        raise CompileError("__templates__ is not a literal list")
+    name = template_function(module).name
+    if names != [name]:
+        msg = "__templates__ lists {!r}, not template {}"
+        raise CompileError(msg.format(names, name))
+    return True
+
+def find_templates(directory):
+    """Return the source of each template module of directory, by module
+    name, in name order"""
+    templates = OrderedDict()
+    for filename in sorted(os.listdir(directory)):
+        module, ext = os.path.splitext(filename)
+        if ext != '.py' or not module.isidentifier():
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            src = f.read()
+        try:
+            if is_template(src):
+                templates[module] = src
+        except CompileError as e:
+            raise CompileError("{}: {}".format(module, e))
+    return templates
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write(path, text):
+    # Replace the file at path by text, unless it holds text already
+    if _read(path) == text:
+        return False
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+def build_library(directory, output, name=NAME, jobs=None, log=None,
+                  **options):
+    """Write NAME.c and NAME.h in output for the templates of directory
+
+    options (simd, spans, tables) are passed to write_c.VariantCompiler.
+    Up to jobs processes, by default the CPU count, compile the variants.
+    Returns the write_c.VariantCompiler of each template compiled, by
+    module name; those up to date are not.
+    """
+    directory = os.path.abspath(directory)
+    # For the template imports, here and in the workers
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    templates = find_templates(directory)
+    parts = os.path.join(output, name + '.parts')
+    os.makedirs(parts, exist_ok=True)
+    part = lambda module, ext: os.path.join(parts, module + ext)
+    for filename in os.listdir(parts):
+        if os.path.splitext(filename)[0] not in templates:
+            os.remove(os.path.join(parts, filename))
+
+    stale = OrderedDict()
+    for module, src in templates.items():
+        key = build_c.template_key(write_c.VariantCompiler, src, **options)
+        if (_read(part(module, '.key')) != key or
+            not os.path.exists(part(module, '.c')) or
+            not os.path.exists(part(module, '.h'))):
+            stale[module] = key
+        elif log:
+            log("{}: up to date".format(module))
+
+    compilers = OrderedDict()
+    if stale:
+        jobs = jobs or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+        try:
+            for module, key in stale.items():
+                start = time.perf_counter()
+                try:
+                    compiler = write_c.VariantCompiler(
+                        templates[module], map=pool.map if pool else map,
+                        **options)
+                except CompileError as e:
+                    raise CompileError("{}: {}".format(module, e))
+                ostream = StringIO()
+                compiler.write_declarations(ostream)
+                _write(part(module, '.c'), compiler.code)
+                _write(part(module, '.h'), ostream.getvalue())
+                # Last, so a build stopped early compiles it again
+                _write(part(module, '.key'), key)
+                compilers[module] = compiler
+                if log:
+                    log("{}: {} variants in {:.2f} s".format(
+                        module, len(compiler.variants),
+                        time.perf_counter() - start))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    code = [write_c.PRELUDE]
+    guard = '{}_H'.format(name.upper())
+    header = ['#ifndef {0}\n#define {0}\n\n'.format(guard),
+              '#include <stddef.h>\n']
+    for module in templates:
+        code.append('\n/* {} */\n'.format(module))
+        code.append(_read(part(module, '.c')))
+        header.append('\n/* {} */\n'.format(module))
+        header.append(_read(part(module, '.h')))
+    header.append('\n#endif\n')
+    for ext, text in [('.c', code), ('.h', header)]:
+        path = os.path.join(output, name + ext)
+        if _write(path, ''.join(text)) and log:
+            log("wrote {}".format(path))
+    return compilers
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', nargs='?',
+                        default=os.path.dirname(os.path.abspath(__file__)),
+                        help="template module directory")
+    parser.add_argument('-o', '--output', default='build',
+                        help="output directory (default build)")
+    parser.add_argument('--name', default=NAME,
+                        help="library file name (default {})".format(NAME))
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="worker processes (default the CPU count)")
+    parser.add_argument('--no-simd', dest='simd', action='store_false',
+                        help="leave out the vectorized loops")
+    parser.add_argument('--no-spans', dest='spans', action='store_false',
+                        help="leave out the span loops of blitters")
+    parser.add_argument('--no-tables', dest='tables', action='store_false',
+                        help="leave out the byte lookup tables")
+    parser.add_argument('--timings', action='store_true',
+                        help="show the time of each compiler pass")
+    args = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    try:
+        compilers = build_library(args.directory, args.output, args.name,
+                                  args.jobs, log, simd=args.simd,
+                                  spans=args.spans, tables=args.tables)
+    except CompileError as e:
+        log("error: {}".format(e))
+        return 1
+    if args.timings:
+        for module, compiler in compilers.items():
+            passes = ' '.join('{}={:.1f}'.format(name, t * 1e3)
+                              for name, t in compiler.timings.items())
+            log("{} ms: {}".format(module, passes))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Mapped pixel target types: the C side of pixels.Surface and PixelArray
+
+A Surface pixel is an unsigned integer of 1, 2, 3 or 4 bytes, a PixelArray
+element an integer of 1, 2, 4 or 8 bytes, signed for a negative format.
+Each is a separate compile time format, so loads and stores are written as
+calls to fixed size helpers (load1 ... store8, sload1 ... sload8, see
+write_c.PRELUDE) with no run time size test.
+"""
+
+from transform import CompileError
+import ast
+
+class Mapped:
+    """A mapped surface pixel of bpp bytes
+    """
+
+    FORMATS = (1, 2, 3, 4)
+
+    def __init__(self, bpp=4):
+        if bpp not in self.FORMATS:
+            raise CompileError("Unsupported pixel size {}".format(bpp))
+        self.bpp = bpp
+        self.stride = bpp
+
+    def visit_Attribute(self, node):
+        self._check_attr(node.attr)
+        load = ast.Name('load{}'.format(self.bpp), ast.Load())
+        return ast.Call(load, [node.value], [])
+
+    def store(self, target, value, node):
+        self._check_attr(target.attr)
+        store = ast.Name('store{}'.format(self.bpp), ast.Load())
+        call = ast.Call(store, [target.value, value], [])
+        return ast.copy_location(ast.Expr(call), node)
+
+    @staticmethod
+    def _check_attr(attr):
+        if attr != 'pixel':
+            raise CompileError("Unknown attribute {}".format(attr))
+
+class Element:
+    """An integer array element of itemsize bytes
+
+    fmt is the item size, negated for a signed integer, which is sign
+    extended as it is loaded. Arrays are strided, so the distance between
+    elements is a run time argument of the loop.
+    """
+
+    FORMATS = (1, 2, 4, 8, -1, -2, -4, -8)
+
+    def __init__(self, fmt=4):
+        if fmt not in self.FORMATS:
+            raise CompileError("Unsupported item size {}".format(fmt))
+        self.itemsize = abs(fmt)
+        self.signed = fmt < 0
+        self.stride = None
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            raise CompileError("Array elements are read-only")
+        load = 'sload{}' if self.signed else 'load{}'
+        load = ast.Name(load.format(self.itemsize), ast.Load())
+        return ast.Call(load, [node], [])
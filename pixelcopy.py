@@ -1,5 +1,7 @@
 from pixels import Surface, PixelArray, blitter
 
+__templates__ = ['array2_to_surface']
+
 @blitter(PixelArray, Surface)
 def array2_to_surface(src, dst) -> None:
     dst.pixel = src
@@ -3,85 +3,171 @@
 Special case: pixelcopy.
 """
 
+import sys
+from buffers import blit_region, pixel_buffer
+
 # Template Types
+#
+# An argument is accessed through the view of its buffer, held for the
+# whole blit: no pixel is copied, and no per pixel call made to the
+# surface or array.
 
 class Surface:
+    class View:
+        """The pixels of a surface, locked until released
+
+        words is a (y, x) memoryview of the pixel integers, or None for a
+        3 byte pixel, read and written through the bytes of buf.view.
+        """
+
+        codes = {1: 'B', 2: 'H', 4: 'I'}
+
+        def __init__(self, surf):
+            self.buf = buf = pixel_buffer(surf, mapped=True)
+            self.width, self.height = buf.get_size()
+            self.words = None
+            code = self.codes.get(buf.bpp)
+            if (code is not None and buf.pitch % buf.bpp == 0 and
+                len(buf.view) == buf.pitch * buf.height):
+                self.words = buf.view.cast(code, (buf.height,
+                                                  buf.pitch // buf.bpp))
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.release()
+
+        def release(self):
+            if self.words is not None:
+                self.words.release()
+            self.buf.release()
+
     class Column:
-        def __init__(self, surf, r):
-            self.surf = surf
+        def __init__(self, view, r):
+            self.view = view
             self.r = r
 
     class Pixel:
-        def __init__(self, surf, r, c):
-            self.surf = surf
+        def __init__(self, view, r, c):
+            self.view = view
             self.posn = r, c
 
         @property
         def pixel(self):
-            return self.surf.get_at(self.posn)
+            r, c = self.posn
+            words = self.view.words
+            if words is not None:
+                return words[c, r]
+            buf = self.view.buf
+            i = c * buf.pitch + r * buf.bpp
+            return int.from_bytes(buf.view[i:i + buf.bpp], sys.byteorder)
 
         @pixel.setter
         def pixel(self, v):
-            self.surf.set_at(self.posn, int(v))
-    
+            r, c = self.posn
+            buf = self.view.buf
+            v = int(v) & ((1 << 8 * buf.bpp) - 1)
+            words = self.view.words
+            if words is not None:
+                words[c, r] = v
+                return
+            i = c * buf.pitch + r * buf.bpp
+            buf.view[i:i + buf.bpp] = v.to_bytes(buf.bpp, sys.byteorder)
+
+    @classmethod
+    def view(cls, surf):
+        return cls.View(surf)
+
+    # Rows and columns follow pygame.surfarray: (x, y) indexing
+    @staticmethod
+    def get_size(surf):
+        return surf.get_size()
+
     @classmethod
-    def get_row_iter(cls, surf):
-        for r in range(surf.get_height()):
-            yield cls.Column(surf, r)
+    def get_row_iter(cls, view, start=0, count=None):
+        if count is None:
+            count = view.width - start
+        for r in range(start, start + count):
+            yield cls.Column(view, r)
 
     @classmethod
-    def get_pix_iter(cls, row):
-        for c in range(row.surf.get_width()):
-            yield cls.Pixel(row.surf, row.r, c)
+    def get_pix_iter(cls, row, start=0, count=None):
+        if count is None:
+            count = row.view.height - start
+        for c in range(start, start + count):
+            yield cls.Pixel(row.view, row.r, c)
 
 class PixelArray:
     class Column:
-        def __init__(self,array, r):
-            self.array = array
+        def __init__(self, view, r):
+            self.view = view
             self.r = r
 
     class Element:
-        def __init__(self, array, r, c):
-            assert(array.ndim == 2)
-            self.array = array
+        def __init__(self, view, r, c):
+            self.view = view
             self.posn = r, c
 
         def __int__(self):
-            r, c = self.posn
-            return int(self.array[r, c])
+            return self.view[self.posn]
 
         @property
         def value(self):
-            r, c = self.posn
-            return self.array[r, c]
+            return self.view[self.posn]
 
         @value.setter
         def value(self, value):
-            r, c = self.posn
-            self.array[r, c] = value
+            self.view[self.posn] = value
+
+    @staticmethod
+    def view(arr):
+        """Return a 2D memoryview of an integer array, strided as it is"""
+        view = memoryview(arr)
+        if view.ndim != 2:
+            view.release()
+            raise ValueError("expected a 2D array")
+        fmt = view.format.lstrip('@')
+        if len(fmt) != 1 or fmt not in 'bBhHiIlLqQ':
+            view.release()
+            raise ValueError("expected a native integer array")
+        return view
+
+    @staticmethod
+    def get_size(arr):
+        return arr.shape[0], arr.shape[1]
 
     @classmethod
-    def get_row_iter(cls, arr):
-        for r in range(arr.shape[0]):
-            yield cls.Column(arr, r)
+    def get_row_iter(cls, view, start=0, count=None):
+        if count is None:
+            count = view.shape[0] - start
+        for r in range(start, start + count):
+            yield cls.Column(view, r)
 
     @classmethod
-    def get_pix_iter(cls, row):
-        for c in range(row.array.shape[1]):
-            yield cls.Element(row.array, row.r, c)
+    def get_pix_iter(cls, row, start=0, count=None):
+        if count is None:
+            count = row.view.shape[1] - start
+        for c in range(start, start + count):
+            yield cls.Element(row.view, row.r, c)
 
 # Decorators
 
+# dest and area are as for blit.blitter, clipped to both arguments
 def blitter(src_type, dst_type):
     def wrap(fn):
-        def wrapper(s : src_type, d : dst_type):
-            next_col_s = scc_type.get_col_iter(s)
-            next_col_d = dst_type.get_col_iter(d)
-            for sc, dc in zip(next_col_s, next_col_d):
-                next_pix_s = scc_type.get_pix_iter(sc)
-                next_pix_d = dst_type.get_pix_iter(dc)
-                for sp, dp in zip(next_pix_s, next_pix_d):
-                    fn(sp, dp)
+        def wrapper(s : src_type, d : dst_type, dest=None, area=None):
+            s_x, s_y, d_x, d_y, width, height = blit_region(
+                src_type.get_size(s), dst_type.get_size(d), dest, area)
+            with src_type.view(s) as sv, dst_type.view(d) as dv:
+                next_col_s = src_type.get_row_iter(sv, s_x, width)
+                next_col_d = dst_type.get_row_iter(dv, d_x, width)
+                for sc, dc in zip(next_col_s, next_col_d):
+                    next_pix_s = src_type.get_pix_iter(sc, s_y, height)
+                    next_pix_d = dst_type.get_pix_iter(dc, d_y, height)
+                    for sp, dp in zip(next_pix_s, next_pix_d):
+                        fn(sp, dp)
+            return d_x, d_y, width, height
 
         return wrapper
 
@@ -1,29 +1,59 @@
 """For Python 3.5
 """
-from transform import CompileError
+from transform import CompileError, TInt
 import ast
 
-class CUint8:
-    pass
+class CUint8(TInt):
+    """A pixel plane byte"""
+
+    def __init__(self):
+        TInt.__init__(self, 0, 255)
 
 c_uint8 = CUint8()
 
 class RGBA:
     """[R, G, B, A]
+
+    order gives the byte layout of a pixel, as for buffers.PixelBuffer.
+    An alpha plane missing from order loads as 255 and ignores stores.
+    Any order compiles; FORMATS are those of the 24 and 32 bit SDL pixel
+    formats, written out by write_c.VariantCompiler by default.
     """
 
-    def __init__(self, base_type):
+    FORMATS = ('bgra', 'rgba', 'argb', 'abgr', 'bgrx', 'rgbx', 'xrgb', 'xbgr',
+               'bgr', 'rgb')
+
+    def __init__(self, base_type, order='rgba'):
         self.base_type = base_type
-        
+        self.order = order
+        self.stride = len(order)
+
+    def has_plane(self, attr):
+        self._attr_as_index(attr)
+        return attr in self.order
+
     def visit_Attribute(self, node):
-        i = self._attr_as_index(node.attr)
         ctx = node.ctx
+        if not self.has_plane(node.attr):
+            if isinstance(ctx, ast.Store) or node.attr != 'a':
+                raise CompileError("No {} plane".format(node.attr))
+            new_node = ast.Num(255)
+            new_node.ttype = c_uint8
+            return new_node
+        i = self.order.index(node.attr)
         new_node = ast.Subscript(node.value, ast.Index(ast.Num(i)), ctx)
         if isinstance(ctx, ast.Store):
             new_node.ttype = node.ttype
         new_node.ttype = c_uint8
         return new_node
 
+    def store(self, target, value, node):
+        if not self.has_plane(target.attr):
+            return None
+        node.targets = [self.visit_Attribute(target)]
+        node.value = value
+        return node
+
     @staticmethod
     def _attr_as_index(attr):
         if attr == 'r':
@@ -45,11 +75,35 @@ class Coder(ast.NodeTransformer):
             typ = self.symtab[node.arg]
             typ_id = type(typ).__name__
             type_name = ast.Name(typ_id, ast.Load())
-            node.annotation = ast.copy_location(type_name, node.annotation)
-        except AttributeError:
+            if node.annotation is None:
+                node.annotation = type_name
+            else:
+                node.annotation = ast.copy_location(type_name,
+                                                    node.annotation)
+        except (AttributeError, KeyError):
             pass
         return node
 
+    def visit_Assign(self, node):
+        # Let the target type write a store, or drop it (None)
+        targets = node.targets
+        if len(targets) == 1:
+            target = targets[0]
+            if (isinstance(target, ast.Attribute) and
+                isinstance(target.value, ast.Name)):
+                store = getattr(self.symtab.get(target.value.id), 'store',
+                                None)
+                if store is not None:
+                    return store(target, self.visit(node.value), node)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        try:
+            new_node = self.symtab[node.id].visit_Name(node)
+        except (AttributeError, KeyError):
+            return node
+        return ast.copy_location(new_node, node)
+
     def visit_Attribute(self, node):
         if isinstance(node.value, ast.Name):
             try:
@@ -0,0 +1,196 @@
+"""Run templates as whole surface NumPy array operations
+
+The template source goes through the same passes as write_c.Compiler,
+transform.lower. Instead of writing C, the degrouped per-channel
+statements are then evaluated once per call, with each pixel plane (r, g,
+b, a) of a surface as a 2D integer array. Results are bit-exact with the
+per-pixel blit.blitter and blit.transmuter wrappers.
+"""
+
+import ast
+import numpy as np
+from transform import (CompileError, imported_macros, lower,
+                       template_function)
+from buffers import SurfaceFunction
+
+# Degrouped call names to array functions
+functions = {
+    'min': np.minimum,
+    }
+
+class Planes(dict):
+    """The channel arrays of one pixel argument
+
+    Planes are loaded, as a wide integer type, on first access. Template
+    arithmetic then behaves as it does on Python ints.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.loaded = {}
+
+    def __missing__(self, plane):
+        buf = self.buf
+        try:
+            i = buf.order.index(plane)
+        except ValueError:
+            if plane != 'a':
+                raise CompileError("Unknown attribute {}".format(plane))
+            value = 255
+        else:
+            view = np.ndarray((buf.height, buf.width), np.uint8, buf.view,
+                              i, (buf.pitch, buf.bpp))
+            value = view.astype(np.intp)
+            self.loaded[plane] = value
+        self[plane] = value
+        return value
+
+    def copy(self):
+        planes = Planes(self.buf)
+        planes.loaded = self.loaded
+        planes.update(self)
+        return planes
+
+    def store(self):
+        """Write changed channels back to the pixel buffer"""
+        buf = self.buf
+        for plane, value in self.items():
+            if plane not in buf.order or self.loaded.get(plane) is value:
+                continue
+            i = buf.order.index(plane)
+            view = np.ndarray((buf.height, buf.width), np.uint8, buf.view,
+                              i, (buf.pitch, buf.bpp))
+            view[...] = value
+
+class Executor(ast.NodeVisitor):
+    """Evaluate a degrouped function body on pixel planes
+    """
+
+    def __init__(self, env, functions=functions):
+        self.env = env
+        self.functions = functions
+
+    def visit_FunctionDef(self, node):
+        for stmt in node.body:
+            self.visit(stmt)
+
+    def visit_Assign(self, node):
+        value = self.visit(node.value)
+        for t in node.targets:
+            if isinstance(t, ast.Name):
+                self.env[t.id] = value
+            elif isinstance(t, ast.Attribute):
+                self.env[t.value.id][t.attr] = value
+            else:
+                msg = "{} assignment unsupported".format(type(t).__name__)
+                raise CompileError(msg)
+
+    def visit_If(self, node):
+        mask = np.asarray(self.visit(node.test)) != 0
+        env = self.env
+        body_env = self._run_branch(node.body, env)
+        else_env = self._run_branch(node.orelse, env)
+        self.env = self._merge(mask, body_env, else_env)
+
+    def _run_branch(self, stmts, env):
+        self.env = {k: v.copy() if isinstance(v, Planes) else v
+                    for k, v in env.items()}
+        for stmt in stmts:
+            self.visit(stmt)
+        return self.env
+
+    @staticmethod
+    def _merge(mask, body_env, else_env):
+        env = {}
+        for k in body_env.keys() | else_env.keys():
+            try:
+                b = body_env[k]
+            except KeyError:
+                env[k] = else_env[k]
+                continue
+            try:
+                e = else_env[k]
+            except KeyError:
+                env[k] = b
+                continue
+            if isinstance(b, Planes):
+                planes = b.copy()
+                for plane in b.keys() | e.keys():
+                    planes[plane] = np.where(mask, b[plane], e[plane])
+                env[k] = planes
+            elif b is not e:
+                env[k] = np.where(mask, b, e)
+            else:
+                env[k] = b
+        return env
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op
+        if isinstance(op, ast.Add):
+            return left + right
+        if isinstance(op, ast.Sub):
+            return left - right
+        if isinstance(op, ast.Mult):
+            return left * right
+        if isinstance(op, ast.FloorDiv):
+            return left // right
+        if isinstance(op, ast.LShift):
+            return left << right
+        if isinstance(op, ast.RShift):
+            return left >> right
+        raise CompileError("Unsupported op {}".format(type(op).__name__))
+
+    def visit_Call(self, node):
+        func_id = node.func.id
+        try:
+            func = self.functions[func_id]
+        except KeyError:
+            raise CompileError("Unknown function {}".format(func_id))
+        return func(*[self.visit(a) for a in node.args])
+
+    def visit_Attribute(self, node):
+        return self.env[node.value.id][node.attr]
+
+    def visit_Name(self, node):
+        try:
+            return self.env[node.id]
+        except KeyError:
+            raise CompileError("Undefined symbol {}".format(node.id))
+
+    def visit_Constant(self, node):
+        return node.value
+
+    # Python 3.7 and earlier
+    def visit_Num(self, node):
+        return node.n
+
+class Compiler(SurfaceFunction):
+    """Compile a blitter or transmuter template into a surface function
+
+    The compiled object is called like the blit.blitter or blit.transmuter
+    wrapper: with a source and destination, or just a destination, surface.
+    Buffer objects accepted by buffers.pixel_buffer work too. macros maps
+    names to the @macro functions the template can call besides its own
+    (see transform.Typer), by default blit.py's. The dest and area
+    keywords, and the returned destination rectangle, are as for the
+    wrappers (see buffers.call_region). A transmuter of an 8 bit surface
+    changes its palette (see buffers.transmute_palette).
+    """
+
+    def __init__(self, src, functions=functions, macros=None):
+        if macros is None:
+            # Templates are exec'd in blit.py, so see its macros
+            macros = imported_macros('blit')
+        self.src = src
+        self.functions = functions
+        self.ast, self.typer = lower(src, macros)
+        self.function = template_function(self.ast)
+        self.arg_names = [a.arg for a in self.function.args.args]
+
+    def _run(self, bufs, size):
+        env = {name: Planes(b) for name, b in zip(self.arg_names, bufs)}
+        executor = Executor(env, self.functions)
+        executor.visit(self.function)
+        executor.env[self.arg_names[-1]].store()
@@ -0,0 +1,266 @@
+"""Check that every execution backend computes what the reference does
+
+Each blit.py template (blit.ALPHA_BLENDx ...) is run by each backend on
+24 and 32 bit surfaces, and compared with its tuple operation
+(blit.ALPHA_BLEND ...) run pixel by pixel. Other templates are compared
+with the Python template, run by blit.blitter. Run with pytest:
+
+    python -m pytest -q test_backends.py
+"""
+
+import ast
+import functools
+import os
+import random
+import subprocess
+import sys
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+import pytest
+import blit
+import build_c
+import write_py
+
+SIZE = (37, 13)
+
+OPERATIONS = sorted(name[0:-len('x_SRC')] for name in dir(blit)
+                    if name.endswith('x_SRC'))
+
+# Surface kinds: (flags, depth)
+FORMATS = [(pygame.SRCALPHA, 32), (0, 32), (0, 24)]
+
+def _numpy(src):
+    run_numpy = pytest.importorskip('run_numpy')
+    return run_numpy.Compiler(src)
+
+BACKENDS = {
+    'template': lambda src: None,
+    'numpy': _numpy,
+    'python': write_py.Compiler,
+    'c': build_c.Kernel,
+    'c-scalar': lambda src: build_c.Kernel(src, simd=False, threads=1),
+    'c-bands': lambda src: build_c.Kernel(src, threads=3, band_pixels=64),
+}
+
+@functools.lru_cache(maxsize=None)
+def _backend(backend, src):
+    return BACKENDS[backend](src)
+
+def _template_function(src):
+    return [n for n in ast.parse(src).body
+            if isinstance(n, ast.FunctionDef)][0]
+
+def _surface(flags, depth, seed):
+    surf = pygame.Surface(SIZE, flags, depth)
+    data = surf.get_buffer()
+    n = data.length
+    data.write(random.Random(seed).getrandbits(8 * n).to_bytes(n, 'little'))
+    del data
+    return surf
+
+def _contents(surf):
+    return pygame.image.tostring(surf, 'RGBA')
+
+def _expected(op, surfaces):
+    """Run the tuple operation op on copies of surfaces"""
+    surfaces = [s.copy() for s in surfaces]
+    d = surfaces[-1]
+    func = getattr(blit, op)
+    width, height = d.get_size()
+    for x in range(width):
+        for y in range(height):
+            d.set_at((x, y), func(*[tuple(s.get_at((x, y)))
+                                    for s in surfaces]))
+    return _contents(d)
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('flags, depth', FORMATS)
+@pytest.mark.parametrize('op', OPERATIONS)
+def test_operation(op, flags, depth, backend):
+    src = getattr(blit, op + 'x_SRC')
+    nargs = len(_template_function(src).args.args)
+    surfaces = [_surface(pygame.SRCALPHA, 32, i) for i in range(nargs - 1)]
+    surfaces.append(_surface(flags, depth, nargs))
+    expected = _expected(op, surfaces)
+    func = _backend(backend, src) or getattr(blit, op + 'x')
+    func(*surfaces)
+    assert _contents(surfaces[-1]) == expected
+
+TRANSMUTERS = [op for op in OPERATIONS
+               if len(_template_function(getattr(blit, op + 'x_SRC'))
+                      .args.args) == 1]
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('op', TRANSMUTERS)
+def test_palette(op, backend):
+    # A transmuter of an 8 bit surface changes its palette, not its pixels
+    surf = _surface(0, 8, 1)
+    rand = random.Random(2)
+    surf.set_palette([tuple(rand.randrange(256) for i in range(3))
+                      for c in range(256)])
+    func = getattr(blit, op)
+    expected = [func(tuple(c)[0:3] + (255,))[0:3]
+                for c in surf.get_palette()]
+    indices = bytes(surf.get_view('2'))
+    func = _backend(backend, getattr(blit, op + 'x_SRC'))
+    func = func or getattr(blit, op + 'x')
+    assert func(surf) == (0, 0) + SIZE
+    assert [tuple(c)[0:3] for c in surf.get_palette()] == expected
+    assert bytes(surf.get_view('2')) == indices
+    with pytest.raises(ValueError):
+        func(surf, area=(1, 0, 5, 5))
+
+# (dest, area) of blits of a SIZE source onto a CLIP_SIZE destination
+CLIP_SIZE = (29, 17)
+CLIPS = [(None, None), ((5, 3), None), ((-4, 6), (2, -3, 20, 9)),
+         ((10, 2), pygame.Rect(30, 1, 12, 30)), ((40, 0), None),
+         ((3, 4), (0, 0, 0, 5))]
+
+@pytest.mark.parametrize('backend', [b for b in BACKENDS if b != 'template'])
+@pytest.mark.parametrize('dest, area', CLIPS)
+def test_clip(dest, area, backend):
+    src = blit.ALPHA_BLENDx_SRC
+    s = _surface(pygame.SRCALPHA, 32, 1)
+    d = pygame.Surface(CLIP_SIZE, pygame.SRCALPHA, 32)
+    d.blit(_surface(pygame.SRCALPHA, 32, 2), (0, 0))
+    expected = d.copy()
+    rect = blit.ALPHA_BLENDx(s, expected, dest=dest, area=area)
+    assert _backend(backend, src)(s, d, dest=dest, area=area) == rect
+    assert _contents(d) == _contents(expected)
+    if 0 in rect[2:]:
+        assert rect[2:] == (0, 0)
+
+# Templates compared with the Python template
+TEMPLATES = [
+    "def floor_div(s: Pixel, d: Pixel) -> None:\n"
+    "    d.rgb = (s.rgb - d.rgb) // 3 + 128\n",
+    "def floor_div_sum(s: Pixel, d: Pixel) -> None:\n"
+    "    d.rgb = ((s.rgb - d.rgb) // 3 - (s.rgb - 200) // 5 +\n"
+    "             (d.rgb - 250) // 7) // 2 + 100\n",
+    "def swizzle(s: Pixel, d: Pixel) -> None:\n"
+    "    d.rgba = s.rrra // 2 + d.abgr // 2\n",
+    "def scalar_min(s: Pixel, d: Pixel) -> None:\n"
+    "    d.a = MIN(s.a, d.a)\n",
+    "def constant_min(s: Pixel, d: Pixel) -> None:\n"
+    "    d.b = MIN(MIN(0 * 2, 3), (s.g * s.a) >> 8)\n",
+    "def cycles(s: Pixel, d: Pixel) -> None:\n"
+    "    d.rgba = d.grab\n"
+    "    d.rgb = d.brg // 2 + s.rgb // 4\n",
+]
+
+def _python_template(src):
+    namespace = dict(vars(blit))
+    exec(src, namespace)
+    return blit.blitter(namespace[_template_function(src).name])
+
+@pytest.mark.parametrize('backend', [b for b in BACKENDS if b != 'template'])
+@pytest.mark.parametrize('flags, depth', FORMATS)
+@pytest.mark.parametrize('src', TEMPLATES)
+def test_template(src, flags, depth, backend):
+    args = [_surface(pygame.SRCALPHA, 32, 1), _surface(flags, depth, 2)]
+    copies = [s.copy() for s in args]
+    _python_template(src)(*copies)
+    _backend(backend, src)(*args)
+    assert _contents(args[-1]) == _contents(copies[-1])
+
+# Templates fused by transform.fuse, compared with the wrappers in turn
+PIPELINES = [('ROTATE', 'BLEND_ADD'), ('BLEND_ADD', 'ROTATE', 'ALPHA_BLEND')]
+
+@pytest.mark.parametrize('backend', [b for b in BACKENDS if b != 'template'])
+@pytest.mark.parametrize('flags, depth', FORMATS)
+@pytest.mark.parametrize('ops', PIPELINES)
+def test_fuse(ops, flags, depth, backend):
+    import transform
+
+    sources = [getattr(blit, op + 'x_SRC') for op in ops]
+    d = _surface(flags, depth, 0)
+    expected = d.copy()
+    args = []
+    for i, src in enumerate(sources):
+        nargs = len(_template_function(src).args.args)
+        surfaces = [_surface(pygame.SRCALPHA, 32, 10 * i + j)
+                    for j in range(nargs - 1)]
+        getattr(blit, ops[i] + 'x')(*surfaces + [expected])
+        args.extend(surfaces)
+    _backend(backend, transform.fuse(sources))(*args + [d])
+    assert _contents(d) == _contents(expected)
+
+DTYPES = ['int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64',
+          'uint64']
+
+@pytest.mark.parametrize('depth', [8, 16, 24, 32])
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_pixelcopy(dtype, depth):
+    numpy = pytest.importorskip('numpy')
+    import pixelcopy
+
+    info = numpy.iinfo(dtype)
+    random = numpy.random.RandomState(1)
+    array = random.randint(info.min, info.max, SIZE, dtype=dtype)
+    array[0, 0], array[1, 0] = info.min, info.max
+    surf = pygame.Surface(SIZE, 0, depth)
+    expected = pygame.Surface(SIZE, 0, depth)
+    pixelcopy.array2_to_surface(array, expected)
+    build_c.Kernel.from_module('pixelcopy')(array, surf)
+    assert bytes(surf.get_view('2')) == bytes(expected.get_view('2'))
+
+@pytest.mark.parametrize('depth', [8, 16, 24, 32])
+def test_pixelcopy_views(depth):
+    numpy = pytest.importorskip('numpy')
+    import pixelcopy
+
+    random = numpy.random.RandomState(2)
+    width, height = SIZE
+    base = random.randint(0, 1 << 31, (2 * height + 1, 3 * width),
+                          dtype='uint32')
+    # Transposed and strided arrays onto a subsurface are used in place
+    array = base.T[1::3, 0:2 * height:2]
+    assert not array.flags.contiguous
+    parent = pygame.Surface((width + 5, height + 4), 0, depth)
+    surf = parent.subsurface((3, 2) + SIZE)
+    expected = pygame.Surface(SIZE, 0, depth)
+    pixelcopy.array2_to_surface(array, expected)
+    build_c.Kernel.from_module('pixelcopy')(array, surf)
+    assert _contents(surf) == _contents(expected)
+
+@pytest.mark.parametrize('tile', [None, 4])
+@pytest.mark.parametrize('size', [SIZE, (3, 70)])
+def test_pixelcopy_tiled(size, tile):
+    numpy = pytest.importorskip('numpy')
+    import pixelcopy
+
+    random = numpy.random.RandomState(3)
+    # Stored column by column, as a C order (x, y) array is, so the loop
+    # walks it in PIXEL_TILE tiles, partial ones at the right and bottom
+    array = random.randint(0, 1 << 24, size, dtype='uint32')
+    assert array.strides[0] > array.strides[1]
+    surf = pygame.Surface(size, 0, 32)
+    expected = pygame.Surface(size, 0, 32)
+    pixelcopy.array2_to_surface(array, expected)
+    cflags = build_c.CFLAGS
+    if tile is not None:
+        cflags = cflags + ['-DPIXEL_TILE={}'.format(tile)]
+    build_c.Kernel.from_module('pixelcopy', cflags=cflags)(array, surf)
+    assert _contents(surf) == _contents(expected)
+
+_HASH_SCRIPT = """\
+import hashlib, blit, write_c
+h = hashlib.sha256()
+for name in sorted(dir(blit)):
+    if name.endswith('x_SRC'):
+        h.update(write_c.Compiler(getattr(blit, name)).library_code.encode())
+print(h.hexdigest())
+"""
+
+def test_code_is_deterministic():
+    # The build caches are keyed by the code, which must not depend on
+    # the order of sets of strings
+    here = os.path.dirname(os.path.abspath(__file__))
+    hashes = set()
+    for seed in ('1', '2', '3'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        hashes.add(subprocess.check_output([sys.executable, '-c',
+                                            _HASH_SCRIPT], cwd=here,
+                                           env=env))
+    assert len(hashes) == 1
@@ -0,0 +1,39 @@
+"""Check the blit.py template types the reference blitters run on
+
+Run with pytest:
+
+    python -m pytest -q test_blit.py
+"""
+
+import pytest
+from blit import Group, MIN, Pixel
+
+def test_swizzle():
+    p = Pixel(1, 2, 3, 4)
+    assert p.g == 2
+    assert list(p.bgr) == [3, 2, 1]
+    assert list(p.aaar) == [4, 4, 4, 1]
+    # Longer attributes are read through __getattr__
+    assert list(p.rgbar) == [1, 2, 3, 4, 1]
+    p.gbr = p.rgb
+    assert p.as_color() == (3, 1, 2, 4)
+    p.ra = 9
+    assert p.as_color() == (9, 1, 2, 9)
+    with pytest.raises(ValueError):
+        p.rgb = p.rg
+    with pytest.raises(AttributeError):
+        p.rgx
+
+@pytest.mark.parametrize('n', [1, 2, 3, 4, 5])
+def test_group(n):
+    g = Group(range(10, 10 + n))
+    h = Group(range(n))
+    assert list(g - h) == [10] * n
+    assert list(g * 2) == [2 * i for i in g]
+    assert list((g + h) // 3) == [(i + j) // 3 for i, j in zip(g, h)]
+    assert list(g << 1 >> 2) == [(i << 1) >> 2 for i in g]
+    assert list(MIN(g, h + 5, 13)) == [min(i, j + 5, 13)
+                                       for i, j in zip(g, h)]
+    assert MIN(4, 2) == 2
+    with pytest.raises(ValueError):
+        MIN(g, Group(range(n + 1)))
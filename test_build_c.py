@@ -0,0 +1,143 @@
+"""Check build_c helpers and Kernel options against plain calls
+
+Run with pytest:
+
+    python -m pytest -q test_build_c.py
+"""
+
+import os
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+import pytest
+import blit
+import build_c
+import write_c
+
+def _contents(surf):
+    return pygame.image.tostring(surf, 'RGBA')
+
+def test_bands():
+    assert build_c.bands(10, 10, threads=4, band_pixels=1000) == [(0, 10)]
+    assert build_c.bands(100, 10, threads=4, band_pixels=100) == [
+        (0, 3), (3, 3), (6, 2), (8, 2)]
+    # Never more bands than rows
+    assert build_c.bands(1000, 2, threads=8, band_pixels=1) == [
+        (0, 1), (1, 1)]
+
+def test_compile_template_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('PIXEL_CACHE_DIR', str(tmpdir))
+    first = build_c.compile_template(write_c.Compiler, blit.ZEROx_SRC)
+    second = build_c.compile_template(write_c.Compiler, blit.ZEROx_SRC)
+    assert second is not first
+    assert second.library_code == first.library_code
+    # A damaged entry is rebuilt
+    [path] = tmpdir.join('templates').listdir()
+    path.write_binary(b'not a pickle')
+    third = build_c.compile_template(write_c.Compiler, blit.ZEROx_SRC)
+    assert third.library_code == first.library_code
+    assert path.read_binary() != b'not a pickle'
+
+def _alpha_runs(size):
+    # A source of transparent, opaque and mixed alpha runs
+    surf = pygame.Surface(size, pygame.SRCALPHA, 32)
+    width, height = size
+    for y in range(height):
+        for x in range(width):
+            a = (0, 255, (x * 37 + y) % 256)[(x // 20 + y) % 3]
+            surf.set_at((x, y), (x % 256, y % 256, (x + y) % 256, a))
+    return surf
+
+def _destination(size):
+    surf = pygame.Surface(size, pygame.SRCALPHA, 32)
+    surf.fill((10, 200, 30, 128))
+    return surf
+
+def test_span_index():
+    size = (101, 7)
+    src = _alpha_runs(size)
+    expected = _destination(size)
+    build_c.Kernel(blit.ALPHA_BLENDx_SRC, spans=False, threads=1)(
+        src, expected)
+    kernel = build_c.Kernel(blit.ALPHA_BLENDx_SRC, threads=1)
+    index = kernel.span_index(src, _destination(size))
+    assert index.blocks == -(-size[0] // write_c.SPAN_BLOCK)
+    # The first block of row 0 is transparent (0), of row 1 opaque (2)
+    assert index.data[0] == 0
+    assert index.data[index.blocks] == 2
+    for kwds in ({}, {'index': index}):
+        d = _destination(size)
+        kernel(src, d, **kwds)
+        assert _contents(d) == _contents(expected)
+
+def test_blits():
+    kernel = build_c.Kernel(blit.ALPHA_BLENDx_SRC, threads=1)
+    a = _alpha_runs((23, 9))
+    b = pygame.Surface((16, 16), 0, 24)
+    b.fill((90, 40, 250))
+    # Runs of each format, a repeated source, clipped and empty blits
+    sequence = [(a, (0, 0)), (a, (30, 5), (4, 2, 10, 5)), (b, (-5, 40)),
+                (b, (70, 0)), (a, (60, 50)), (a, (200, 0))]
+    expected = _destination((80, 60))
+    rects = [kernel(item[0], expected, dest=item[1],
+                    area=item[2] if len(item) > 2 else None)
+             for item in sequence]
+    d = _destination((80, 60))
+    assert kernel.blits(sequence, d) == rects
+    assert _contents(d) == _contents(expected)
+
+def test_swar_pairs():
+    assert write_c.Compiler(blit.BLEND_ADDx_SRC).pair is not None
+    assert write_c.Compiler(blit.ALPHA_BLENDx_SRC).pair is None
+    kernel = build_c.Kernel(blit.BLEND_ADDx_SRC, simd=False, threads=1)
+    # Odd and even widths, bytes of every sum with and without a carry
+    for width in (1, 2, 7):
+        s = pygame.Surface((width, 16), pygame.SRCALPHA, 32)
+        for y in range(16):
+            for x in range(width):
+                s.set_at((x, y), (y * 16, x * 40, 255 - y * 16, 17 * y))
+        d = _destination((width, 16))
+        expected = d.copy()
+        blit.BLEND_ADDx(s, expected)
+        kernel(s, d)
+        assert _contents(d) == _contents(expected)
+
+TABLED = [
+    # One byte, and two bytes with a negative quotient
+    "def gamma(d: Pixel) -> None:\n"
+    "    d.rgb = d.rgb * d.rgb // 255 * d.rgb // 255\n",
+    "def spread(s: Pixel, d: Pixel) -> None:\n"
+    "    d.rgb = (s.rgb - d.rgb) // 7 * 3 + s.rgb // 2 + 50\n",
+]
+
+@pytest.mark.parametrize('src', TABLED)
+def test_tables(src):
+    assert 'lut_' in write_c.Compiler(src).code
+    assert 'lut_' not in write_c.Compiler(src, tables=False).code
+    size = (256, 3)
+    args = [_alpha_runs(size) for i in range(src.count('Pixel'))]
+    results = []
+    for tables in (False, True):
+        copies = [a.copy() for a in args]
+        build_c.Kernel(src, simd=False, threads=1, tables=tables)(*copies)
+        results.append(_contents(copies[-1]))
+    assert results[0] == results[1]
+
+def test_stats():
+    kernel = build_c.Kernel(blit.ALPHA_BLENDx_SRC, threads=2,
+                            band_pixels=100, stats=True)
+    s = _alpha_runs((20, 10))
+    d = _destination((20, 10))
+    kernel(s, d)
+    kernel.blits([(s, (0, 0)), (s, (5, 5), (0, 0, 4, 3))], d)
+    [(entry, stats)] = [(e, st) for e, st in kernel.get_stats().items()
+                        if st.calls]
+    assert entry.endswith('_loop')
+    # Two bands, then a call per blit of the batch
+    assert stats.calls == 4
+    assert stats.pixels == 2 * 200 + 12
+    assert stats.bytes == 2 * 4 * stats.pixels
+    kernel.reset_stats()
+    assert not any(any(st) for st in kernel.get_stats().values())
+    with pytest.raises(ValueError):
+        build_c.Kernel(blit.ALPHA_BLENDx_SRC, stats=False).get_stats()
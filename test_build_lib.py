@@ -0,0 +1,58 @@
+"""Check build_lib's template discovery and incremental builds
+
+Run with pytest:
+
+    python -m pytest -q test_build_lib.py
+"""
+
+import ctypes
+
+import pytest
+import build_c
+import build_lib
+from transform import CompileError
+
+HALVE = ("from blit import Pixel\n"
+         "\n"
+         "__templates__ = ['halve']\n"
+         "\n"
+         "def halve(d: Pixel) -> None:\n"
+         "    d.rgb = d.rgb // 2\n")
+
+def test_find_templates(tmpdir):
+    tmpdir.join('halve.py').write(HALVE)
+    tmpdir.join('helper.py').write("def halve(d):\n    pass\n")
+    assert list(build_lib.find_templates(str(tmpdir))) == ['halve']
+    tmpdir.join('misnamed.py').write(HALVE.replace("['halve']",
+                                                    "['half']"))
+    with pytest.raises(CompileError):
+        build_lib.find_templates(str(tmpdir))
+
+def test_build_library(tmpdir):
+    templates = tmpdir.mkdir('templates')
+    templates.join('halve.py').write(HALVE)
+    output = tmpdir.join('build')
+    messages = []
+    compilers = build_lib.build_library(str(templates), str(output), jobs=1,
+                                        log=messages.append, simd=False)
+    assert list(compilers) == ['halve']
+    code = output.join('pixel_loops.c').read()
+    header = output.join('pixel_loops.h').read()
+    assert '__templates__' not in code
+    assert 'void halve_bgra_loop(' in header
+    lib = ctypes.CDLL(build_c.build(code))
+    assert lib.halve_bgra_loop
+
+    # Nothing changed: nothing compiled or written
+    messages = []
+    assert build_lib.build_library(str(templates), str(output), jobs=1,
+                                   log=messages.append, simd=False) == {}
+    assert messages == ['halve: up to date']
+    assert output.join('pixel_loops.c').read() == code
+
+    # A changed template is compiled again
+    templates.join('halve.py').write(HALVE.replace('// 2', '// 4'))
+    compilers = build_lib.build_library(str(templates), str(output), jobs=1,
+                                        simd=False)
+    assert list(compilers) == ['halve']
+    assert output.join('pixel_loops.c').read() != code
@@ -0,0 +1,104 @@
+"""Check the transform passes on small templates
+
+Run with pytest:
+
+    python -m pytest -q test_transform.py
+"""
+
+import ast
+
+import pytest
+import transform
+
+def _lowered(src, macros=None):
+    module, typer = transform.lower(src, macros)
+    return transform.template_function(module).body
+
+def test_fold_min():
+    [stmt] = _lowered("def f(s: Pixel, d: Pixel) -> None:\n"
+                      "    d.b = MIN(MIN(0 * 2, 3), (s.g * s.a) >> 8)\n")
+    call = stmt.value
+    assert isinstance(call, ast.Call)
+    assert transform.constant_value(call.args[0]) == 0
+
+def test_fold_constant_if():
+    stmts = _lowered("def f(d: Pixel) -> None:\n"
+                     "    if MIN(2, 3) > 1:\n"
+                     "        d.r = 1\n"
+                     "    else:\n"
+                     "        d.r = 2\n")
+    assert [transform.constant_value(s.value) for s in stmts] == [1]
+
+def test_share():
+    stmts = _lowered("def f(s: Pixel, d: Pixel) -> None:\n"
+                     "    d.r = s.a * d.a\n"
+                     "    d.g = s.a * d.a + 1\n")
+    # s.a * d.a is computed once, into a temporary
+    products = [n for stmt in stmts for n in ast.walk(stmt)
+                if isinstance(n, ast.BinOp) and isinstance(n.op, ast.Mult)]
+    assert len(products) == 1
+    assert stmts[-1].targets[0].attr == 'g'
+
+MACRO_SRC = ("@macro\n"
+             "def HALF(x):\n"
+             "    return x // 2\n")
+
+def test_macros():
+    macros = transform.module_macros(ast.parse(MACRO_SRC).body)
+    src = ("def f(s: Pixel, d: Pixel) -> None:\n"
+           "    d.rgb = HALF(s.rgb)\n")
+    stmts = _lowered(src, macros)
+    # Inlined for each channel
+    assert len(stmts) == 3
+    assert not any(isinstance(n, ast.Call)
+                   for stmt in stmts for n in ast.walk(stmt))
+    # The same macro, defined by the template module
+    assert len(_lowered(MACRO_SRC + src)) == 3
+
+def test_macros_are_explicit():
+    with pytest.raises(transform.CompileError):
+        _lowered("def f(s: Pixel, d: Pixel) -> None:\n"
+                 "    d.rgb = ALPHA_BLEND_COMP(s.rgb, d.rgb, s.a)\n")
+
+@pytest.mark.parametrize('hi', [255, 255 * 255, 0xffff])
+@pytest.mark.parametrize('d', [3, 5, 7, 10, 255, 257, 1000])
+def test_divide_magic(d, hi):
+    m, s = transform.divide_magic(d, hi, limit=1 << 62)
+    assert all((x * m) >> s == x // d for x in range(hi + 1))
+    # None when x * m may not fit an int
+    expected = (m, s) if hi * m <= 0x7fffffff else None
+    assert transform.divide_magic(d, hi) == expected
+
+def test_reducer():
+    module, typer = transform.lower("def f(s: Pixel, d: Pixel) -> None:\n"
+                                    "    d.r = s.r * 4\n"
+                                    "    d.g = (s.g - 128) // 8\n"
+                                    "    d.b = (s.b * s.a) // 255\n")
+    func = transform.template_function(module)
+    transform.Typer().visit(func)
+    func = transform.Reducer().visit(func)
+    ops = [type(stmt.value.op) for stmt in func.body]
+    assert ops == [ast.LShift, ast.RShift, ast.RShift]
+
+@pytest.mark.parametrize('swizzle, temporaries', [
+    ('d.rgb = d.gbr', 1), ('d.rgba = d.grab', 2), ('d.rgba = d.gbar', 1),
+    ('d.rg = d.gb', 0), ('d.rrg = d.gbr', 1), ('d.rgb = d.rgb // 2', 0)])
+def test_degroup_cycles(swizzle, temporaries):
+    from types import SimpleNamespace
+    import blit
+
+    src = "def f(d: Pixel) -> None:\n    {}\n".format(swizzle)
+    stmts = _lowered(src)
+    names = [s for s in stmts if isinstance(s.targets[0], ast.Name)]
+    assert len(names) == temporaries
+    # The strands, run in order, store what the group assignment does
+    module = ast.parse("def f(d):\n    pass\n")
+    module.body[0].body = stmts
+    namespace = {}
+    exec(compile(ast.fix_missing_locations(module), '<test>', 'exec'),
+         namespace)
+    d = SimpleNamespace(r=1, g=2, b=3, a=4)
+    namespace['f'](d)
+    expected = blit.Pixel(1, 2, 3, 4)
+    exec(swizzle, {'d': expected})
+    assert (d.r, d.g, d.b, d.a) == expected.as_color()
@@ -6,10 +6,48 @@ For Python 3.5 and later.
 """
 
 import ast
+import copy
+import heapq
+from collections import Counter, OrderedDict
+from itertools import product as _product, starmap as _starmap
+import importlib.util
+import operator
+from time import perf_counter
 
 class CompileError(Exception):
     pass
 
+def is_macro(node):
+    """Return True for a function definition decorated with @macro"""
+    return any(isinstance(d, ast.Name) and d.id == 'macro'
+               for d in node.decorator_list)
+
+def is_stage(node):
+    """Return True for a @macro template: a function of statements, not a
+    single return, inlined by Fuser"""
+    if not is_macro(node):
+        return False
+    body = node.body
+    if (body and isinstance(body[0], ast.Expr) and
+        isinstance(constant_value(body[0].value), str)):
+        body = body[1:]  # docstring
+    return not (len(body) == 1 and isinstance(body[0], ast.Return))
+
+def template_function(module):
+    """Return the single template function definition of a module"""
+    funcs = [n for n in module.body
+             if isinstance(n, ast.FunctionDef) and not is_macro(n)]
+    if len(funcs) != 1:
+        raise CompileError("Expected a single template function")
+    return funcs[0]
+
+def is_templates_list(node):
+    """True if node is the __templates__ = [...] assignment marking a
+    template module (see build_lib)"""
+    return (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+            isinstance(node.targets[0], ast.Name) and
+            node.targets[0].id == '__templates__')
+
 class TNoneType:
     """None has no useable type: For error detection.
 
@@ -25,56 +63,96 @@ class TNoneType:
     def __str__(self):
         return "TNoneType"
 
-class Cast:
-    # To add when TInt takes bit sizes
-    pass
+class Cast(ast.expr):
+    """Convert value to the integer type ttype
+
+    Inserted where an expression's range does not fit the type that holds
+    it, see write_c.Caster.
+    """
+    _fields = ('value',)
+
+    def __init__(self, value=None, ttype=None):
+        ast.expr.__init__(self, value)
+        self.ttype = ttype
 
 class TInt:
-    # Update TInt to take a bit size argument?
-    def __init__(self):
-        pass
+    """An integer, with the range [lo, hi] of its values when known
+
+    All TInt are the same ttype; the range only decides the size of the
+    C type needed to hold the value.
+    """
+
+    def __init__(self, lo=None, hi=None):
+        self.lo = lo
+        self.hi = hi
 
     def __eq__(self, other):
-        return type(other) is type(self)
+        return isinstance(other, TInt)
 
     def __str__(self):
-        return "TInt"
+        if not self.known:
+            return "TInt"
+        return "TInt({}, {})".format(self.lo, self.hi)
 
-    def add(self, other):
+    @property
+    def known(self):
+        return self.lo is not None and self.hi is not None
+
+    def fits(self, lo, hi):
+        """Return True if every value is within [lo, hi]"""
+        return self.known and lo <= self.lo and self.hi <= hi
+
+    def union(self, other):
+        if not (self.known and other.known):
+            return TInt()
+        return TInt(min(self.lo, other.lo), max(self.hi, other.hi))
+
+    def _check(self, other, symbol):
         if not other == self:
-            msg = "+: incompatible type {}".format(other)
+            msg = "{}: incompatible type {}".format(symbol, other)
             raise CompileError(msg)
-        return self
+
+    def _corners(self, other, op):
+        # The range of a result monotonic in each operand
+        if not (self.known and other.known):
+            return TInt()
+        values = [op(a, b) for a in (self.lo, self.hi)
+                           for b in (other.lo, other.hi)]
+        return TInt(min(values), max(values))
+
+    def add(self, other):
+        self._check(other, '+')
+        if not (self.known and other.known):
+            return TInt()
+        return TInt(self.lo + other.lo, self.hi + other.hi)
 
     def sub(self, other):
-        if not other == self:
-            msg = "-: incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        self._check(other, '-')
+        if not (self.known and other.known):
+            return TInt()
+        return TInt(self.lo - other.hi, self.hi - other.lo)
 
     def lshift(self, other):
-        if not other == self:
-            msg = "<<: incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        self._check(other, '<<')
+        if not (other.known and 0 <= other.lo and other.hi < 64):
+            return TInt()
+        return self._corners(other, operator.lshift)
 
     def rshift(self, other):
-        if not other == self:
-            msg = ">>: incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        self._check(other, '>>')
+        if not (other.known and 0 <= other.lo):
+            return TInt()
+        return self._corners(other, operator.rshift)
     
     def mul(self, other):
-        if not other == self:
-            msg = "*: incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        self._check(other, '*')
+        return self._corners(other, operator.mul)
     
     def floordiv(self, other):
-        if not other == self:
-            msg = "//: incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        self._check(other, '//')
+        if not (other.known and (other.lo > 0 or other.hi < 0)):
+            return TInt()
+        return self._corners(other, operator.floordiv)
     
 class TGroup:
     def __init__(self, base_type, size):
@@ -84,42 +162,38 @@ class TGroup:
     def __str__(self):
         return "TGroup({}, {})".format(self.base_type, self.size)
 
-    # Update these operators to call base_type operations
-    def add(self, other):
-        if not (other == self.base_type or self == other):
-            msg = "+: Incompatible type {}".format(other)
+    def _apply(self, other, symbol, name):
+        # The itemwise operation, on the base types
+        if self == other:
+            other_base = other.base_type
+        elif other == self.base_type:
+            other_base = other
+        else:
+            msg = "{}: Incompatible type {}".format(symbol, other)
             raise CompileError(msg)
-        return self
+        base_type = getattr(self.base_type, name)(other_base)
+        return TGroup(base_type, self.size)
+
+    def add(self, other):
+        return self._apply(other, '+', 'add')
 
     def sub(self, other):
-        if not (other == self.base_type or self == other):
-            msg = "-: Incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        return self._apply(other, '-', 'sub')
 
     def rshift(self, other):
-        if not (other == self.base_type or self == other):
-            msg = ">>: Incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        return self._apply(other, '>>', 'rshift')
 
     def lshift(self, other):
-        if not (other == self.base_type or self == other):
-            msg = "<<: Incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        return self._apply(other, '<<', 'lshift')
 
     def mul(self, other):
-        if not (other == self.base_type or self == other):
-            msg = "*: Incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        return self._apply(other, '*', 'mul')
 
     def floordiv(self, other):
-        if not (other == self.base_type or self == other):
-            msg = "//: Incompatible type {}".format(other)
-            raise CompileError(msg)
-        return self
+        return self._apply(other, '//', 'floordiv')
+
+    def union(self, other):
+        return TGroup(self.base_type.union(other.base_type), self.size)
 
     def __len__(self):
         return self.size
@@ -156,50 +230,198 @@ class TPixel:
             raise CompilerError("Invalid attribute {}".format(a))
         return a, self.base_type
 
+class TSurface:
+    """A mapped surface pixel: pixels.Surface.Pixel"""
+
+    def __init__(self, base_type):
+        self.base_type = base_type
+
+    def __str__(self):
+        return "TSurface({})".format(self.base_type)
+
+    def getattr(self, name):
+        if name != 'pixel':
+            raise CompileError("Invalid attribute {}".format(name))
+        return self.base_type
+
+    def setattr(self, name, value):
+        if name != 'pixel':
+            raise CompileError("Invalid attribute {}".format(name))
+        if not (value == self.base_type or isinstance(value, TArray)):
+            raise CompileError("attribute/value mismatch")
+
+class TArray:
+    """An integer array element: pixels.PixelArray.Element"""
+
+    def __init__(self, base_type):
+        self.base_type = base_type
+
+    def __str__(self):
+        return "TArray({})".format(self.base_type)
+
 class TMin:
     wraps = 'min'
     def call(self, a, b):
-        # inadiquate
-        return a
+        if isinstance(a, TGroup) or isinstance(b, TGroup):
+            group = a if isinstance(a, TGroup) else b
+            a_base = getattr(a, 'base_type', a)
+            b_base = getattr(b, 'base_type', b)
+            return TGroup(self.call(a_base, b_base), group.size)
+        if not (a.known and b.known):
+            return TInt()
+        return TInt(min(a.lo, b.lo), min(a.hi, b.hi))
+
+class TMacro:
+    """A @macro function, type checked for each call and inlined by Inliner
+
+    The body of a macro is a single return statement.
+    """
 
-class TAlphaBlendComp:
-    wraps = 'ALPHA_BLEND_COMP'
-    def call(self, a, b, c):
-        # inadiquate
-        return a
+    def __init__(self, node, symtab):
+        self.node = node
+        self.symtab = symtab
+        self.params = [a.arg for a in node.args.args]
+        self.expression = macro_expression(node)
+
+    def call(self, *args):
+        if len(args) != len(self.params):
+            msg = "{}() takes {} arguments ({} given)"
+            raise CompileError(msg.format(self.node.name, len(self.params),
+                                          len(args)))
+        typer = Typer()
+        typer.symtab = dict(self.symtab)
+        typer.symtab.update(zip(self.params, args))
+        expression = copy.deepcopy(self.expression)
+        typer.visit(expression)
+        return expression.ttype
+
+def macro_expression(node):
+    """Return the expression a macro function definition returns"""
+    body = node.body
+    if (body and isinstance(body[0], ast.Expr) and
+        isinstance(constant_value(body[0].value), str)):
+        body = body[1:]  # docstring
+    if len(body) != 1 or not isinstance(body[0], ast.Return):
+        msg = "macro {} must be a single return statement".format(node.name)
+        raise CompileError(msg)
+    if body[0].value is None:
+        raise CompileError("macro {} returns nothing".format(node.name))
+    return body[0].value
+
+def module_macros(body, macros=None):
+    """Return the @macro functions defined by a module body
+
+    Compile-time conditionals are evaluated to find the definitions used.
+    """
+    if macros is None:
+        macros = {}
+    for stmt in body:
+        if isinstance(stmt, ast.FunctionDef) and is_macro(stmt):
+            macros[stmt.name] = stmt
+        elif isinstance(stmt, ast.If):
+            module_macros(conditional_branch(stmt), macros)
+    return macros
+
+def conditional_branch(node):
+    """Return the statements a compile-time if statement selects"""
+    test = constant_value(Folder().visit(copy.deepcopy(node.test)))
+    if test is None:
+        raise CompileError("Conditional is not a compile-time constant")
+    return node.body if test else node.orelse
+
+_imported_macros = {}
+
+def imported_macros(module_name):
+    """Return the @macro functions defined in the named module's source"""
+    try:
+        return _imported_macros[module_name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(module_name)
+    macros = {}
+    if spec is not None and spec.origin and spec.origin.endswith('.py'):
+        with open(spec.origin) as f:
+            tree = ast.parse(f.read(), spec.origin, 'exec')
+        macros = module_macros(tree.body)
+    _imported_macros[module_name] = macros
+    return macros
 
 symtab = {
-    'Pixel': TPixel(TInt()),
+    'Pixel': TPixel(TInt(0, 255)),
+    'Surface': TSurface(TInt()),
+    'PixelArray': TArray(TInt()),
     'MIN': TMin(),
-    'ALPHA_BLEND_COMP': TAlphaBlendComp(),
+    'min': TMin(),
     'int': TInt()
     }
 
 class Typer(ast.NodeVisitor):
-    def __init__(self):
+    """Give each node of a template module its ttype
+
+    The @macro functions a template can call are those it defines, those
+    it imports and those of macros, a dict of function definitions by name
+    given by the compiler. They are collected in macros, by name.
+    """
+
+    def __init__(self, macros=None):
         self.symtab = symtab.copy()
+        self.macros = {}
+        if macros is not None:
+            self._add_macros(macros)
+
+    def _add_macros(self, macros):
+        for name, node in macros.items():
+            self.macros[name] = node
+            self.symtab[name] = TMacro(node, self.symtab)
 
     def visit_Module(self, node):
-        for child in node.body:
+        self._visit_module_body(node.body)
+
+    def _visit_module_body(self, body):
+        for child in body:
             if isinstance(child, ast.ImportFrom):
-                print("Have some symbol definitions")
+                macros = imported_macros(child.module)
+                names = [a.name for a in child.names]
+                if names != ['*']:
+                    macros = {n: macros[n] for n in names if n in macros}
+                self._add_macros(macros)
             elif isinstance(child, ast.If):
-                print("Have a compile-time conditional statement")
+                # A compile-time conditional, also resolved by Folder
+                self._visit_module_body(conditional_branch(child))
             elif isinstance(child, ast.FunctionDef):
-                self.visit(child)
+                if is_macro(child):
+                    self._add_macros({child.name: child})
+                else:
+                    self.visit(child)
             else:
-                raise CompilerError("Unknown top level statement")
+                raise CompileError("Unknown top level statement")
 
     def visit_FunctionDef(self, node):
         symtab = self.symtab
-        for a in node.args.args:
-            ttype_name = a.annotation.id
+        decorator_types = self._decorator_types(node)
+        for i, a in enumerate(node.args.args):
+            if a.annotation is not None:
+                ttype_name = a.annotation.id
+            elif i < len(decorator_types):
+                ttype_name = decorator_types[i]
+            else:
+                raise CompileError("No ttype for argument {}".format(a.arg))
             try:
                 ttype = symtab[ttype_name]
             except KeyError:
                 raise CompilerError("Unknown ttype {}".format(ttype_name))
             self.symtab[a.arg] = ttype
-        self.generic_visit(node)
+        for stmt in node.body:
+            self.visit(stmt)
+
+    @staticmethod
+    def _decorator_types(node):
+        # The argument types of a pixels.blitter(src_type, dst_type) template
+        for d in node.decorator_list:
+            if isinstance(d, ast.Call) and isinstance(d.func, ast.Name):
+                if all(isinstance(a, ast.Name) for a in d.args):
+                    return [a.id for a in d.args]
+        return []
 
     def visit_Assign(self, node):
         self.generic_visit(node)
@@ -212,6 +434,9 @@ class Typer(ast.NodeVisitor):
                 elif not (t.ttype == value.ttype):
                     msg = "Incompatible types: {} = {}".format(t.ttype, value)
                     raise CompileError(msg)
+                elif hasattr(t.ttype, 'union'):
+                    # A variable holds every value assigned to it
+                    self.symtab[id] = t.ttype = t.ttype.union(value.ttype)
             elif isinstance(t, ast.Attribute):
                 t.value.ttype.setattr(t.attr, value.ttype)
             else:
@@ -250,7 +475,7 @@ class Typer(ast.NodeVisitor):
     def visit_Constant(self, node):
         value = node.value
         if isinstance(value, int):
-            node.ttype = TInt()
+            node.ttype = TInt(value, value)
         elif value is None:
             node.ttype = TNoneType()
         else:
@@ -263,14 +488,14 @@ class Typer(ast.NodeVisitor):
         self.generic_visit(node)
         for a in node.args:
             args.append(a.ttype)
-        try:
-            node.ttype = self.symtab[func_id].call(*args)
-        except KeyError:
+        func = self.symtab.get(func_id)
+        if func is None:
             raise CompileError("Unknown function {}".format(func_id))
+        node.ttype = func.call(*args)
 
     # Python 3.7 and earlier
     def visit_Num(self, node):
-        node.ttype = TInt()
+        node.ttype = TInt(node.n, node.n)
 
     def _visit_unsupported_literal(self, node):
         msg = "{} literals not supported".format(type(node).__name__)
@@ -392,63 +617,929 @@ class Degrouper(ast.NodeTransformer):
                 raise CompileError("Multitarget assignment unsupported")
             size = len(ttype)
             assigns = [self.Copier(i).visit(node) for i in range(size)]
-            assigns += self._resolve_overwrites(assigns)
-            return assigns
+            return self._resolve_overwrites(assigns)
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        # A call outside a group assignment, as in d.a = MIN(s.a, d.a),
+        # named as Copier names it
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Name):
+            func.id = getattr(symtab.get(func.id), 'wraps', func.id)
         return node
 
     def _resolve_overwrites(self, assigns):
-        extras = []
-        for i in range(len(assigns) - 1):
-            extras += self._resolve_overwrites_1(assigns[i], assigns[i + 1:])
-        return extras
-
-    def _resolve_overwrites_1(self, first, rest):
-        extras = []
-        target = first.targets[0]
-        if any(self._check_conficts(target, o) for o in rest):
-            tmp_id = '_{}'.format(self._temp_count)
-            self._temp_count += 1
-            new_target = ast.Name(tmp_id, ast.Store())
-            ttype = target.ttype
-            ast.copy_location(new_target, target).ttype = ttype
-            first.targets[0] = new_target
-            new_value = ast.Name(tmp_id, ast.Load())
-            ast.copy_location(new_value, target).ttype = ttype
-            new_assign = ast.Assign([target], new_value)
-            ast.copy_location(new_assign, first)
-            extras.append(new_assign)
-        return extras
-
-    class NameChecker(ast.NodeVisitor):
-        def __init__(self, name):
-            self.id = name.id
-            self.n_conflicts = 0
+        # Order the strands of a group assignment, each of which reads the
+        # values from before any is stored, so that no strand overwrites
+        # what a later one reads. A strand waits for the readers of its
+        # target; a cycle of them, like the swizzle p.rgb = p.brg, is
+        # broken by computing one strand into a temporary stored last, one
+        # temporary per cycle. Each value's reads are indexed in one walk.
+        n = len(assigns)
+        first = {}
+        later = [None] * n
+        waits = [0] * n
+        for i, assign in enumerate(assigns):
+            key = self._key(assign.targets[0])
+            if key is None:
+                raise CompileError("Unsupported assignment target")
+            if key in first:
+                # Stores to one target keep their order
+                j = first[key]
+                while later[j] is not None:
+                    j = later[j]
+                later[j] = i
+                waits[i] += 1
+            else:
+                first[key] = i
+        reads = []
+        for i, assign in enumerate(assigns):
+            read = set()
+            for node in ast.walk(assign.value):
+                if isinstance(getattr(node, 'ctx', None), ast.Load):
+                    j = first.get(self._key(node, False))
+                    if j is not None and j != i:
+                        read.add(j)
+            for j in read:
+                waits[j] += 1
+            reads.append(read)
+
+        ordered = []
+        done = [False] * n
+        temps = {}
+        ready = [i for i in range(n) if not waits[i]]
+
+        def release(js):
+            for j in js:
+                waits[j] -= 1
+                if not waits[j]:
+                    heapq.heappush(ready, j)
+
+        while len(ordered) < n + len(temps):
+            if not ready:
+                # Only cycles are left
+                i = self._on_cycle(done, temps, reads)
+                temps[i] = self._temp_assign(assigns[i])
+                ordered.append(assigns[i])
+                release(reads[i])
+                continue
+            i = heapq.heappop(ready)
+            done[i] = True
+            if i in temps:
+                ordered.append(temps[i])
+            else:
+                ordered.append(assigns[i])
+                release(reads[i])
+            if later[i] is not None:
+                release([later[i]])
+        return ordered
+
+    @staticmethod
+    def _on_cycle(done, temps, reads):
+        # A waiting strand on a cycle of strands reading each other's target
+        waiting = [i for i in range(len(done))
+                   if not done[i] and i not in temps]
+        reader = {}
+        for j in waiting:
+            for k in reads[j]:
+                reader.setdefault(k, j)
+        i = waiting[0]
+        seen = set()
+        while i not in seen:
+            seen.add(i)
+            i = reader.get(i, i)
+        return i
+
+    def _temp_assign(self, assign):
+        # Store assign's value in a new temporary; return the assignment of
+        # the temporary to its target
+        target = assign.targets[0]
+        tmp_id = '_{}'.format(self._temp_count)
+        self._temp_count += 1
+        new_target = ast.Name(tmp_id, ast.Store())
+        ttype = target.ttype
+        ast.copy_location(new_target, target).ttype = ttype
+        assign.targets[0] = new_target
+        new_value = ast.Name(tmp_id, ast.Load())
+        ast.copy_location(new_value, target).ttype = ttype
+        new_assign = ast.Assign([target], new_value)
+        return ast.copy_location(new_assign, assign)
+
+    @staticmethod
+    def _key(node, target=True):
+        # The variable or plane a Name or Attribute stands for, or None
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Attribute):
+            if isinstance(node.value, ast.Name):
+                return node.value.id, node.attr
+            if target:
+                raise CompileError("Only supports attributes of names")
+        return None
+
+def fuse(sources, name=None):
+    """Return the source of a template running each template of sources,
+    in turn, on a pixel
+
+    The last argument of every template is the destination, d, shared by
+    all. The others become arguments of the fused template, in order,
+    named for the template argument and its position in sources: s1 for
+    argument s of the second template. The templates are kept as @macro
+    stages, merged into one pixel loop by Fuser. name defaults to the
+    template names joined by '_'.
+    """
+    lines = []
+    names = []
+    params = []
+    calls = []
+    dst_type = None
+    defined = {}
+    for i, src in enumerate(sources):
+        func = template_function(ast.parse(src, '<str>', 'exec'))
+        decorator_types = Typer._decorator_types(func)
+        arg_types = []
+        for j, a in enumerate(func.args.args):
+            if a.annotation is not None:
+                arg_types.append(a.annotation.id)
+            elif j < len(decorator_types):
+                arg_types.append(decorator_types[j])
+            else:
+                raise CompileError("No ttype for argument {}".format(a.arg))
+        if not arg_types:
+            raise CompileError("{} takes no pixel".format(func.name))
+        if dst_type is None:
+            dst_type = arg_types[-1]
+        elif arg_types[-1] != dst_type:
+            msg = "{} destination is not a {}".format(func.name, dst_type)
+            raise CompileError(msg)
+        args = []
+        for a, ttype_name in zip(func.args.args[0:-1], arg_types):
+            param = '{}{}'.format(a.arg, i)
+            params.append('{}: {}'.format(param, ttype_name))
+            args.append(param)
+        args.append('d')
+        calls.append('    {}({})\n'.format(func.name, ', '.join(args)))
+        names.append(func.name)
+        if func.name in defined:
+            if defined[func.name] != src:
+                msg = "Two templates named {}".format(func.name)
+                raise CompileError(msg)
+            continue
+        defined[func.name] = src
+        src_lines = src.splitlines(True)
+        first = min([d.lineno for d in func.decorator_list] + [func.lineno])
+        src_lines.insert(first - 1, '@macro\n')
+        lines.extend(src_lines)
+        lines.append('\n')
+    if not calls:
+        raise CompileError("No templates to fuse")
+    if name is None:
+        name = '_'.join(names)
+    params.append('d: {}'.format(dst_type))
+    lines.append('def {}({}) -> None:\n'.format(name, ', '.join(params)))
+    lines.extend(calls)
+    return ''.join(lines)
+
+class Fuser(ast.NodeTransformer):
+    """Inline the stages a template calls
+
+    A stage is a template marked @macro (see is_stage). A statement
+    calling one, stage(d, ...), is replaced by the stage body, with each
+    parameter renamed to its argument, which must be an argument of the
+    template, and each local variable prefixed by the stage name. Every
+    stage then runs on a pixel in one pass over memory. Stage definitions
+    are dropped from the module, as are the __templates__ lists of the
+    template modules fused (see is_templates_list). Runs first, on the
+    parsed module.
+    """
+
+    def visit_Module(self, node):
+        self.stages = {}
+        self._active = []
+        body = []
+        for stmt in node.body:
+            if isinstance(stmt, ast.FunctionDef) and is_stage(stmt):
+                self.stages[stmt.name] = stmt
+            elif not is_templates_list(stmt):
+                body.append(stmt)
+        node.body = body
+        if self.stages:
+            self.generic_visit(node)
+        return node
+
+    def visit_FunctionDef(self, node):
+        if is_macro(node):
+            return node
+        self.arg_types = {a.arg: getattr(a.annotation, 'id', None)
+                          for a in node.args.args}
+        node.body = self._block(node.body)
+        return node
+
+    def _block(self, stmts):
+        body = []
+        for stmt in stmts:
+            value = getattr(stmt, 'value', None)
+            if (isinstance(stmt, ast.Expr) and isinstance(value, ast.Call) and
+                isinstance(value.func, ast.Name) and
+                value.func.id in self.stages):
+                body.extend(self._inline(value))
+                continue
+            if isinstance(stmt, ast.If):
+                stmt.body = self._block(stmt.body)
+                stmt.orelse = self._block(stmt.orelse)
+            body.append(stmt)
+        return body
+
+    def _inline(self, call):
+        name = call.func.id
+        if name in self._active:
+            raise CompileError("Recursive stage {}".format(name))
+        stage = self.stages[name]
+        params = stage.args.args
+        if len(params) != len(call.args):
+            msg = "{}() takes {} arguments ({} given)"
+            raise CompileError(msg.format(name, len(params), len(call.args)))
+        names = {}
+        for param, arg in zip(params, call.args):
+            if not (isinstance(arg, ast.Name) and arg.id in self.arg_types):
+                msg = "{}() arguments must be template arguments"
+                raise CompileError(msg.format(name))
+            ttype_name = getattr(param.annotation, 'id', None)
+            if ttype_name not in (None, self.arg_types[arg.id]):
+                msg = "{}(): {} is not a {}".format(name, arg.id, ttype_name)
+                raise CompileError(msg)
+            names[param.arg] = arg.id
+        body = stage.body
+        if (body and isinstance(body[0], ast.Expr) and
+            isinstance(constant_value(body[0].value), str)):
+            body = body[1:]  # docstring
+        body = copy.deepcopy(body)
+        for stmt in body:
+            for n in ast.walk(stmt):
+                if (isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)
+                    and n.id not in names):
+                    names[n.id] = '{}_{}'.format(name, n.id)
+        renamer = self.Renamer(names)
+        body = [renamer.visit(stmt) for stmt in body]
+        self._active.append(name)
+        try:
+            return self._block(body)
+        finally:
+            self._active.pop()
+
+    class Renamer(ast.NodeTransformer):
+
+        def __init__(self, names):
+            self.names = names
 
         def visit_Name(self, node):
-            if node.id == self.id and isinstance(node.ctx, ast.Load):
-                self.n_conflicts += 1
-
-    class AttributeChecker(ast.NodeVisitor):
-        def __init__(self, attribute):
-            self.id = attribute.value.id
-            self.attr = attribute.attr
-            self.n_conflicts = 0
-    
-        def visit_Attribute(self, node):
-            if (node.attr == self.attr and
-                isinstance(node.ctx, ast.Load) and
-                isinstance(node.value, ast.Name) and # conditional and
-                node.value.id == self.id):
-                self.n_conflicts += 1
-
-    def _check_conficts(self, target, assign):
-        if isinstance(target, ast.Name):
-            checker = self.NameChecker(target)
-        elif isinstance(target, ast.Attribute):
-            if not isinstance(target.value, ast.Name):
-                raise CompileError("Only supports attributes of names")
-            checker = self.AttributeChecker(target)
+            node.id = self.names.get(node.id, node.id)
+            return node
+
+class Inliner(ast.NodeTransformer):
+    """Replace @macro calls by the macro expression
+
+    Runs on Degrouper output, so each argument is a single channel
+    expression, substituted for every use of its parameter.
+    """
+
+    def __init__(self, macros):
+        self.macros = macros
+        self._active = []
+
+    def visit_FunctionDef(self, node):
+        if is_macro(node):
+            return node
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if not isinstance(func, ast.Name) or func.id not in self.macros:
+            return node
+        if func.id in self._active:
+            raise CompileError("Recursive macro {}".format(func.id))
+        macro = self.macros[func.id]
+        params = [a.arg for a in macro.args.args]
+        if len(params) != len(node.args):
+            msg = "{}() takes {} arguments ({} given)"
+            raise CompileError(msg.format(func.id, len(params),
+                                          len(node.args)))
+        expression = copy.deepcopy(macro_expression(macro))
+        expression = self.Substituter(dict(zip(params, node.args)),
+                                      getattr(node, 'ttype', None)).visit(
+                                          expression)
+        self._active.append(func.id)
+        try:
+            expression = self.visit(expression)
+        finally:
+            self._active.pop()
+        return ast.copy_location(expression, node)
+
+    class Substituter(ast.NodeTransformer):
+
+        def __init__(self, args, ttype):
+            self.args = args
+            self.ttype = ttype
+
+        def visit(self, node):
+            new_node = ast.NodeTransformer.visit(self, node)
+            if isinstance(new_node, ast.expr) and self.ttype is not None:
+                if getattr(new_node, 'ttype', None) is None:
+                    new_node.ttype = self.ttype
+            return new_node
+
+        def visit_Name(self, node):
+            try:
+                return copy.deepcopy(self.args[node.id])
+            except KeyError:
+                return node
+
+def constant_value(node):
+    """Return the value of a constant node, or None"""
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, getattr(ast, 'Num', ())):  # Python 3.7 and earlier
+        return node.n
+    return None
+
+def new_constant(value, node=None):
+    """Return an integer constant node, located at node"""
+    if isinstance(value, bool):
+        value = int(value)
+    try:
+        new_node = ast.Constant(value)
+    except AttributeError:  # Python 3.5
+        new_node = ast.Num(value)
+    new_node.ttype = TInt(value, value)
+    if node is not None:
+        ast.copy_location(new_node, node)
+    return new_node
+
+class Folder(ast.NodeTransformer):
+    """Fold constant expressions and conditionals; share repeated values
+
+    Runs on Degrouper output, so every expression is for a single channel.
+    Constants, and calls of min with constant arguments, are folded with
+    Python semantics: in particular -1 >> 1 is an arithmetic shift, as it
+    is for the C compilers the library is built with. An if statement
+    with a constant test, in a template or at module level, is replaced by
+    the branch taken.
+
+    Within a template function, an expression (a pixel plane load, an
+    operation or a call) evaluated more than once before any of the values
+    it reads is stored is assigned once to a temporary, _e0, _e1 ...
+    """
+
+    binops = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.LShift: operator.lshift,
+        ast.RShift: operator.rshift,
+        ast.BitAnd: operator.and_,
+        ast.BitOr: operator.or_,
+        ast.BitXor: operator.xor,
+        }
+
+    unaryops = {
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+        ast.Invert: operator.invert,
+        ast.Not: operator.not_,
+        }
+
+    cmpops = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        }
+
+    # Degrouped call names to the functions folding them
+    functions = {'min': min}
+
+    def __init__(self):
+        self._temp_count = 0
+        self._clear()
+
+    def _clear(self):
+        self._keys = {}
+        self._interned = {}
+        self._counts = {}
+        self._stores = {}
+
+    def visit_FunctionDef(self, node):
+        self.generic_visit(node)
+        if not is_macro(node):
+            node.body = self._share(node.body, {})
+            self._clear()
+        return node
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        test = constant_value(node.test)
+        if test is None:
+            return node
+        return node.body if test else node.orelse
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left = constant_value(node.left)
+        right = constant_value(node.right)
+        if left is not None and right is not None:
+            try:
+                value = self.binops[type(node.op)](left, right)
+            except (KeyError, ArithmeticError, ValueError):
+                return node
+            return new_constant(value, node)
+        op = node.op
+        if right == 0 and isinstance(op, (ast.Add, ast.Sub, ast.LShift,
+                                          ast.RShift, ast.BitOr,
+                                          ast.BitXor)):
+            return node.left
+        if left == 0 and isinstance(op, (ast.Add, ast.BitOr, ast.BitXor)):
+            return node.right
+        if right == 1 and isinstance(op, (ast.Mult, ast.FloorDiv)):
+            return node.left
+        if left == 1 and isinstance(op, ast.Mult):
+            return node.right
+        if 0 in (left, right) and isinstance(op, (ast.Mult, ast.BitAnd)):
+            return new_constant(0, node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = constant_value(node.operand)
+        if operand is None:
+            return node
+        try:
+            value = self.unaryops[type(node.op)](operand)
+        except KeyError:
+            return node
+        return new_constant(value, node)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        values = [constant_value(n) for n in [node.left] + node.comparators]
+        if any(v is None for v in values):
+            return node
+        result = True
+        for op, left, right in zip(node.ops, values, values[1:]):
+            try:
+                result = self.cmpops[type(op)](left, right)
+            except KeyError:
+                return node
+            if not result:
+                break
+        return new_constant(result, node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if not isinstance(func, ast.Name) or node.keywords:
+            return node
+        args = [constant_value(n) for n in node.args]
+        if func.id not in self.functions or None in args:
+            return node
+        return new_constant(self.functions[func.id](*args), node)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        values = [constant_value(n) for n in node.values]
+        if any(v is None for v in values):
+            return node
+        if isinstance(node.op, ast.And):
+            value = all(values)
         else:
-            raise CompileError("Unsupported assignment target")
-        checker.visit(assign)
-        return checker.n_conflicts > 0
+            value = any(values)
+        return new_constant(value, node)
+
+    # Common subexpressions
+
+    def _share(self, stmts, available):
+        """Rewrite a block, given the temporaries available on entry"""
+        new_stmts = []
+        for i, stmt in enumerate(stmts):
+            rest = stmts[i:]
+            if isinstance(stmt, ast.Assign):
+                stmt.value = self._replace(stmt.value, rest, available,
+                                           new_stmts)
+                self._kill(available, self._stored(stmt))
+            elif isinstance(stmt, ast.If):
+                stmt.test = self._replace(stmt.test, rest, available,
+                                          new_stmts)
+                stmt.body = self._share(stmt.body, dict(available))
+                stmt.orelse = self._share(stmt.orelse, dict(available))
+                self._kill(available, self._stored(stmt))
+            new_stmts.append(stmt)
+        return new_stmts
+
+    def _replace(self, node, rest, available, new_stmts):
+        """Return node with shared subexpressions replaced by temporaries
+
+        Assignments to new temporaries are appended to new_stmts.
+        """
+        if not isinstance(node, ast.expr) or not self._is_shareable(node):
+            return node
+        key = self._key(node)
+        deps = self._loads(node)
+        try:
+            tmp_id = available[key][0]
+        except KeyError:
+            pass
+        else:
+            return self._temp_name(tmp_id, ast.Load(), node)
+        new_node = self._copy(node, rest, available, new_stmts)
+        if self._count(key, deps, rest)[0] < 2:
+            return new_node
+        tmp_id = '_e{}'.format(self._temp_count)
+        self._temp_count += 1
+        assign = ast.Assign([self._temp_name(tmp_id, ast.Store(), node)],
+                            new_node)
+        new_stmts.append(ast.copy_location(assign, node))
+        available[key] = tmp_id, deps
+        return self._temp_name(tmp_id, ast.Load(), node)
+
+    def _copy(self, node, rest, available, new_stmts):
+        # A shallow copy with its operands replaced
+        new_node = type(node)()
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                value = [self._replace(v, rest, available, new_stmts)
+                         for v in value]
+            else:
+                value = self._replace(value, rest, available, new_stmts)
+            setattr(new_node, name, value)
+        try:
+            new_node.ttype = node.ttype
+        except AttributeError:
+            pass
+        return ast.copy_location(new_node, node)
+
+    @staticmethod
+    def _temp_name(tmp_id, ctx, node):
+        name = ast.Name(tmp_id, ctx)
+        try:
+            name.ttype = node.ttype
+        except AttributeError:
+            pass
+        return ast.copy_location(name, node)
+
+    @staticmethod
+    def _is_shareable(node):
+        if isinstance(node, ast.Attribute):
+            return isinstance(node.value, ast.Name)
+        return isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare,
+                                 ast.Call))
+
+    def _count(self, key, deps, stmts):
+        """Return the uses of expression key in stmts before deps change
+        and whether they change"""
+        count = 0
+        for stmt in stmts:
+            if isinstance(stmt, ast.If):
+                count += self._count_expr(key, stmt.test)
+                n_body, body_killed = self._count(key, deps, stmt.body)
+                n_else, else_killed = self._count(key, deps, stmt.orelse)
+                count += n_body + n_else
+                if body_killed or else_killed:
+                    return count, True
+            else:
+                value = getattr(stmt, 'value', None)
+                if value is not None:
+                    count += self._count_expr(key, value)
+                if deps & self._stored(stmt):
+                    return count, True
+        return count, False
+
+    def _count_expr(self, key, node):
+        try:
+            counts = self._counts[id(node)][1]
+        except KeyError:
+            counts = Counter(self._key(n) for n in ast.walk(node)
+                             if isinstance(n, ast.expr))
+            self._counts[id(node)] = node, counts
+        return counts[key]
+
+    def _key(self, node):
+        # Equal expressions get the same number. Keys are memoized,
+        # keeping the node so its id is not reused.
+        try:
+            return self._keys[id(node)][1]
+        except KeyError:
+            pass
+        parts = [type(node).__name__]
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                value = tuple(self._key(v) if isinstance(v, ast.AST) else v
+                              for v in value)
+            elif isinstance(value, ast.AST):
+                value = self._key(value)
+            parts.append(value)
+        key = self._interned.setdefault(tuple(parts), len(self._interned))
+        self._keys[id(node)] = node, key
+        return key
+
+    @staticmethod
+    def _loads(node):
+        # The variables and pixel planes an expression reads
+        deps = set()
+        for n in ast.walk(node):
+            if isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name):
+                deps.add((n.value.id, n.attr))
+            elif isinstance(n, ast.Name):
+                deps.add(n.id)
+        return deps
+
+    def _stored(self, stmt):
+        # The variables and pixel planes a statement assigns
+        try:
+            return self._stores[id(stmt)][1]
+        except KeyError:
+            pass
+        stored = set()
+        for n in ast.walk(stmt):
+            if isinstance(n, ast.Assign):
+                for t in n.targets:
+                    if isinstance(t, ast.Name):
+                        stored.add(t.id)
+                    elif (isinstance(t, ast.Attribute) and
+                          isinstance(t.value, ast.Name)):
+                        stored.add((t.value.id, t.attr))
+        self._stores[id(stmt)] = stmt, stored
+        return stored
+
+    @staticmethod
+    def _kill(available, stored):
+        for key, (tmp_id, deps) in list(available.items()):
+            if deps & stored:
+                del available[key]
+
+def divide_magic(d, hi, limit=0x7fffffff):
+    """Return (m, s) such that (x * m) >> s == x // d for 0 <= x <= hi
+
+    m is the smallest such multiplier; None when x * m may exceed limit.
+    Writing x = q * d + r, m = (2**s + e) / d gives x * m / 2**s =
+    q + (r + x * e / 2**s) / d, which floors to q when x * e < 2**s.
+    """
+    for s in range(64):
+        m = -(-(1 << s) // d)
+        e = m * d - (1 << s)
+        if hi * e < (1 << s):
+            if hi * m > limit:
+                return None
+            return m, s
+    return None
+
+class Reducer(ast.NodeTransformer):
+    """Replace multiplications and divisions by constants with cheaper
+    operations, exact over the value ranges Typer found
+
+    x * 2**k becomes x << k when x >= 0, and x // 2**k becomes x >> k. For
+    x >= 0, x // d becomes (x * m) >> s (see divide_magic) when x * m fits
+    an int. Ranges of up to check_limit values are also checked value by
+    value.
+    """
+
+    check_limit = 1 << 20
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        op = node.op
+        left, right = node.left, node.right
+        if isinstance(op, ast.Mult):
+            if constant_value(left) is not None:
+                left, right = right, left
+            k = self._log2(constant_value(right))
+            if k is not None and self._nonnegative(left):
+                return self._binop(left, ast.LShift(), k, node)
+        elif isinstance(op, ast.FloorDiv):
+            d = constant_value(right)
+            k = self._log2(d)
+            if k is not None:
+                return self._binop(left, ast.RShift(), k, node)
+            ttype = getattr(left, 'ttype', None)
+            if d is None or d <= 0 or not self._nonnegative(left):
+                return node
+            magic = divide_magic(d, ttype.hi)
+            if magic is None:
+                return node
+            m, s = magic
+            if (ttype.hi < self.check_limit and
+                any((x * m) >> s != x // d
+                    for x in range(ttype.lo, ttype.hi + 1))):
+                return node
+            product = self._binop(left, ast.Mult(), m, node)
+            product.ttype = ttype.mul(TInt(m, m))
+            return self._binop(product, ast.RShift(), s, node)
+        return node
+
+    @staticmethod
+    def _log2(value):
+        if isinstance(value, int) and value > 0 and not value & (value - 1):
+            return value.bit_length() - 1
+        return None
+
+    @staticmethod
+    def _nonnegative(node):
+        ttype = getattr(node, 'ttype', None)
+        return isinstance(ttype, TInt) and ttype.known and ttype.lo >= 0
+
+    @staticmethod
+    def _binop(left, op, value, node):
+        new_node = ast.BinOp(left, op, new_constant(value, node))
+        new_node.ttype = node.ttype
+        return ast.copy_location(new_node, node)
+
+class Specializer(ast.NodeTransformer):
+    """Specialize a template for known pixel plane values
+
+    assume maps (argument, plane) pairs, such as ('s', 'a'), to the value
+    the plane loads as. Runs on Inliner output. After substitution, a
+    stored value computed from pixel planes alone is evaluated for every
+    combination of their values, up to max_points; one found to be a
+    constant, or a copy of one of the planes, is replaced by it. Stores of
+    a plane's own value are dropped, and an if statement whose branches
+    end up the same becomes that branch.
+    """
+
+    # Most combinations of plane values an expression is evaluated over
+    max_points = 1 << 16
+
+    functions = {'min': min}
+
+    def __init__(self, assume):
+        self.assume = assume
+
+    def visit_FunctionDef(self, node):
+        if is_macro(node):
+            return node
+        node.body = self._block(node.body)
+        return node
+
+    def _block(self, stmts):
+        new_stmts = []
+        for stmt in stmts:
+            stmt = self.visit(stmt)
+            if stmt is None:
+                continue
+            if isinstance(stmt, list):
+                new_stmts.extend(stmt)
+            else:
+                new_stmts.append(stmt)
+        return new_stmts
+
+    def visit_If(self, node):
+        node.test = Folder().visit(self.visit(node.test))
+        node.body = self._block(node.body)
+        node.orelse = self._block(node.orelse)
+        test = constant_value(node.test)
+        if test is not None:
+            return node.body if test else node.orelse
+        if self._dump(node.body) == self._dump(node.orelse):
+            return node.body
+        return node
+
+    def visit_Assign(self, node):
+        node.value = self._simplify(Folder().visit(self.visit(node.value)))
+        if len(node.targets) == 1:
+            target, value = node.targets[0], node.value
+            if (isinstance(target, ast.Attribute) and
+                isinstance(value, ast.Attribute) and
+                self._plane(target) == self._plane(value)):
+                return None
+        return node
+
+    def visit_Attribute(self, node):
+        plane = self._plane(node)
+        if isinstance(node.ctx, ast.Load) and plane in self.assume:
+            return new_constant(self.assume[plane], node)
+        return node
+
+    @staticmethod
+    def _plane(node):
+        if isinstance(node, ast.Attribute) and isinstance(node.value,
+                                                          ast.Name):
+            return node.value.id, node.attr
+        return None
+
+    @staticmethod
+    def _dump(stmts):
+        return [ast.dump(s) for s in stmts]
+
+    def _simplify(self, value):
+        planes = OrderedDict()
+        nodes = [value]
+        while nodes:
+            n = nodes.pop()
+            if isinstance(n, ast.Attribute):
+                plane = self._plane(n)
+                ttype = getattr(n, 'ttype', None)
+                if (plane is None or not isinstance(ttype, TInt) or
+                    not ttype.known):
+                    return value
+                planes[plane] = range(ttype.lo, ttype.hi + 1)
+                continue
+            if isinstance(n, ast.Name) and n.id not in self.functions:
+                return value
+            nodes.extend(ast.iter_child_nodes(n))
+        size = 1
+        for values in planes.values():
+            size *= len(values)
+        if not planes or size > self.max_points:
+            return value
+        func = self._function(value, planes)
+        # Most expressions are ruled out by the corners of the ranges
+        for ranges in ([(r[0], r[-1]) for r in planes.values()],
+                       list(planes.values())):
+            # Python semantics, as those of the template
+            try:
+                results = tuple(_starmap(func, _product(*ranges)))
+            except ArithmeticError:
+                return value
+            candidates = [i for i, column in enumerate(self._columns(ranges))
+                          if results == column]
+            if results.count(results[0]) == len(results):
+                candidates.append(None)
+            if not candidates:
+                return value
+        if candidates[-1] is None:
+            return new_constant(results[0], value)
+        plane = list(planes)[candidates[0]]
+        for n in ast.walk(value):
+            if self._plane(n) == plane:
+                return copy.deepcopy(n)
+
+    @staticmethod
+    def _columns(ranges):
+        # The values of each plane over the product of ranges
+        repeat = 1
+        for values in ranges:
+            repeat *= len(values)
+        outer = 1
+        for values in ranges:
+            repeat //= len(values)
+            column = tuple(v for v in values for i in range(repeat))
+            yield column * outer
+            outer *= len(values)
+
+    def _function(self, value, planes):
+        # A Python function of the plane values
+        names = ['_p{}'.format(i) for i in range(len(planes))]
+        plane_names = dict(zip(planes, names))
+        class Renamer(ast.NodeTransformer):
+            def visit_Attribute(renamer, node):
+                name = ast.Name(plane_names[self._plane(node)], ast.Load())
+                return ast.copy_location(name, node)
+        # Parsed rather than built, as ast.arguments varies by version
+        expr = ast.parse('lambda {}: 0'.format(', '.join(names)),
+                         '<specialize>', 'eval')
+        expr.body.body = Renamer().visit(copy.deepcopy(value))
+        code = compile(ast.fix_missing_locations(expr), '<specialize>', 'eval')
+        return eval(code, dict(self.functions))
+
+def lower(src, macros=None, assume=None, timings=None):
+    """Return the module of template source src after the passes every
+    backend runs, and the Typer that typed it
+
+    The module's stages are fused (Fuser), then it is typed (Typer),
+    degrouped (Degrouper), leaving a statement for each pixel channel,
+    inlined (Inliner), specialized for the plane values assume gives, if
+    any (Specializer), and folded (Folder). macros are the @macro
+    functions the template sees besides those it defines and imports (see
+    Typer). A backend then writes or runs the template function from
+    there. The seconds each pass took are stored in the dict timings, if
+    given, by pass name.
+    """
+    start = perf_counter()
+    module = ast.parse(src, '<str>', 'exec')
+    start = _timed(timings, 'parse', start)
+    module = Fuser().visit(module)
+    start = _timed(timings, 'fuser', start)
+    typer = Typer(macros)
+    typer.visit(module)
+    start = _timed(timings, 'typer', start)
+    module = Degrouper().visit(module)
+    start = _timed(timings, 'degrouper', start)
+    module = Inliner(typer.macros).visit(module)
+    start = _timed(timings, 'inliner', start)
+    if assume:
+        module = Specializer(assume).visit(module)
+        start = _timed(timings, 'specializer', start)
+    module = Folder().visit(module)
+    _timed(timings, 'folder', start)
+    return module, typer
+
+def _timed(timings, name, start):
+    end = perf_counter()
+    if timings is not None:
+        timings[name] = end - start
+    return end
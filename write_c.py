@@ -1,10 +1,530 @@
-from transform import TInt, CompileError
+from transform import (TInt, TPixel, TSurface, TArray, Cast, CompileError,
+                       constant_value)
 from rgba import RGBA, c_uint8
+from mapped import Mapped, Element
+from collections import OrderedDict
+from itertools import product
+from io import StringIO
+from time import perf_counter
 import ast
+import copy
+import hashlib
+
+# Definitions used by written functions
+PRELUDE = """\
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+#define PIXEL_BIG_ENDIAN 1
+#endif
+
+static inline uint32_t load1(const unsigned char *p) {
+    return p[0];
+}
+
+static inline uint32_t load2(const unsigned char *p) {
+    uint16_t v;
+    memcpy(&v, p, 2);
+    return v;
+}
+
+static inline uint32_t load3(const unsigned char *p) {
+#ifdef PIXEL_BIG_ENDIAN
+    return (uint32_t)p[0] << 16 | (uint32_t)p[1] << 8 | p[2];
+#else
+    return p[0] | (uint32_t)p[1] << 8 | (uint32_t)p[2] << 16;
+#endif
+}
+
+static inline uint32_t load4(const unsigned char *p) {
+    uint32_t v;
+    memcpy(&v, p, 4);
+    return v;
+}
+
+static inline uint64_t load8(const unsigned char *p) {
+    uint64_t v;
+    memcpy(&v, p, 8);
+    return v;
+}
+
+static inline int32_t sload1(const unsigned char *p) {
+    return (int8_t)p[0];
+}
+
+static inline int32_t sload2(const unsigned char *p) {
+    int16_t v;
+    memcpy(&v, p, 2);
+    return v;
+}
+
+static inline int32_t sload4(const unsigned char *p) {
+    int32_t v;
+    memcpy(&v, p, 4);
+    return v;
+}
+
+static inline int64_t sload8(const unsigned char *p) {
+    int64_t v;
+    memcpy(&v, p, 8);
+    return v;
+}
+
+static inline void store1(unsigned char *p, uint32_t v) {
+    p[0] = (unsigned char)v;
+}
+
+static inline void store2(unsigned char *p, uint32_t v) {
+    uint16_t v16 = (uint16_t)v;
+    memcpy(p, &v16, 2);
+}
+
+static inline void store3(unsigned char *p, uint32_t v) {
+#ifdef PIXEL_BIG_ENDIAN
+    p[0] = (unsigned char)(v >> 16);
+    p[1] = (unsigned char)(v >> 8);
+    p[2] = (unsigned char)v;
+#else
+    p[0] = (unsigned char)v;
+    p[1] = (unsigned char)(v >> 8);
+    p[2] = (unsigned char)(v >> 16);
+#endif
+}
+
+static inline void store4(unsigned char *p, uint32_t v) {
+    memcpy(p, &v, 4);
+}
+
+/* Bit position of pixel byte k in a 32 bit word load */
+#ifdef PIXEL_BIG_ENDIAN
+#define BYTE_SHIFT(k) (8 * (3 - (k)))
+#else
+#define BYTE_SHIFT(k) (8 * (k))
+#endif
+
+#if defined(__GNUC__)
+#define PIXEL_SIMD 1
+#if defined(__x86_64__) || defined(__i386__)
+#define PIXEL_X86 1
+#endif
+typedef int32_t pixel_i4 __attribute__((vector_size(16)));
+typedef uint32_t pixel_u4 __attribute__((vector_size(16)));
+typedef int32_t pixel_i8 __attribute__((vector_size(32)));
+typedef uint32_t pixel_u8 __attribute__((vector_size(32)));
+#define VMIN(a, b) (((a) & ((a) < (b))) | ((b) & ~((a) < (b))))
+/* FLOOR_DIV of vectors, whose comparisons are 0 or -1 */
+#define VFLOOR_DIV(a, b) \\
+    ((a) / (b) + ((((a) % (b)) != 0) & ((((a) % (b)) ^ (b)) < 0)))
+#endif
+
+static inline int min(int a, int b) {
+    return a < b ? a : b;
+}
+
+/* Python's a // b, rounding down where C's a / b truncates */
+#define FLOOR_DIV(a, b) \\
+    ((a) / (b) - ((((a) % (b)) != 0) & ((((a) % (b)) ^ (b)) < 0)))
+
+/* Bytewise arithmetic on words of two 4 byte pixels, see SwarWriter */
+#define SWAR_HIGH 0x8080808080808080ull
+
+/* The sum of each byte pair, wrapped to a byte */
+static inline uint64_t swar_add(uint64_t a, uint64_t b) {
+    return ((a & ~SWAR_HIGH) + (b & ~SWAR_HIGH)) ^ ((a ^ b) & SWAR_HIGH);
+}
+
+/* The sum of each byte pair, saturated at 255 */
+static inline uint64_t swar_adds(uint64_t a, uint64_t b) {
+    uint64_t sum = swar_add(a, b);
+    uint64_t carry = ((a & b) | ((a | b) & ~sum)) & SWAR_HIGH;
+    return sum | ((carry >> 7) * 0xffu);
+}
+
+/* Pixels a side of the square tiles a LoopWriter loop may walk */
+#ifndef PIXEL_TILE
+#define PIXEL_TILE 64
+#endif
+
+/* True if stepping x moves further through memory than stepping y */
+static inline int walks_columns(ptrdiff_t stride, ptrdiff_t pitch) {
+    return (stride < 0 ? -stride : stride) > (pitch < 0 ? -pitch : pitch);
+}
+
+/* Source alpha classes of blocks of pixels, see SpanLoopWriter */
+#define SPAN_BLOCK 8 /* as SPAN_BLOCK below */
+#define SPAN_CHUNK 256 /* blocks classed at a time */
+#define SPAN_BACKOFF 15 /* most chunks blended unclassed in a row */
+#define SPAN_TRANSPARENT 0
+#define SPAN_MIXED 1
+#define SPAN_OPAQUE 2
+
+static inline int span_class(const unsigned char *p, int n, uint32_t mask) {
+    uint64_t mask2 = (uint64_t)mask << 32 | mask, all, any, w[4];
+    uint32_t w1;
+    int i;
+    if (n == SPAN_BLOCK) {
+        /* Two pixel words at a time */
+        memcpy(w, p, 32);
+        all = w[0] & w[1] & w[2] & w[3];
+        any = w[0] | w[1] | w[2] | w[3];
+    } else {
+        all = mask2;
+        any = 0;
+        for (i = 0; i < n; ++i) {
+            memcpy(&w1, p + 4 * i, 4);
+            all &= (uint64_t)w1 << 32 | w1;
+            any |= w1;
+        }
+    }
+    /* SPAN_TRANSPARENT, SPAN_MIXED or SPAN_OPAQUE */
+    return ((any & mask2) != 0) + ((all & mask2) == mask2);
+}
+
+/* Store the class of each block of a row of width pixels in classes */
+static inline void span_classes(const unsigned char *p, int width,
+                                uint32_t mask, unsigned char *classes) {
+    int b, full = width / SPAN_BLOCK;
+    for (b = 0; b < full; ++b) {
+        classes[b] = (unsigned char)span_class(p + 4 * SPAN_BLOCK * b,
+                                               SPAN_BLOCK, mask);
+    }
+    if (width % SPAN_BLOCK) {
+        classes[full] = (unsigned char)span_class(p + 4 * SPAN_BLOCK * full,
+                                                  width % SPAN_BLOCK, mask);
+    }
+}
+
+#ifdef PIXEL_STATS
+#include <time.h>
+
+/* Totals over the calls of a loop entry point, see StatsWriter */
+typedef struct {
+    uint64_t calls, pixels, bytes, nanoseconds;
+} pixel_stats;
+
+static inline uint64_t pixel_clock(void) {
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (uint64_t)t.tv_sec * 1000000000u + (uint64_t)t.tv_nsec;
+}
+
+/* Add a call started at start, atomically as bands run on many threads */
+static inline void pixel_count(pixel_stats *stats, uint64_t pixels,
+                               uint64_t bytes, uint64_t start) {
+    uint64_t nanoseconds = pixel_clock() - start;
+    __atomic_fetch_add(&stats->calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&stats->pixels, pixels, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&stats->bytes, bytes, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&stats->nanoseconds, nanoseconds, __ATOMIC_RELAXED);
+}
+#endif
+"""
+
+# Pixels per block classed by SpanLoopWriter loops
+SPAN_BLOCK = 8
+
+# C integer types, narrowest first, with the ranges they hold
+c_int_types = [
+    ('uint8_t', 0, 0xff),
+    ('int8_t', -0x80, 0x7f),
+    ('uint16_t', 0, 0xffff),
+    ('int16_t', -0x8000, 0x7fff),
+    ('int32_t', -0x80000000, 0x7fffffff),
+    ('int64_t', -0x8000000000000000, 0x7fffffffffffffff),
+    ]
+
+def c_int_type(ttype):
+    """Return the narrowest C integer type holding the values of a TInt
+
+    An int, as C arithmetic is done in, when the range is unknown.
+    """
+    if isinstance(ttype, TInt):
+        for name, lo, hi in c_int_types:
+            if ttype.fits(lo, hi):
+                return name
+    return 'int'
+
+def _at_least(node, lo):
+    # True if every value of node is known to be lo or more
+    ttype = getattr(node, 'ttype', None)
+    return isinstance(ttype, TInt) and ttype.known and ttype.lo >= lo
+
+class LocalNames(ast.NodeVisitor):
+    """Collect the local variables assigned in a function body
+
+    types maps each to its TInt, covering every value assigned.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.types = {}
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Store):
+            ttype = getattr(node, 'ttype', None)
+            if node.id not in self.ids:
+                self.ids.append(node.id)
+                self.types[node.id] = ttype
+            elif isinstance(ttype, TInt) and self.types[node.id] is not None:
+                self.types[node.id] = self.types[node.id].union(ttype)
+
+class Caster(ast.NodeTransformer):
+    """Insert the Cast nodes the value ranges found by Typer call for
+
+    A pixel byte store is cast to uint8_t when the value may not fit, and
+    an operation whose result may not fit an int is done in int64_t.
+    Otherwise C's own conversions are exact, so no cast is written.
+    """
+
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        target = node.targets[0]
+        if (isinstance(target, ast.Subscript) and
+            not self._fits(node.value, 0, 0xff)):
+            node.value = ast.copy_location(Cast(node.value, c_uint8),
+                                           node.value)
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        ttype = getattr(node, 'ttype', None)
+        if (isinstance(ttype, TInt) and ttype.known and
+            not self._fits(node, -0x80000000, 0x7fffffff)):
+            int64 = TInt(*c_int_types[-1][1:])
+            node.left = ast.copy_location(Cast(node.left, int64), node.left)
+        return node
+
+    @staticmethod
+    def _fits(node, lo, hi):
+        ttype = getattr(node, 'ttype', None)
+        return isinstance(ttype, TInt) and ttype.fits(lo, hi)
+
+class Promoter(ast.NodeTransformer):
+    """Hold pixel bytes stored and then loaded again in locals
+
+    Pixel pointers may alias, so C loads a byte the function stored back
+    from memory; a fused template (see transform.Fuser) does so between
+    stages. Within each run of assignments, such a byte is instead loaded
+    into a local, _ARG_K, at the start of the run and stored from it at
+    the end. No local lives across an if, since C compilers then merge
+    both branches into one, and a well predicted branch is cheaper. Runs
+    on Caster output, so a local keeps the uint8_t conversion of the store
+    it replaces.
+    """
+
+    def visit_FunctionDef(self, node):
+        node.body = self._block(node.body)
+        return node
+
+    def _block(self, stmts):
+        body = []
+        run = []
+        for stmt in stmts + [None]:
+            if isinstance(stmt, ast.Assign):
+                run.append(stmt)
+                continue
+            body.extend(self._promote(run))
+            run = []
+            if isinstance(stmt, ast.If):
+                stmt.body = self._block(stmt.body)
+                stmt.orelse = self._block(stmt.orelse)
+            if stmt is not None:
+                body.append(stmt)
+        return body
+
+    def _promote(self, stmts):
+        # A run of assignments, with bytes loaded after a store in locals
+        self.promoted = OrderedDict()
+        stored = set()
+        for stmt in stmts:
+            for n in ast.walk(stmt.value):
+                if isinstance(n, ast.Subscript):
+                    key = ByteUses.key(n)
+                    if key in stored and key not in self.promoted:
+                        self.promoted[key] = '_{}_{}'.format(*key)
+            for t in stmt.targets:
+                if isinstance(t, ast.Subscript):
+                    stored.add(ByteUses.key(t))
+        if not self.promoted:
+            return stmts
+        loads = []
+        stores = []
+        for (arg, k), local in self.promoted.items():
+            loads.append(self._assign(self._name(local, ast.Store()),
+                                      self._byte(arg, k, ast.Load())))
+            stores.append(self._assign(self._byte(arg, k, ast.Store()),
+                                       self._name(local, ast.Load())))
+        return loads + [self.visit(stmt) for stmt in stmts] + stores
+
+    def visit_Subscript(self, node):
+        local = self.promoted.get(ByteUses.key(node))
+        if local is None:
+            return node
+        return ast.copy_location(self._name(local, node.ctx), node)
+
+    @staticmethod
+    def _name(local, ctx):
+        node = ast.Name(local, ctx)
+        node.ttype = c_uint8
+        return node
+
+    @staticmethod
+    def _byte(arg, k, ctx):
+        node = ast.Subscript(ast.Name(arg, ast.Load()),
+                             ast.Index(ast.Num(k)), ctx)
+        node.ttype = c_uint8
+        return node
+
+    @staticmethod
+    def _assign(target, value):
+        node = ast.Assign([target], value)
+        ast.fix_missing_locations(node)
+        return node
+
+class Tabler:
+    """Replace byte expressions of one or two bytes by table lookups
+
+    A pixel byte store, or a byte local, whose value depends on only one
+    or two bytes, and takes at least min_ops operations, is
+    evaluated for every input at compile time into a table of 256 or 65536
+    bytes, and written as lut_HASH[x] or lut_HASH[(x << 8) + y]. tables
+    maps each table name to its values; tables_code declares tables, each
+    under an include guard, so libraries written together share a table.
+
+    Runs on Promoter output. The function given is left as is, for the
+    vector loops: a table lookup per lane is slower than the arithmetic.
+    """
+
+    # Least operations worth a lookup, by input count: one load of a
+    # small table replaces a few operations, but a large table is mostly
+    # in L2 cache, not L1
+    min_ops = {1: 3, 2: 5}
+
+    def __init__(self):
+        self.tables = OrderedDict()
+
+    def visit(self, function):
+        function = copy.copy(function)
+        function.body = self._block(function.body)
+        return function
+
+    def _block(self, stmts):
+        body = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.If):
+                stmt = copy.copy(stmt)
+                stmt.body = self._block(stmt.body)
+                stmt.orelse = self._block(stmt.orelse)
+            elif (isinstance(stmt, ast.Assign) and
+                  self._is_byte(stmt.targets[0])):
+                value = self._lookup(stmt.value)
+                if value is not None:
+                    stmt = ast.copy_location(ast.Assign(stmt.targets, value),
+                                             stmt)
+            body.append(stmt)
+        return body
+
+    @staticmethod
+    def _is_byte(node):
+        # A pixel byte, or a local holding one
+        ttype = getattr(node, 'ttype', None)
+        return (isinstance(node, (ast.Subscript, ast.Name)) and
+                isinstance(ttype, TInt) and ttype.fits(0, 0xff))
+
+    def _lookup(self, value):
+        # The table lookup replacing value, or None
+        inputs = OrderedDict()
+        ops = 0
+        nodes = [value]
+        while nodes:
+            node = nodes.pop(0)
+            if isinstance(node, (ast.Subscript, ast.Name)):
+                if isinstance(node, ast.Name) and node.id in ('min', 'max'):
+                    continue
+                if not self._is_byte(node):
+                    return None
+                # A pixel load is an input, not its pointer and index
+                inputs.setdefault(ast.dump(node), node)
+                continue
+            nodes.extend(ast.iter_child_nodes(node))
+            if isinstance(node, ast.Call):
+                if not (isinstance(node.func, ast.Name) and
+                        node.func.id in ('min', 'max')):
+                    return None
+                ops += 1
+            elif isinstance(node, ast.BinOp):
+                ttype = getattr(node, 'ttype', None)
+                if not (isinstance(ttype, TInt) and ttype.known):
+                    return None
+                ops += 1
+        n = len(inputs)
+        if n not in self.min_ops or ops < self.min_ops[n]:
+            return None
+        values = self._evaluate(value, list(inputs))
+        name = 'lut_{}'.format(hashlib.sha1(values).hexdigest()[:16])
+        self.tables[name] = values
+        loads = list(inputs.values())
+        index = loads[0]
+        if n == 2:
+            index = ast.BinOp(ast.BinOp(loads[0], ast.LShift(), ast.Num(8)),
+                              ast.Add(), loads[1])
+        lookup = ast.Subscript(ast.Name(name, ast.Load()), ast.Index(index),
+                               ast.Load())
+        lookup.ttype = c_uint8
+        return ast.copy_location(lookup, value)
+
+    @staticmethod
+    def _evaluate(value, inputs):
+        # The bytes of value for every input, the first input major
+        names = {key: 'x{}'.format(i) for i, key in enumerate(inputs)}
+
+        class Evaluable(ast.NodeTransformer):
+            # value as a Python expression of x0 and x1
+            def visit_Subscript(self, node):
+                return ast.Name(names[ast.dump(node)], ast.Load())
+
+            def visit_Name(self, node):
+                key = ast.dump(node)
+                if key in names:
+                    return ast.Name(names[key], ast.Load())
+                return node
+
+            def visit_Cast(self, node):
+                value = self.visit(node.value)
+                if node.ttype is c_uint8:
+                    return ast.BinOp(value, ast.BitAnd(), ast.Num(0xff))
+                return value
+
+        expr = ast.parse('lambda x0, x1=0: 0', mode='eval')
+        expr.body.body = Evaluable().visit(copy.deepcopy(value))
+        ast.fix_missing_locations(expr)
+        f = eval(compile(expr, '<table>', 'eval'), {})
+        if len(inputs) == 1:
+            return bytes(f(x) & 0xff for x in range(256))
+        return bytes(f(x, y) & 0xff for x in range(256) for y in range(256))
+
+    @staticmethod
+    def tables_code(tables):
+        lines = []
+        for name, values in tables.items():
+            lines.append('#ifndef {}'.format(name.upper()))
+            lines.append('#define {}'.format(name.upper()))
+            lines.append('static const uint8_t {}[{}] = {{'.format(
+                name, len(values)))
+            for i in range(0, len(values), 16):
+                lines.append('    {},'.format(
+                    ', '.join(str(v) for v in values[i:i + 16])))
+            lines.append('};')
+            lines.append('#endif')
+            lines.append('')
+        return ''.join(line + '\n' for line in lines)
 
 class Writer(ast.NodeVisitor):
-    def __init__(self, ostream):
+    def __init__(self, ostream, qualifiers=''):
         self.ostream = ostream
+        self.qualifiers = qualifiers
         self.indent = ''
 
     def visit_FunctionDef(self, node):
@@ -18,10 +538,21 @@ class Writer(ast.NodeVisitor):
             c_returns = 'void'
         else:
             raise CompileError("unsupported C return type")
-        ostream.write('{}{} {}('.format(self.indent, c_returns, c_name))
+        ostream.write('{}{}{} {}('.format(self.indent, self.qualifiers,
+                                          c_returns, c_name))
         self.visit(node.args)
         ostream.write(') {\n')
         self.indent += '    '
+        local_names = LocalNames()
+        for stmt in node.body:
+            local_names.visit(stmt)
+        declarations = OrderedDict()
+        for id in local_names.ids:
+            c_type = c_int_type(local_names.types[id])
+            declarations.setdefault(c_type, []).append(id)
+        for c_type, ids in declarations.items():
+            ostream.write('{}{} {};\n'.format(self.indent, c_type,
+                                              ', '.join(ids)))
         for stmt in node.body:
             self.visit(stmt)
         self.indent = self.indent[0:-4]
@@ -40,7 +571,7 @@ class Writer(ast.NodeVisitor):
         if not isinstance(annotation, ast.Name):
             raise CompileError("Unsupported argument type")
         typ = annotation.id
-        if typ == 'RGBA':
+        if typ in ('RGBA', 'Mapped', 'Element'):
             self.ostream.write('unsigned char *')
         elif typ == 'int':
             self.ostream.write('int ')
@@ -53,12 +584,12 @@ class Writer(ast.NodeVisitor):
         self.ostream.write(self.indent)
         self.visit(targets[0])
         self.ostream.write(' = ')
-        do_cast = self._cast(node.value, targets[0])
-        if do_cast:
-            self.ostream.write('(')
         self.visit(node.value)
-        if do_cast:
-            self.ostream.write(')')
+        self.ostream.write(';\n')
+
+    def visit_Expr(self, node):
+        self.ostream.write(self.indent)
+        self.visit(node.value)
         self.ostream.write(';\n')
 
     def visit_If(self, node):
@@ -84,15 +615,29 @@ class Writer(ast.NodeVisitor):
         func = node.func
         if not isinstance(func, ast.Name):
             raise CompileError("Unable to handle non-name function id")
-        self.ostream.write('{}('.format(func.id))
-        for arg in node.args[0:-1]:
+        self._write_call(self._function(func.id, node.args), node.args)
+
+    def _function(self, name, args):
+        # The C function or macro called for name(*args)
+        return name
+
+    def _write_call(self, name, args):
+        self.ostream.write('{}('.format(name))
+        for arg in args[0:-1]:
             self.visit(arg)
             self.ostream.write(', ')
-        for arg in node.args[-1:]:
+        for arg in args[-1:]:
             self.visit(arg)
         self.ostream.write(')')
 
     def visit_BinOp(self, node):
+        if (isinstance(node.op, ast.FloorDiv) and
+            not (_at_least(node.left, 0) and _at_least(node.right, 1))):
+            # C's / truncates towards zero where Python's // rounds down,
+            # so it only floors when no operand is negative
+            args = [node.left, node.right]
+            self._write_call(self._function('FLOOR_DIV', args), args)
+            return
         self.ostream.write('(')
         self.generic_visit(node)
         self.ostream.write(')')
@@ -124,31 +669,1173 @@ class Writer(ast.NodeVisitor):
     def visit_Name(self, node):
         self.ostream.write(node.id)
 
+    def visit_Constant(self, node):
+        if not isinstance(node.value, int):
+            raise CompileError("Unsupported constant {}".format(node.value))
+        self.ostream.write('{}'.format(node.value))
+
+    # Python 3.7 and earlier
     def visit_Num(self, node):
         self.ostream.write('{}'.format(node.n))
 
-    def _cast(self, value, target):
-        # To implement later
-        self.ostream.write('/* cast */ ')
-        return True
+    def visit_Cast(self, node):
+        self.ostream.write('({})('.format(c_int_type(node.ttype)))
+        self.visit(node.value)
+        self.ostream.write(')')
+
+
+class SwarWriter:
+    """Write a function computing the bytes of two adjacent pixels at once
+
+    Matches a Coder output function whose statements each store byte k of
+    the same 4 byte pixel, all with one expression of bytes k: bytes
+    a[k], constants, and sums, either wrapped to a byte or saturated by
+    min(..., 255). For function NAME, writes NAME_pair, which computes the
+    expression for all 8 bytes of two pixels in a 64 bit word, SIMD within
+    a register (see swar_add), and merges the bytes stored into the
+    destination word. LoopWriter calls it for pairs of pixels, so loops
+    built without vector support still work on more than a byte at a time.
+    """
+
+    def __init__(self, ostream, qualifiers=''):
+        self.ostream = ostream
+        self.qualifiers = qualifiers
+
+    @classmethod
+    def match(cls, function, arg_types):
+        """Return (destination, byte indices, expression) for a function
+        written a word at a time, or None
+
+        The expression is a tree of ('byte', arg), ('const', value),
+        ('add', x, y) and ('adds', x, y) tuples.
+        """
+        types = {a.arg: t for a, t in zip(function.args.args, arg_types)}
+        dst = None
+        indices = []
+        expression = None
+        for stmt in function.body:
+            if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+                    isinstance(stmt.targets[0], ast.Subscript)):
+                return None
+            arg, k = ByteUses.key(stmt.targets[0])
+            if dst not in (None, arg) or k in indices:
+                return None
+            dst = arg
+            indices.append(k)
+            e = cls._expression(stmt.value, k, False)
+            if e is None or expression not in (None, e):
+                return None
+            expression = e
+        if expression is None:
+            return None
+        args = {dst} | {n[1] for n in cls._nodes(expression) if n[0] == 'byte'}
+        if not all(isinstance(types.get(a), RGBA) and types[a].stride == 4
+                   for a in args):
+            return None
+        return dst, indices, expression
+
+    @classmethod
+    def _expression(cls, node, k, saturated):
+        # The expression tree of node for byte k, or None
+        if isinstance(node, Cast):
+            if saturated or node.ttype is not c_uint8:
+                return None
+            return cls._expression(node.value, k, False)
+        if isinstance(node, ast.Subscript):
+            arg, i = ByteUses.key(node)
+            return ('byte', arg) if i == k else None
+        value = constant_value(node)
+        if isinstance(value, int):
+            return ('const', value) if 0 <= value <= 0xff else None
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left = cls._expression(node.left, k, saturated)
+            right = cls._expression(node.right, k, saturated)
+            if left is None or right is None:
+                return None
+            return ('adds' if saturated else 'add', left, right)
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id == 'min' and len(node.args) == 2 and
+            not saturated):
+            # Sums of bytes, which are not negative, saturate as they go
+            for x, y in (node.args, node.args[::-1]):
+                if constant_value(y) == 0xff:
+                    return cls._expression(x, k, True)
+        return None
+
+    @staticmethod
+    def _nodes(expression):
+        nodes = [expression]
+        for n in nodes:
+            nodes.extend(c for c in n[1:] if isinstance(c, tuple))
+        return nodes
+
+    def write(self, function, dst, indices, expression):
+        ostream = self.ostream
+        args = [a.arg for a in function.args.args]
+        loaded = {n[1] for n in self._nodes(expression) if n[0] == 'byte'}
+        ostream.write('{}void {}_pair({}) {{\n'.format(
+            self.qualifiers, function.name,
+            ', '.join('unsigned char *{}'.format(a) for a in args)))
+        whole = len(indices) == 4
+        if not whole:
+            mask = ' | '.join('(0xffu << BYTE_SHIFT({}))'.format(k)
+                              for k in sorted(indices))
+            ostream.write('    const uint64_t mask = (uint64_t)({}) * '
+                          '0x100000001ull;\n'.format(mask))
+        words = [a for a in args if a in loaded or a == dst]
+        ostream.write('    uint64_t {};\n'.format(
+            ', '.join('{}_w'.format(a) for a in words)))
+        for a in words:
+            if a in loaded or not whole:
+                ostream.write('    memcpy(&{0}_w, {0}, 8);\n'.format(a))
+        value = self._code(expression)
+        if whole:
+            ostream.write('    {}_w = {};\n'.format(dst, value))
+        else:
+            ostream.write('    {0}_w = ({1} & mask) | ({0}_w & ~mask);\n'
+                          .format(dst, value))
+        ostream.write('    memcpy({0}, &{0}_w, 8);\n'.format(dst))
+        ostream.write('}\n')
+
+    def _code(self, expression):
+        kind = expression[0]
+        if kind == 'byte':
+            return '{}_w'.format(expression[1])
+        if kind == 'const':
+            return '{:#x}ull'.format(expression[1] * 0x0101010101010101)
+        func = 'swar_adds' if kind == 'adds' else 'swar_add'
+        return '{}({}, {})'.format(func, self._code(expression[1]),
+                                   self._code(expression[2]))
+
+
+# Template argument ttypes to C target types, with their default formats
+target_types = [
+    (TPixel, RGBA, 'rgba'),
+    (TSurface, Mapped, 4),
+    (TArray, Element, 4),
+    ]
+
+def target_type(ttype, fmt=None):
+    """Return the C target type of a template argument ttype"""
+    for ttype_class, target_class, default in target_types:
+        if isinstance(ttype, ttype_class):
+            if fmt is None:
+                fmt = default
+            if target_class is RGBA:
+                return RGBA(c_uint8, fmt)
+            return target_class(fmt)
+    raise CompileError("No C type for {}".format(ttype))
+
+class LoopWriter:
+    """Write the row/pixel loop entry point of a per-pixel function
+
+    For function NAME, taking one pixel pointer per argument, writes
+
+        void NAME_loop(unsigned char *s_pixels, ptrdiff_t s_stride,
+                       ptrdiff_t s_pitch, ..., int width, int height)
+
+    which calls NAME for each pixel of a width x height area. A stride is
+    the byte distance between horizontally adjacent pixels, a pitch that
+    between rows. When the target type has a fixed stride the argument is
+    ignored in favour of the constant. The last argument is the
+    destination.
+
+    Fixed stride pixels are stored row by row, but a run time strided
+    argument, such as a pygame.surfarray array, may be stored column by
+    column. Walking both a row at a time would then miss the cache on
+    every pixel of that argument, so such a call walks the area in
+    PIXEL_TILE square tiles instead.
+
+    pair names a function of two adjacent pixels (see SwarWriter), called
+    for each pair of a row before NAME finishes it.
+    """
+
+    def __init__(self, ostream):
+        self.ostream = ostream
+
+    @staticmethod
+    def params(arg_names):
+        params = []
+        for arg in arg_names:
+            params.append('unsigned char *{}_pixels'.format(arg))
+            params.append('ptrdiff_t {}_stride'.format(arg))
+            params.append('ptrdiff_t {}_pitch'.format(arg))
+        params.extend(['int width', 'int height'])
+        return ', '.join(params)
+
+    def write(self, name, arg_names, arg_types, loop_name=None,
+              qualifiers='', pair=None):
+        ostream = self.ostream
+        params = self.params(arg_names)
+        if loop_name is None:
+            loop_name = '{}_loop'.format(name)
+        strided = [a for a, t in zip(arg_names, arg_types) if t.stride is None]
+        tiled = '{}_tiled'.format(loop_name)
+        if strided:
+            self._write_tiled(name, arg_names, arg_types, tiled)
+            ostream.write('\n')
+        ostream.write('{}void {}({}) {{\n'.format(qualifiers, loop_name,
+                                                 params))
+        ostream.write('    int x, y;\n')
+        if strided:
+            call_args = ', '.join(
+                ['{0}_pixels, {0}_stride, {0}_pitch'.format(a)
+                 for a in arg_names] + ['width', 'height'])
+            test = ' || '.join('walks_columns({0}_stride, {0}_pitch)'.format(a)
+                               for a in strided)
+            ostream.write('    if (height > 1 && ({})) {{\n'.format(test))
+            ostream.write('        {}({});\n'.format(tiled, call_args))
+            ostream.write('        return;\n')
+            ostream.write('    }\n')
+        ostream.write('    for (y = 0; y < height; ++y) {\n')
+        for arg in arg_names:
+            ostream.write('        unsigned char *{0} = {0}_pixels + '
+                          'y * {0}_pitch;\n'.format(arg))
+        strides = []
+        for arg, typ in zip(arg_names, arg_types):
+            stride = typ.stride
+            if stride is None:
+                stride = '{}_stride'.format(arg)
+            strides.append((arg, stride))
+        start = 'x = 0'
+        if pair is not None:
+            start = ''
+            ostream.write('        for (x = 0; x + 2 <= width; x += 2) {\n')
+            ostream.write('            {}({});\n'.format(pair,
+                                                        ', '.join(arg_names)))
+            for arg, stride in strides:
+                ostream.write('            {} += 2 * {};\n'.format(arg,
+                                                                   stride))
+            ostream.write('        }\n')
+        ostream.write('        for ({}; x < width; ++x) {{\n'.format(start))
+        ostream.write('            {}({});\n'.format(name,
+                                                    ', '.join(arg_names)))
+        for arg, stride in strides:
+            ostream.write('            {} += {};\n'.format(arg, stride))
+        ostream.write('        }\n')
+        ostream.write('    }\n')
+        ostream.write('}\n')
+
+    def _write_tiled(self, name, arg_names, arg_types, loop_name):
+        ostream = self.ostream
+        ostream.write('static void {}({}) {{\n'.format(loop_name,
+                                                      self.params(arg_names)))
+        ostream.write('    int tx, ty, x, y, x_end, y_end;\n')
+        ostream.write('    for (ty = 0; ty < height; ty += PIXEL_TILE) {\n')
+        ostream.write('        y_end = min(ty + PIXEL_TILE, height);\n')
+        ostream.write('        for (tx = 0; tx < width; tx += PIXEL_TILE) {\n')
+        ostream.write('            x_end = min(tx + PIXEL_TILE, width);\n')
+        ostream.write('            for (y = ty; y < y_end; ++y) {\n')
+        strides = []
+        for arg, typ in zip(arg_names, arg_types):
+            stride = typ.stride
+            if stride is None:
+                stride = '{}_stride'.format(arg)
+            strides.append((arg, stride))
+            ostream.write('                unsigned char *{0} = {0}_pixels + '
+                          'y * {0}_pitch + tx * {1};\n'.format(arg, stride))
+        ostream.write('                for (x = tx; x < x_end; ++x) {\n')
+        ostream.write('                    {}({});\n'.format(
+                      name, ', '.join(arg_names)))
+        for arg, stride in strides:
+            ostream.write('                    {} += {};\n'.format(arg,
+                                                                   stride))
+        ostream.write('                }\n')
+        ostream.write('            }\n')
+        ostream.write('        }\n')
+        ostream.write('    }\n')
+        ostream.write('}\n')
+
+
+class VectorWriter(Writer):
+    """Write a per-pixel function body as code for lanes pixels at once
+
+    Each pixel byte, and each local variable, becomes a vector of lanes
+    32 bit integers, one per pixel, using GCC vector extensions. Every
+    assignment defines a new vector, so an if statement runs both branches
+    and merges what they assigned under the test mask. Stores are packed
+    back into the 32 bit pixel words loaded, keeping unwritten bytes.
+    """
+
+    # The forms of functions taking a vector argument
+    vector_functions = {'min': 'VMIN', 'FLOOR_DIV': 'VFLOOR_DIV'}
+
+    def __init__(self, ostream, lanes, indent):
+        Writer.__init__(self, ostream)
+        self.lanes = lanes
+        self.vtype = 'pixel_i{}'.format(lanes)
+        self.wtype = 'pixel_u{}'.format(lanes)
+        self.indent = indent
+        self.values = OrderedDict()
+        self._count = 0
+
+    def write(self, function):
+        """Write the body of the Coder output function"""
+        uses = ByteUses()
+        uses.visit(function)
+        indent = self.indent
+        vtype = self.vtype
+        ostream = self.ostream
+        size = 4 * self.lanes
+        args = [a.arg for a in function.args.args]
+        for arg in args:
+            if (arg in uses.loads or arg in uses.stores):
+                ostream.write('{}{} {}_w;\n'.format(indent, self.wtype, arg))
+                ostream.write('{0}memcpy(&{1}_w, {1}, {2});\n'.format(
+                              indent, arg, size))
+            for k in sorted(uses.loads.get(arg, ())):
+                name = self._new_name()
+                ostream.write('{}{} {} = ({})(({}_w >> BYTE_SHIFT({})) & '
+                              '0xff);\n'.format(indent, vtype, name, vtype,
+                                                 arg, k))
+                self.values[(arg, k)] = name
+        for stmt in function.body:
+            self.visit(stmt)
+        for arg in args:
+            stored = sorted(uses.stores.get(arg, ()))
+            if not stored:
+                continue
+            keep = ' & '.join('~(0xffu << BYTE_SHIFT({}))'.format(k)
+                              for k in stored)
+            parts = ['({}_w & ({}))'.format(arg, keep)]
+            for k in stored:
+                parts.append('((({})({}) & 0xff) << BYTE_SHIFT({}))'.format(
+                             self.wtype, self.values[(arg, k)], k))
+            ostream.write('{}{}_w = {};\n'.format(indent, arg,
+                                                  ' | '.join(parts)))
+            ostream.write('{0}memcpy({1}, &{1}_w, {2});\n'.format(indent,
+                                                                  arg, size))
+
+    def visit_Cast(self, node):
+        # Lanes are stored masked to a byte, and wider casts not vectorized
+        self.visit(node.value)
+
+    def _new_name(self):
+        name = 'v{}'.format(self._count)
+        self._count += 1
+        return name
+
+    def _expression(self, node):
+        ostream = self.ostream
+        self.ostream = StringIO()
+        try:
+            self.visit(node)
+            return self.ostream.getvalue()
+        finally:
+            self.ostream = ostream
+
+    def _define(self, value):
+        name = self._new_name()
+        self.ostream.write('{}{} {} = ({}){{0}} + ({});\n'.format(
+                           self.indent, self.vtype, name, self.vtype, value))
+        return name
+
+    def visit_Assign(self, node):
+        targets = node.targets
+        if len(targets) > 1:
+            raise CompileError("Multiple assignment unsupported")
+        target = targets[0]
+        value = self._define(self._expression(node.value))
+        if isinstance(target, ast.Subscript):
+            self.values[self._byte_key(target)] = value
+        elif isinstance(target, ast.Name):
+            if isinstance(node.value, Cast):
+                # A Promoter local reads back as the byte stored would
+                value = self._define('{} & 0xff'.format(value))
+            self.values[target.id] = value
+        else:
+            raise CompileError("Unsupported assignment target")
+
+    def visit_If(self, node):
+        test = self._expression(node.test)
+        if not self._is_vector(node.test):
+            # A scalar comparison is 0 or 1, a vector one the 0 or -1 mask
+            test = self._define(test)
+        mask = self._define('({}) != 0'.format(test))
+        before = self.values
+        self.values = OrderedDict(before)
+        for stmt in node.body:
+            self.visit(stmt)
+        body_values = self.values
+        self.values = OrderedDict(before)
+        for stmt in node.orelse:
+            self.visit(stmt)
+        else_values = self.values
+        self.values = OrderedDict()
+        # In a fixed order, so the code is the same whatever the hash seed
+        keys = list(body_values)
+        keys += [key for key in else_values if key not in body_values]
+        for key in keys:
+            b = body_values.get(key)
+            e = else_values.get(key)
+            if b is None or e is None or b == e:
+                self.values[key] = e if b is None else b
+            else:
+                self.values[key] = self._define(
+                    '({0} & {1}) | (~{0} & {2})'.format(mask, b, e))
+
+    def _function(self, name, args):
+        # Vector forms mask with comparisons, which are 0 or -1 only for
+        # vectors, so they are not written for all scalar arguments
+        if any(self._is_vector(arg) for arg in args):
+            return self.vector_functions.get(name, name)
+        return name
+
+    def _is_vector(self, node):
+        # Pixel bytes, and the locals defined from them, are vectors
+        for n in ast.walk(node):
+            if isinstance(n, ast.Subscript):
+                return True
+            if isinstance(n, ast.Name) and n.id in self.values:
+                return True
+        return False
+
+    def visit_Subscript(self, node):
+        self.ostream.write(self.values[self._byte_key(node)])
+
+    def visit_Name(self, node):
+        self.ostream.write(self.values.get(node.id, node.id))
+
+    @staticmethod
+    def _byte_key(node):
+        return node.value.id, subscript_index(node)
+
+def subscript_index(node):
+    """Return the constant index of a Coder Subscript node"""
+    index = node.slice
+    if isinstance(index, ast.Index):  # Python 3.8 and earlier
+        index = index.value
+    if isinstance(index, ast.Constant):
+        return index.value
+    return index.n
+
+class ByteUses(ast.NodeVisitor):
+    """Collect the pixel bytes a Coder output function loads and stores
+
+    A byte is loaded when it is read before it is stored, or when it is
+    stored under a condition, keeping its loaded value otherwise. A byte
+    read only after an unconditional store to it is not.
+    """
+
+    def __init__(self):
+        self.loads = {}
+        self.stores = {}
+        self._stored = set()
+        self._depth = 0
+
+    @staticmethod
+    def key(node):
+        """Return the (argument, byte index) of a Coder Subscript node"""
+        return node.value.id, subscript_index(node)
+
+    def visit_Subscript(self, node):
+        arg, k = node.value.id, subscript_index(node)
+        if isinstance(node.ctx, ast.Store):
+            self.stores.setdefault(arg, set()).add(k)
+            if not self._depth:
+                self._stored.add((arg, k))
+        elif (arg, k) not in self._stored:
+            self.loads.setdefault(arg, set()).add(k)
+        self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for t in node.targets:
+            if isinstance(t, ast.Subscript) and self._depth:
+                arg, k = t.value.id, subscript_index(t)
+                if (arg, k) not in self._stored:
+                    self.loads.setdefault(arg, set()).add(k)
+            self.visit(t)
+
+    def visit_If(self, node):
+        self.visit(node.test)
+        self._depth += 1
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+        self._depth -= 1
+
+def fits_lanes(function):
+    """Return True if every value of a Coder output function is known to
+    fit a 32 bit vector lane"""
+    ranges = []
+    def collect(node):
+        if isinstance(node, ast.Subscript):
+            ranges.append(node.ttype)  # not the constant index
+            return
+        if isinstance(node, ast.Call):
+            ranges.append(getattr(node, 'ttype', None))
+            for arg in node.args:
+                collect(arg)
+            return
+        if isinstance(node, ast.expr) and not isinstance(node, Cast):
+            ranges.append(getattr(node, 'ttype', None))
+        for child in ast.iter_child_nodes(node):
+            collect(child)
+    for stmt in function.body:
+        collect(stmt)
+    return all(isinstance(t, TInt) and t.fits(-0x80000000, 0x7fffffff)
+               for t in ranges)
+
+class VectorLoopWriter:
+    """Write SIMD loops for a per-pixel function and pick one at load time
+
+    Only templates whose arguments are all 4 byte RGBA pixels, and whose
+    values all have a known range fitting a 32 bit lane (see fits_lanes),
+    are vectorized. On x86 an AVX2 loop of 8 pixels, an SSE2 loop of 4 and
+    the scalar loop are written; a constructor run when the library is
+    loaded points NAME_loop at the best the CPU supports. Other GCC
+    compatible compilers get a generic 4 pixel loop. Rows are finished,
+    and vectorless builds run, with the scalar loop.
+    """
+
+    targets = [('avx2', 8), ('sse2', 4)]
+
+    def __init__(self, ostream):
+        self.ostream = ostream
+
+    @staticmethod
+    def can_vectorize(arg_types, function=None):
+        if not all(isinstance(t, RGBA) and t.stride == 4 for t in arg_types):
+            return False
+        return function is None or fits_lanes(function)
+
+    def write(self, name, function, arg_names, arg_types, loop_name=None,
+              qualifiers='', pair=None):
+        ostream = self.ostream
+        params = LoopWriter.params(arg_names)
+        if loop_name is None:
+            loop_name = '{}_loop'.format(name)
+        call_args = ', '.join(
+            ['{0}_pixels, {0}_stride, {0}_pitch'.format(a)
+             for a in arg_names] + ['width', 'height'])
+        scalar = '{}_loop_scalar'.format(name)
+        LoopWriter(ostream).write(name, arg_names, arg_types, scalar,
+                                  'static ', pair)
+        ostream.write('\n#ifdef PIXEL_X86\n')
+        for target, lanes in self.targets:
+            ostream.write('\n__attribute__((target("{}")))\n'.format(target))
+            self._write_vector_loop(name, function, arg_names, lanes,
+                                    '{}_loop_{}'.format(name, target))
+        impl = '{}_run'.format(name)
+        ostream.write('\nstatic void (*{})({}) = {};\n'.format(impl, params,
+                                                              scalar))
+        ostream.write('\n__attribute__((constructor))\n')
+        ostream.write('static void {}_init(void) {{\n'.format(name))
+        ostream.write('    __builtin_cpu_init();\n')
+        keyword = '    if'
+        for target, lanes in self.targets:
+            ostream.write('{} (__builtin_cpu_supports("{}")) {{\n'.format(
+                          keyword, target))
+            ostream.write('        {} = {}_loop_{};\n'.format(impl, name,
+                                                              target))
+            ostream.write('    }')
+            keyword = ' else if'
+        ostream.write('\n}\n')
+        ostream.write('#elif defined(PIXEL_SIMD)\n')
+        vec4 = '{}_loop_vec4'.format(name)
+        self._write_vector_loop(name, function, arg_names, 4, vec4)
+        ostream.write('#define {} {}\n'.format(impl, vec4))
+        ostream.write('#else\n')
+        ostream.write('#define {} {}\n'.format(impl, scalar))
+        ostream.write('#endif\n\n')
+        ostream.write('{}void {}({}) {{\n'.format(qualifiers, loop_name,
+                                                 params))
+        ostream.write('    {}({});\n'.format(impl, call_args))
+        ostream.write('}\n')
+
+    def _write_vector_loop(self, name, function, arg_names, lanes, loop_name):
+        ostream = self.ostream
+        params = LoopWriter.params(arg_names)
+        ostream.write('static void {}({}) {{\n'.format(loop_name, params))
+        ostream.write('    int x, y;\n')
+        ostream.write('    for (y = 0; y < height; ++y) {\n')
+        for arg in arg_names:
+            ostream.write('        unsigned char *{0} = {0}_pixels + '
+                          'y * {0}_pitch;\n'.format(arg))
+        ostream.write('        for (x = 0; x + {0} <= width; x += {0}) {{\n'
+                      .format(lanes))
+        VectorWriter(ostream, lanes, ' ' * 12).write(function)
+        for arg in arg_names:
+            ostream.write('            {} += {};\n'.format(arg, 4 * lanes))
+        ostream.write('        }\n')
+        ostream.write('        for (; x < width; ++x) {\n')
+        ostream.write('            {}({});\n'.format(name,
+                                                    ', '.join(arg_names)))
+        for arg in arg_names:
+            ostream.write('            {} += 4;\n'.format(arg))
+        ostream.write('        }\n')
+        ostream.write('    }\n')
+        ostream.write('}\n')
+
+
+class SpanLoopWriter:
+    """Write a blitter loop passing over runs of transparent or opaque
+    source pixels
+
+    For a blitter NAME(s, d) of a 4 byte source pixel with alpha, each row
+    is split into blocks of SPAN_BLOCK pixels, classed a pixel word at a
+    time by their source alpha: all 0 (transparent), all 255 (opaque) or
+    mixed. A run of mixed blocks goes to the blend loop, NAME_blend. A run
+    of opaque blocks goes to the loop of NAME_opaque, the template
+    specialized for s.a == 255 (see transform.Specializer), or to memcpy
+    when that copies s. A run of transparent blocks likewise goes to the
+    loop of NAME_transparent, or nowhere when that stores nothing.
+
+    Also written are
+
+        void NAME_spans(unsigned char *s_pixels, ptrdiff_t s_stride,
+                        ptrdiff_t s_pitch, int width, int height,
+                        unsigned char *index)
+
+    storing the class of each block, (width + SPAN_BLOCK - 1) / SPAN_BLOCK
+    a row, and NAME_loop_indexed, taking that index after the NAME_loop
+    arguments, which reads block classes from the index instead.
+    """
+
+    def __init__(self, ostream):
+        self.ostream = ostream
+
+    @staticmethod
+    def can_skip(arg_names, arg_types):
+        """Return True if blocks of the first argument can be classed"""
+        return (len(arg_names) == 2 and
+                all(isinstance(t, RGBA) for t in arg_types) and
+                arg_types[0].stride == 4 and 'a' in arg_types[0].order)
+
+    @staticmethod
+    def copies(compiler):
+        """Return True if compiler's function copies the source pixel
+        bytes to the destination, for the plane values it assumes"""
+        src, dst = compiler.arg_names
+        src_type, dst_type = compiler.arg_types
+        if dst_type.stride != 4:
+            return False
+        assumed = {src_type.order.index(plane): value
+                   for (arg, plane), value in compiler.assume.items()
+                   if arg == src and plane in src_type.order}
+        stored = set()
+        for stmt in compiler.function.body:
+            if not (isinstance(stmt, ast.Assign) and
+                    isinstance(stmt.targets[0], ast.Subscript) and
+                    stmt.targets[0].value.id == dst):
+                return False
+            k = subscript_index(stmt.targets[0])
+            value = stmt.value
+            if isinstance(value, ast.Subscript):
+                if value.value.id != src or subscript_index(value) != k:
+                    return False
+            elif k not in assumed or constant_value(value) != assumed[k]:
+                return False
+            stored.add(k)
+        return stored == {0, 1, 2, 3}
+
+    def write(self, name, arg_names, arg_types, opaque, transparent):
+        ostream = self.ostream
+        src, dst = arg_names
+        dst_stride = arg_types[1].stride
+        alpha = arg_types[0].order.index('a')
+        params = LoopWriter.params(arg_names)
+        call_args = ', '.join(
+            ['{0}_pixels, {0}_stride, {0}_pitch'.format(a)
+             for a in arg_names] + ['width', 'height'])
+        run = ('{{}}({0}, 4, {0}_pitch, {1}, {1}_stride, {1}_pitch, n, 1);'
+               .format(src, dst))
+        runs = {'SPAN_MIXED': run.format(name + '_blend')}
+        for cls, compiler in [('SPAN_OPAQUE', opaque),
+                              ('SPAN_TRANSPARENT', transparent)]:
+            if self.copies(compiler):
+                runs[cls] = 'memcpy({}, {}, 4 * n);'.format(dst, src)
+            elif compiler.function.body:
+                compiler.write_loop(ostream, 'static ')
+                ostream.write('\n')
+                runs[cls] = run.format(compiler.name + '_loop')
+
+        rows = '{}_span_rows'.format(name)
+        lines = [
+            'static void {}({}, const unsigned char *index) {{'.format(rows,
+                                                                   params),
+            '    const uint32_t mask = 0xffu << BYTE_SHIFT({});'.format(alpha),
+            '    int blocks = (width + SPAN_BLOCK - 1) / SPAN_BLOCK;',
+            '    int y, c, count, b, e, n, cls = SPAN_MIXED, runs;',
+            '    int skip = 0, backoff = 0;',
+            '    unsigned char buffer[SPAN_CHUNK];',
+            '    const unsigned char *classes;',
+            '    for (y = 0; y < height; ++y) {',
+            '        unsigned char *{0}_row = {0}_pixels + '
+            'y * {0}_pitch;'.format(src),
+            '        unsigned char *{0}_row = {0}_pixels + '
+            'y * {0}_pitch;'.format(dst),
+            '        for (c = 0; c < blocks; c += SPAN_CHUNK) {',
+            '            count = min(SPAN_CHUNK, blocks - c);',
+            '            if (index) {',
+            '                classes = index + (ptrdiff_t)y * blocks + c;',
+            '            } else if (skip) {',
+            '                --skip;',
+            '                classes = NULL;',
+            '            } else {',
+            '                span_classes({}_row + 4 * SPAN_BLOCK * c,'.format(
+                src),
+            '                             min(width - SPAN_BLOCK * c, '
+            'SPAN_BLOCK * SPAN_CHUNK),',
+            '                             mask, buffer);',
+            '                classes = buffer;',
+            '            }',
+            '            runs = 0;',
+            '            for (b = 0; b < count; b = e) {',
+            '                if (classes) {',
+            '                    cls = classes[b];',
+            '                    for (e = b + 1; e < count && '
+            'classes[e] == cls; ++e) {',
+            '                    }',
+            '                } else {',
+            '                    cls = SPAN_MIXED;',
+            '                    e = count;',
+            '                }',
+            '                ++runs;',
+            '                n = min((c + e) * SPAN_BLOCK, width) - '
+            '(c + b) * SPAN_BLOCK;',
+            '                unsigned char *{0} = {0}_row + 4 * (c + b) * '
+            'SPAN_BLOCK;'.format(src),
+            '                unsigned char *{0} = {0}_row + {1} * (c + b) * '
+            'SPAN_BLOCK;'.format(dst, dst_stride),
+            ]
+        keyword = '                if'
+        for cls in ['SPAN_MIXED', 'SPAN_OPAQUE', 'SPAN_TRANSPARENT']:
+            if cls not in runs:
+                continue
+            lines.append('{} (cls == {}) {{'.format(keyword, cls))
+            lines.append('                    ' + runs[cls])
+            keyword = '                } else if'
+        lines.extend([
+            '                }',
+            '            }',
+            '            if (classes == buffer) {',
+            '                /* Class less often while there is nothing to '
+            'skip */',
+            '                if (runs == 1 && cls == SPAN_MIXED) {',
+            '                    backoff = min(2 * backoff + 1, '
+            'SPAN_BACKOFF);',
+            '                    skip = backoff;',
+            '                } else {',
+            '                    backoff = 0;',
+            '                }',
+            '            }',
+            '        }',
+            '    }',
+            '}',
+            ''])
+        for line in lines:
+            ostream.write(line + '\n')
+
+        ostream.write('void {}_loop({}) {{\n'.format(name, params))
+        ostream.write('    {}({}, NULL);\n'.format(rows, call_args))
+        ostream.write('}\n\n')
+        ostream.write('void {}_loop_indexed({}, const unsigned char *index) '
+                      '{{\n'.format(name, params))
+        ostream.write('    {}({}, index);\n'.format(rows, call_args))
+        ostream.write('}\n\n')
+
+        ostream.write('void {0}_spans(unsigned char *{1}_pixels, '
+                      'ptrdiff_t {1}_stride, ptrdiff_t {1}_pitch, int width, '
+                      'int height, unsigned char *index) {{\n'.format(name,
+                                                                      src))
+        ostream.write('    const uint32_t mask = 0xffu << BYTE_SHIFT({});\n'
+                      .format(alpha))
+        ostream.write('    int blocks = (width + SPAN_BLOCK - 1) / '
+                      'SPAN_BLOCK;\n')
+        ostream.write('    int y;\n')
+        ostream.write('    for (y = 0; y < height; ++y) {\n')
+        ostream.write('        span_classes({0}_pixels + y * {0}_pitch, '
+                      'width, mask,\n'.format(src))
+        ostream.write('                     index + (ptrdiff_t)y * blocks);\n')
+        ostream.write('    }\n')
+        ostream.write('}\n')
+
+
+class BatchWriter:
+    """Write a blitter entry point running many blits in one call
+
+        void NAME_batch(const ptrdiff_t *blits, int count)
+
+    calls NAME_loop for each of count records of its arguments: a pixel
+    address, stride and pitch per template argument, then width and
+    height. The records are run in order, so later blits draw over
+    earlier ones.
+    """
+
+    def __init__(self, ostream):
+        self.ostream = ostream
+
+    @staticmethod
+    def record_size(arg_names):
+        return 3 * len(arg_names) + 2
+
+    def write(self, name, arg_names):
+        ostream = self.ostream
+        args = []
+        for i in range(len(arg_names)):
+            args.extend(['(unsigned char *)blits[{}]'.format(3 * i),
+                         'blits[{}]'.format(3 * i + 1),
+                         'blits[{}]'.format(3 * i + 2)])
+        size = self.record_size(arg_names)
+        args.extend(['(int)blits[{}]'.format(size - 2),
+                     '(int)blits[{}]'.format(size - 1)])
+        ostream.write('void {}_batch(const ptrdiff_t *blits, int count) '
+                      '{{\n'.format(name))
+        ostream.write('    int i;\n')
+        ostream.write('    for (i = 0; i < count; ++i, blits += {}) {{\n'
+                      .format(size))
+        ostream.write('        {}_loop({});\n'.format(name, ', '.join(args)))
+        ostream.write('    }\n')
+        ostream.write('}\n')
+
+
+class StatsWriter:
+    """Write the PIXEL_STATS instrumentation of loop entry points
+
+    In a library built with -DPIXEL_STATS, begin renames each entry point
+    ENTRY written after it to ENTRY_measured, and end writes ENTRY as a
+    wrapper adding each call to the pixel_stats ENTRY_stats: the call, its
+    pixels, the bytes of those pixels, summed over the arguments, and the
+    nanoseconds taken. build_c.Kernel.get_stats reads them. Otherwise the
+    preprocessor drops it all, leaving the loops as they were.
+    """
+
+    def __init__(self, ostream):
+        self.ostream = ostream
+
+    @staticmethod
+    def entries(name, spans):
+        """Return the (entry point, extra parameters, extra arguments) of
+        a loop"""
+        entries = [('{}_loop'.format(name), '', '')]
+        if spans:
+            entries.append(('{}_loop_indexed'.format(name),
+                            ', const unsigned char *index', ', index'))
+        return entries
+
+    def begin(self, entries):
+        ostream = self.ostream
+        ostream.write('#ifdef PIXEL_STATS\n')
+        for entry, params, args in entries:
+            ostream.write('#define {0} {0}_measured\n'.format(entry))
+        ostream.write('#endif\n\n')
+
+    def end(self, entries, arg_names, arg_types):
+        ostream = self.ostream
+        pixel_bytes = sum(t.itemsize if t.stride is None else t.stride
+                          for t in arg_types)
+        loop_params = LoopWriter.params(arg_names)
+        loop_args = ', '.join(['{0}_pixels, {0}_stride, {0}_pitch'.format(a)
+                               for a in arg_names] + ['width', 'height'])
+        ostream.write('#ifdef PIXEL_STATS\n')
+        for entry, params, args in entries:
+            params = loop_params + params
+            call_args = loop_args + args
+            ostream.write('#undef {}\n'.format(entry))
+            ostream.write('pixel_stats {}_stats;\n\n'.format(entry))
+            ostream.write('void {}({}) {{\n'.format(entry, params))
+            ostream.write('    uint64_t start = pixel_clock();\n')
+            ostream.write('    uint64_t pixels = (uint64_t)width * '
+                          '(uint64_t)height;\n')
+            ostream.write('    {}_measured({});\n'.format(entry, call_args))
+            ostream.write('    pixel_count(&{}_stats, pixels, pixels * {}, '
+                          'start);\n'.format(entry, pixel_bytes))
+            ostream.write('}\n\n')
+        ostream.write('#endif\n')
 
 
 class Compiler:
-    def __init__(self, src):
-        from io import StringIO
-        from transform import Typer, Degrouper
+    """Compile a template to C
+
+    formats maps template argument names to compile time formats: a byte
+    order string (see buffers.PixelBuffer) for a blit.Pixel argument, a
+    byte size for a pixels.Surface or pixels.PixelArray argument. Unlisted
+    arguments get a default format. name renames the C function. macros
+    maps names to the @macro function definitions the template can call
+    besides its own (see transform.Typer), by default blit.py's. code is
+    the per-pixel function, with a SwarWriter pixel pair function, named
+    by pair, when one matches; library_code a complete C translation unit
+    adding PRELUDE, the lookup tables and the LoopWriter entry point.
+    tables maps the name of each table of code, and of the span loops, to
+    its values (see Tabler). timings maps each compiler pass, in order, to
+    the seconds it took.
+
+    assume maps (argument, plane) pairs to values they are compiled for
+    (see transform.Specializer). Unless spans is False, a blitter of a
+    source with alpha that specializes to a cheaper function for
+    transparent or opaque source pixels gets a SpanLoopWriter loop. An
+    exported blitter loop also gets a BatchWriter entry point. Unless
+    tables is False, the per-pixel function looks up byte expressions of
+    one or two bytes in tables (see Tabler).
+    """
+
+    def __init__(self, src, formats=None, name=None, simd=True, assume=None,
+                 spans=True, macros=None, tables=True):
+        from transform import (Typer, Reducer, imported_macros, lower,
+                               template_function)
         from rgba import Coder
 
+        if formats is None:
+            formats = {}
+        if assume is None:
+            assume = {}
+        if macros is None:
+            # Templates are exec'd in blit.py, so see its macros
+            macros = imported_macros('blit')
         self.src = src
-        self.ast = ast.parse(src, '<str>', 'exec')
-        self.typer = Typer()
-        self.typer.visit(self.ast)
-        self.degrouper = Degrouper()
-        self.ast = self.degrouper.visit(self.ast)
-        symtab = {'s': RGBA(c_uint8), 'd': RGBA(c_uint8), 'p': RGBA(c_uint8)}
+        self.simd = simd
+        self.assume = assume
+        self.timings = OrderedDict()
+        self.ast, self.typer = lower(src, macros, assume, self.timings)
+        start = perf_counter()
+        func = template_function(self.ast)
+        # Retype the lowered function for the value ranges of its nodes
+        Typer().visit(func)
+        start = self._timed('ranges', start)
+        func = Reducer().visit(func)
+        start = self._timed('reducer', start)
+        self.template_name = func.name
+        self.name = self.template_name if name is None else name
+        func.name = self.name
+        self.arg_names = [a.arg for a in func.args.args]
+        self.arg_types = [target_type(self.typer.symtab[a], formats.get(a))
+                          for a in self.arg_names]
+        symtab = dict(zip(self.arg_names, self.arg_types))
         self.coder = Coder(symtab)
-        self.ast = self.coder.visit(self.ast)
+        self.function = self.coder.visit(func)
+        start = self._timed('coder', start)
+        self.function = Caster().visit(self.function)
+        start = self._timed('caster', start)
+        self.function = Promoter().visit(self.function)
+        start = self._timed('promoter', start)
+        scalar = self.function
+        self.tables = OrderedDict()
+        if tables:
+            tabler = Tabler()
+            scalar = tabler.visit(self.function)
+            self.tables.update(tabler.tables)
+            start = self._timed('tabler', start)
         self.ostream = StringIO()
-        self.writer = Writer(self.ostream)
-        self.writer.visit(self.ast)
+        # Static, so the loop can inline it in a position independent build
+        self.writer = Writer(self.ostream, 'static inline ')
+        self.writer.visit(scalar)
+        self.pair = None
+        swar = SwarWriter.match(self.function, self.arg_types)
+        if swar is not None:
+            self.ostream.write('\n')
+            SwarWriter(self.ostream, 'static inline ').write(self.function,
+                                                             *swar)
+            self.pair = '{}_pair'.format(self.name)
         self.code = self.ostream.getvalue()
+        start = self._timed('writer', start)
+        self.span_compilers = None
+        if spans and not assume:
+            self.span_compilers = self._specialize(src, formats, macros,
+                                                   tables)
+            for compiler in self.span_compilers or ():
+                self.tables.update(compiler.tables)
+            start = self._timed('spans', start)
+        self.ostream = StringIO()
+        self.ostream.write(PRELUDE)
+        self.ostream.write('\n')
+        self.ostream.write(Tabler.tables_code(self.tables))
+        self.write_loop(self.ostream)
+        self.library_code = self.ostream.getvalue()
+        self._timed('loop', start)
+
+    def __getstate__(self):
+        # Keep the results, not the passes, for build_c.compile_template
+        state = dict(self.__dict__)
+        for key in ('typer', 'degrouper', 'folder', 'coder', 'writer',
+                    'ostream'):
+            state.pop(key, None)
+        return state
+
+    def _timed(self, name, start):
+        end = perf_counter()
+        self.timings[name] = end - start
+        return end
+
+    def _specialize(self, src, formats, macros, tables):
+        # The (opaque, transparent) source compilers, if worth a span loop
+        if not (SpanLoopWriter.can_skip(self.arg_names, self.arg_types) and
+                self._loads(self.function, self.arg_names[0],
+                            self.arg_types[0].order.index('a'))):
+            return None
+        compilers = []
+        for suffix, alpha in [('opaque', 255), ('transparent', 0)]:
+            compilers.append(Compiler(src, formats,
+                                      '{}_{}'.format(self.name, suffix),
+                                      self.simd,
+                                      {(self.arg_names[0], 'a'): alpha},
+                                      False, macros, tables))
+        if all(any(isinstance(n, ast.BinOp) for n in ast.walk(c.function))
+               for c in compilers):
+            return None
+        return compilers
+
+    @staticmethod
+    def _loads(function, arg, k):
+        # True if function loads byte k of argument arg
+        return any(isinstance(n, ast.Subscript) and
+                   isinstance(n.ctx, ast.Load) and n.value.id == arg and
+                   subscript_index(n) == k for n in ast.walk(function))
+
+    def write_loop(self, ostream, qualifiers=''):
+        """Write the per-pixel function and its loop entry point"""
+        ostream.write(self.code)
+        ostream.write('\n')
+        loop_name = None
+        exported = not qualifiers
+        batch = exported and len(self.arg_names) == 2
+        entries = StatsWriter.entries(self.name, self.span_compilers)
+        if exported:
+            StatsWriter(ostream).begin(entries)
+        if self.span_compilers:
+            loop_name, qualifiers = '{}_blend'.format(self.name), 'static '
+        if self.simd and VectorLoopWriter.can_vectorize(self.arg_types,
+                                                        self.function):
+            VectorLoopWriter(ostream).write(self.name, self.function,
+                                            self.arg_names, self.arg_types,
+                                            loop_name, qualifiers, self.pair)
+        else:
+            LoopWriter(ostream).write(self.name, self.arg_names,
+                                      self.arg_types, loop_name, qualifiers,
+                                      self.pair)
+        if self.span_compilers:
+            ostream.write('\n')
+            SpanLoopWriter(ostream).write(self.name, self.arg_names,
+                                          self.arg_types,
+                                          *self.span_compilers)
+        if exported:
+            ostream.write('\n')
+            StatsWriter(ostream).end(entries, self.arg_names, self.arg_types)
+        if batch:
+            ostream.write('\n')
+            BatchWriter(ostream).write(self.name, self.arg_names)
+
+    def write_declarations(self, ostream):
+        """Write the prototypes of the entry points write_loop exports"""
+        params = LoopWriter.params(self.arg_names)
+        for entry, extra, args in StatsWriter.entries(self.name,
+                                                      self.span_compilers):
+            ostream.write('void {}({}{});\n'.format(entry, params, extra))
+        if self.span_compilers:
+            ostream.write('void {0}_spans(unsigned char *{1}_pixels, '
+                          'ptrdiff_t {1}_stride, ptrdiff_t {1}_pitch, '
+                          'int width, int height, unsigned char *index);\n'
+                          .format(self.name, self.arg_names[0]))
+        if len(self.arg_names) == 2:
+            ostream.write('void {}_batch(const ptrdiff_t *blits, int count);\n'
+                          .format(self.name))
+
+
+def variant_name(name, formats):
+    """Return the C name of a template compiled for a tuple of formats
+
+    A negative, signed, array format -n is named sn.
+    """
+    return '_'.join([name] + ['s{}'.format(-f) if isinstance(f, int) and f < 0
+                              else str(f) for f in formats])
+
+def _compile_variant(src, formats, name, options):
+    # A VariantCompiler variant, by a function a process pool can pickle
+    simd, spans, macros, tables = options
+    return Compiler(src, formats, name, simd, spans=spans, macros=macros,
+                    tables=tables)
+
+class VariantCompiler:
+    """Compile a template for every combination of argument formats
+
+    formats maps argument names to sequences of formats; an unlisted
+    argument takes every format its target type supports (FORMATS). Each
+    combination is a separate per-pixel function and loop, named by
+    variant_name, so no format is tested inside a loop. When all formats
+    are sizes, a NAME_select(size, ...) function returns the loop for a
+    combination, or NULL. simd, spans, macros and tables are passed to
+    Compiler. timings maps each Compiler pass to its seconds summed over
+    variants.
+
+    code is the variants, after the lookup tables they share, written
+    once; library_code adds PRELUDE. write_declarations writes the
+    prototypes of their entry points, for a header.
+
+    map runs the compile of each variant. The map of a process pool, such
+    as concurrent.futures.ProcessPoolExecutor.map, compiles them in
+    parallel.
+    """
+
+    def __init__(self, src, formats=None, simd=True, spans=True,
+                 macros=None, tables=True, map=map):
+        from transform import (Fuser, Typer, imported_macros,
+                               template_function)
+
+        if formats is None:
+            formats = {}
+        if macros is None:
+            macros = imported_macros('blit')
+        self.src = src
+        tree = Fuser().visit(ast.parse(src, '<str>', 'exec'))
+        typer = Typer(macros)
+        typer.visit(tree)
+        func = template_function(tree)
+        self.name = func.name
+        self.arg_names = [a.arg for a in func.args.args]
+        choices = []
+        for arg in self.arg_names:
+            try:
+                choices.append(tuple(formats[arg]))
+            except KeyError:
+                choices.append(type(target_type(typer.symtab[arg])).FORMATS)
+        self.variants = OrderedDict()
+        self.tables = OrderedDict()
+        self.timings = OrderedDict()
+        combinations = list(product(*choices))
+        compilers = map(_compile_variant, [src] * len(combinations),
+                        [dict(zip(self.arg_names, c)) for c in combinations],
+                        [variant_name(self.name, c) for c in combinations],
+                        [(simd, spans, macros, tables)] * len(combinations))
+        for combination, compiler in zip(combinations, compilers):
+            self.variants[combination] = compiler
+            self.tables.update(compiler.tables)
+            for key, t in compiler.timings.items():
+                self.timings[key] = self.timings.get(key, 0) + t
+        self.select = all(isinstance(f, int) for c in choices for f in c)
+        ostream = StringIO()
+        ostream.write(Tabler.tables_code(self.tables))
+        for compiler in self.variants.values():
+            ostream.write('\n')
+            compiler.write_loop(ostream)
+        if self.select:
+            ostream.write('\n')
+            self.write_select(ostream)
+        self.code = ostream.getvalue()
+        self.library_code = PRELUDE + self.code
+
+    def write_declarations(self, ostream):
+        """Write the prototypes of the entry points of library_code"""
+        for compiler in self.variants.values():
+            compiler.write_declarations(ostream)
+        if self.select:
+            params = ', '.join('int {}_format'.format(a)
+                               for a in self.arg_names)
+            ostream.write('typedef void (*{}_loop_t)({});\n'.format(
+                self.name, LoopWriter.params(self.arg_names)))
+            ostream.write('{0}_loop_t {0}_select({1});\n'.format(self.name,
+                                                                 params))
+
+    def write_select(self, ostream):
+        name = self.name
+        ostream.write('typedef void (*{}_loop_t)({});\n\n'.format(
+            name, LoopWriter.params(self.arg_names)))
+        params = ', '.join('int {}_format'.format(a) for a in self.arg_names)
+        ostream.write('{0}_loop_t {0}_select({1}) {{\n'.format(name, params))
+        for combination, compiler in self.variants.items():
+            test = ' && '.join('{}_format == {}'.format(a, f)
+                               for a, f in zip(self.arg_names, combination))
+            ostream.write('    if ({}) {{\n'.format(test))
+            ostream.write('        return {}_loop;\n'.format(compiler.name))
+            ostream.write('    }\n')
+        ostream.write('    return NULL;\n')
+        ostream.write('}\n')
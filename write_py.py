@@ -0,0 +1,225 @@
+"""Write templates as straight-line Python functions
+
+A pure Python fallback for hosts with neither NumPy nor a C compiler. The
+degrouped template body is written out with one local variable per pixel
+channel, loaded from and stored to the raw pixel bytes once per pixel, so
+no blit.Pixel or blit.Group objects are built. The source is exec'd once
+per template and pixel layout and the function cached.
+"""
+
+import ast
+from io import StringIO
+from transform import (CompileError, imported_macros, lower,
+                       template_function)
+from buffers import SurfaceFunction
+
+# Degrouped call names to Python functions
+functions = {
+    'min': min,
+    }
+
+class PlaneUses(ast.NodeVisitor):
+    """Collect the (argument, plane) pairs a function body accesses
+    """
+
+    def __init__(self, arg_names):
+        self.arg_names = arg_names
+        self.loads = set()
+        self.stores = set()
+
+    def visit_Attribute(self, node):
+        value = node.value
+        if isinstance(value, ast.Name) and value.id in self.arg_names:
+            if isinstance(node.ctx, ast.Store):
+                self.stores.add((value.id, node.attr))
+            else:
+                self.loads.add((value.id, node.attr))
+        self.generic_visit(node)
+
+class Writer(ast.NodeVisitor):
+    """Write a degrouped template function as a Python row/pixel loop
+
+    orders maps each pixel argument name to the byte order string of its
+    buffer (see buffers.PixelBuffer). The written function takes, for each
+    argument, a byte memoryview and a pitch, followed by width and height.
+    """
+
+    def __init__(self, ostream, orders):
+        self.ostream = ostream
+        self.orders = orders
+        self.indent = ''
+
+    def visit_FunctionDef(self, node):
+        ostream = self.ostream
+        arg_names = [a.arg for a in node.args.args]
+        for name in arg_names:
+            if name not in self.orders:
+                raise CompileError("No pixel layout for {}".format(name))
+        params = []
+        for name in arg_names:
+            params.extend([name, '{}_pitch'.format(name)])
+        params.extend(['width', 'height'])
+        ostream.write('def {}({}):\n'.format(node.name, ', '.join(params)))
+        self.indent = '    '
+        ostream.write('{}for _y in range(height):\n'.format(self.indent))
+        self.indent += '    '
+        ranges = []
+        for name in arg_names:
+            bpp = len(self.orders[name])
+            start = '_y * {}_pitch'.format(name)
+            ranges.append('range({0}, {0} + width * {1}, {1})'.format(start,
+                                                                     bpp))
+        indices = ['{}_i'.format(name) for name in arg_names]
+        if len(ranges) == 1:
+            loop = 'for {} in {}:\n'.format(indices[0], ranges[0])
+        else:
+            loop = 'for {} in zip({}):\n'.format(', '.join(indices),
+                                                 ', '.join(ranges))
+        ostream.write(self.indent + loop)
+        self.indent += '    '
+        uses = PlaneUses(arg_names)
+        uses.visit(node)
+        for name, plane in sorted(uses.loads | uses.stores):
+            local = self._local(name, plane)
+            order = self.orders[name]
+            if plane in order:
+                value = '{}[{}_i + {}]'.format(name, name, order.index(plane))
+            else:
+                value = '255'
+            ostream.write('{}{} = {}\n'.format(self.indent, local, value))
+        for stmt in node.body:
+            self.visit(stmt)
+        for name, plane in sorted(uses.stores):
+            order = self.orders[name]
+            if plane not in order:
+                continue
+            ostream.write('{}{}[{}_i + {}] = {}\n'.format(
+                self.indent, name, name, order.index(plane),
+                self._local(name, plane)))
+        self.indent = ''
+
+    @staticmethod
+    def _local(name, plane):
+        return '{}_{}'.format(name, plane)
+
+    def visit_Assign(self, node):
+        targets = node.targets
+        if len(targets) > 1:
+            raise CompileError("Multiple assignment unsupported")
+        self.ostream.write(self.indent)
+        self.visit(targets[0])
+        self.ostream.write(' = ')
+        self.visit(node.value)
+        self.ostream.write('\n')
+
+    def visit_If(self, node):
+        self.ostream.write('{}if '.format(self.indent))
+        self.visit(node.test)
+        self.ostream.write(':\n')
+        self._write_block(node.body)
+        if node.orelse:
+            self.ostream.write('{}else:\n'.format(self.indent))
+            self._write_block(node.orelse)
+
+    def _write_block(self, stmts):
+        self.indent += '    '
+        for stmt in stmts:
+            self.visit(stmt)
+        if not stmts:
+            self.ostream.write('{}pass\n'.format(self.indent))
+        self.indent = self.indent[0:-4]
+
+    def visit_Call(self, node):
+        func = node.func
+        if not isinstance(func, ast.Name):
+            raise CompileError("Unable to handle non-name function id")
+        self.ostream.write('{}('.format(func.id))
+        for arg in node.args[0:-1]:
+            self.visit(arg)
+            self.ostream.write(', ')
+        for arg in node.args[-1:]:
+            self.visit(arg)
+        self.ostream.write(')')
+
+    def visit_BinOp(self, node):
+        self.ostream.write('(')
+        self.generic_visit(node)
+        self.ostream.write(')')
+
+    def visit_Add(self, node):
+        self.ostream.write(' + ')
+
+    def visit_Sub(self, node):
+        self.ostream.write(' - ')
+
+    def visit_Mult(self, node):
+        self.ostream.write(' * ')
+
+    def visit_FloorDiv(self, node):
+        self.ostream.write(' // ')
+
+    def visit_LShift(self, node):
+        self.ostream.write(' << ')
+
+    def visit_RShift(self, node):
+        self.ostream.write(' >> ')
+
+    def visit_Attribute(self, node):
+        value = node.value
+        if not isinstance(value, ast.Name):
+            raise CompileError("Only supports attributes of names")
+        self.ostream.write(self._local(value.id, node.attr))
+
+    def visit_Name(self, node):
+        self.ostream.write(node.id)
+
+    def visit_Constant(self, node):
+        self.ostream.write('{!r}'.format(node.value))
+
+    # Python 3.7 and earlier
+    def visit_Num(self, node):
+        self.ostream.write('{}'.format(node.n))
+
+class Compiler(SurfaceFunction):
+    """Compile a blitter or transmuter template into a surface function
+
+    Made and called like run_numpy.Compiler. A Python function is written
+    and exec'd for each combination of argument pixel layouts met, then
+    reused.
+    """
+
+    def __init__(self, src, functions=functions, macros=None):
+        if macros is None:
+            # Templates are exec'd in blit.py, so see its macros
+            macros = imported_macros('blit')
+        self.src = src
+        self.functions = functions
+        self.ast, self.typer = lower(src, macros)
+        self.function = template_function(self.ast)
+        self.arg_names = [a.arg for a in self.function.args.args]
+        self.codes = {}
+        self._cache = {}
+
+    def get_function(self, orders):
+        """Return the compiled function for a tuple of argument layouts"""
+        try:
+            return self._cache[orders]
+        except KeyError:
+            pass
+        ostream = StringIO()
+        Writer(ostream, dict(zip(self.arg_names, orders))).visit(self.function)
+        code = ostream.getvalue()
+        namespace = dict(self.functions)
+        exec(compile(code, '<{}>'.format(self.function.name), 'exec'),
+             namespace)
+        func = namespace[self.function.name]
+        self.codes[orders] = code
+        self._cache[orders] = func
+        return func
+
+    def _run(self, bufs, size):
+        func = self.get_function(tuple(b.order for b in bufs))
+        args = []
+        for b in bufs:
+            args.extend([b.view, b.pitch])
+        func(*args, *size)